@@ -14,6 +14,9 @@ from ghost_data import get_fresh_connection, get_app, get_job
 from ghost_data import update_app, update_job
 from ghost_log import log
 from ghost_tools import get_job_log_remote_path, GHOST_JOB_STATUSES_COLORS
+from libs.host_deploy_results import get_host_deploy_results_collector
+from libs.locks import JobLockRegistry
+from libs.ssh_pool import SSHConnectionPool, DEFAULT_SSH_KEEPALIVE
 
 from notification import MAIL_LOG_FROM_DEFAULT, Notification, TEMPLATES_DIR
 from settings import cloud_connections, DEFAULT_PROVIDER, REDIS_HOST
@@ -98,6 +101,8 @@ class Command:
     _db = None
     log_file = None
     app = None
+    ssh_pool = None
+    host_deploy_results = None
 
     def __init__(self, dry_run=False):
         self._dry_run = dry_run
@@ -124,6 +129,16 @@ class Command:
            '_updated': self.job['_updated']
         })
 
+    def record_hosts_results(self, results, module_name=None):
+        """
+        Appends the results by host of a remote execution to the job, one entry by module
+        for the executions deploying a list of modules
+        """
+        module_names = module_name if isinstance(module_name, list) else [module_name]
+        hosts_results = [dict(result, host=host, module=name) for host, result in results.items()
+                         for name in module_names]
+        self._db.jobs.update({'_id': self.job['_id']}, {'$push': {'hosts_results': {'$each': hosts_results}}})
+
     def _update_app_pending_changes(self, fields):
         app_pending_changes = {ob['field']: ob for ob in self.app.get('pending_changes', [])}
         for f in fields:
@@ -211,7 +226,17 @@ class Command:
         self._db = get_fresh_connection()
         self.job = get_job(job_id)
         self.app = get_app(self.job['app_id'])
+        # Registered until the job log is pushed, so that the disk manager keeps the job files
+        job_locks = JobLockRegistry()
+        job_lock_ids = [str(self.job['_id']), self._worker_job.id]
+        for job_lock_id in job_lock_ids:
+            job_locks.register(job_lock_id)
         self._init_log_file()
+        # SSH connections to instances are kept open and shared by the remote executions of the job
+        self.ssh_pool = SSHConnectionPool(self.log_file, int(self._config.get('ssh_keepalive', DEFAULT_SSH_KEEPALIVE)))
+        # Results of the detached stage2 runs, sent by instances to the Ghost API
+        self.host_deploy_results = get_host_deploy_results_collector(
+            self._config, self.job['_id'], self._db.host_deploy_results, Redis(host=REDIS_HOST))
         update_job(self.job['_id'], {
             'log_id': self._worker_job.id,
             'started_at': datetime.utcnow(),
@@ -237,8 +262,11 @@ class Command:
             self.update_status("failed", str(message))
             raise
         finally:
+            self.ssh_pool.close()
             subject, body, slack_msg = format_notif(self.app, self.job)
             self._slack_notification_action(slack_msg)
             self._close_log_file()
             self._mail_log_action(subject, body)
             self._push_log_to_s3()
+            for job_lock_id in job_lock_ids:
+                job_locks.unregister(job_lock_id)
@@ -2,26 +2,39 @@ import calendar
 import datetime
 import io
 import os
-from sh import git
+from multiprocessing.pool import ThreadPool
+from sh import git, ErrorReturnCode
 
 from ghost_tools import b64decode_utf8, boolify
 from ghost_tools import GCallException, gcall, get_app_module_name_list, clean_local_module_workspace, refresh_stage2
 from ghost_tools import get_aws_connection_data
-from ghost_tools import get_module_package_rev_from_manifest, keep_n_recent_elements_from_list
 from ghost_tools import get_mirror_path_from_module, get_lock_path_from_repo
 from ghost_log import log
 from settings import cloud_connections, DEFAULT_PROVIDER
-from libs.git_helper import git_acquire_lock, git_release_lock
+from libs.git_helper import git_fetch_mirror_commit, git_update_mirror, git_update_submodules
 from libs.host_deployment_manager import HostDeploymentManager
 from libs.deploy import execute_module_script_on_ghost
-from libs.deploy import get_path_from_app_with_color
-from libs.deploy import get_buildpack_clone_path_from_module, get_intermediate_clone_path_from_module
-from libs.deploy import update_app_manifest, rollback_app_manifest
-from libs.deploy import download_s3_object
+from libs.deploy import get_path_from_app_with_color, get_module_build_hash
+from libs.deploy import get_buildpack_clone_path_from_module
+from libs.deploy import get_app_manifest
+from libs.disk_manager import get_disk_stores, manage_disk_stores
+from libs.build_cache import BuildCache, get_build_cache_config, get_build_cache_key
+from libs.lxd import lxd_is_available
+from libs.package_catalog import import_module_packages, purge_module_packages, register_package
+from libs.packaging import get_package_codec, get_package_extension, get_package_extract_command, PackageFilter
+from libs.packaging import stream_package_to_s3, stream_delta_package_to_s3
+from libs.packaging import get_package_index, get_package_delta, upload_package_index, download_package_index
+from libs.packaging import get_package_index_name, get_package_delta_name, get_package_store_key_path
+from libs.s3_sources import S3SourcesFetcher
+from libs.timings import PhaseTimer
+from libs.workspaces import WorkspaceLocks, get_workspace_mode, remove_workspace, touch_workspace
 
 COMMAND_DESCRIPTION = "Deploy module(s)"
 RELATED_APP_FIELDS = ['modules']
 
+# Number of commits of the module history kept in working directories and packages
+GIT_CLONE_DEPTH = 10
+
 
 def is_available(app_context=None):
     return True
@@ -38,6 +51,8 @@ class Deploy:
     _as_group = None
     _worker = None
     _config = None
+    _purge_pool = None
+    _manifest = None
 
     def __init__(self, worker):
         self._app = worker.app
@@ -66,68 +81,212 @@ class Deploy:
                         result.append(item)
         return result
 
-    def _deploy_module(self, module, fabric_execution_strategy, safe_deployment_strategy):
+    def _deploy_module(self, module, fabric_execution_strategy, safe_deployment_strategy, timer=None):
+        """
+        Deploys the module, or the list of modules with a single stage2 run by instance
+        """
+        module_names = [mod['name'] for mod in (module if isinstance(module, list) else [module])]
         deploy_manager = HostDeploymentManager(self._cloud_connection, self._app, module, self._log_file,
-                                               self._app.get('safe-deployment', {}), fabric_execution_strategy)
+                                               self._app.get('safe-deployment', {}), fabric_execution_strategy,
+                                               timer=timer, hosts_results_recorder=lambda results: (
+                                                   self._worker.record_hosts_results(results, module_names)),
+                                               ssh_pool=self._worker.ssh_pool,
+                                               host_deploy_results=self._worker.host_deploy_results)
         deploy_manager.deployment(safe_deployment_strategy)
 
-    def _purge_s3_package(self, path, bucket, module, pkg_name, deployment_package_retention=42):
+    def _use_package_store(self):
+        return boolify(self._config.get('deployment_package_store', False))
+
+    def _get_package_name(self, module, ts, commit, codec):
+        return "{0}_{1}_{2}{3}".format(ts, module['name'], commit, get_package_extension(codec))
+
+    def _package_module(self, module, ts, commit, timer, build_hash=None):
         """
-        Purge N old packages deployment for the current module from the current app
+        Creates the module package and uploads it to S3, in the package store if enabled
+        Returns the package name, its key path in the package store (None if stored in the module path),
+        the package size, the uncompressed size of its content, its number of files
+        and the names of the package index and delta, if any
         """
-        try:
-            # Get all packages in S3 related to the current module
-            keys_list = [i.name.split("/")[-1] for i in bucket.list(path[+1:])]
-
-            # Get app manifest and extract package name
-            manifest_key_path = '{path}/MANIFEST'.format(path=get_path_from_app_with_color(self._app))
-            manifest_module_pkg_name = get_module_package_rev_from_manifest(bucket, manifest_key_path, module)
-
-            # Remove the current production/used package from the purge list
-            keys_list.remove(manifest_module_pkg_name)
-
-            # Remove the current deployment package just generated from the purge list
-            keys_list.remove(pkg_name)
-
-            if len(keys_list) > deployment_package_retention:
-                keys_list = keep_n_recent_elements_from_list(keys_list, deployment_package_retention, self._log_file)
-                for obj in keys_list:
-                    key_path_to_purge = '{path}/{obj}'.format(path=path, obj=obj)
-                    try:
-                        bucket.get_key(key_path_to_purge).delete()
-                        log("Packages Purge: Deleted S3 Object: %s" % key_path_to_purge, self._log_file)
-                    except:
-                        log("Packages Purge: Delete FAILED for S3 Object: %s" % key_path_to_purge, self._log_file)
-        except Exception, e:
-            log("Packages Purge: Global exception | " + str(e), self._log_file)
-
-    def _package_module(self, module, ts, commit):
         path = get_buildpack_clone_path_from_module(self._app, module)
-        os.chdir(path)
-        pkg_name = "{0}_{1}_{2}".format(ts, module['name'], commit)
-        pkg_path = '../{0}'.format(pkg_name)
+        codec = get_package_codec(self._config, self._log_file)
+        pkg_name = self._get_package_name(module, ts, commit, codec)
         uid = module.get('uid', os.geteuid())
         gid = module.get('gid', os.getegid())
-        tar_exclude_git = "--exclude '.git'" if boolify(self._config.get('deployment_package_exclude_git_metadata', False)) else ''
-        gcall("tar czf {0} --owner={1} --group={2} {3} .".format(pkg_path, uid, gid, tar_exclude_git), "Creating package: %s" % pkg_name, self._log_file)
+        package_filter = PackageFilter.from_module(
+            module, path, boolify(self._config.get('deployment_package_exclude_git_metadata', False)))
 
-        log("Uploading package: %s" % pkg_name, self._log_file)
+        log("Creating and uploading package: %s" % pkg_name, self._log_file)
         conn = self._local_cloud_connection.get_connection(self._config.get('bucket_region', self._app['region']), ["s3"])
         bucket = conn.get_bucket(self._config['bucket_s3'])
-        key_path = '{path}/{pkg_name}'.format(path=path, pkg_name=pkg_name)
-        key = bucket.get_key(path)
-        if not key:
-            key = bucket.new_key(key_path)
-        key.set_contents_from_filename(pkg_path)
+        store_key_path = None
+        if self._use_package_store() and build_hash:
+            store_key_path = get_package_store_key_path(build_hash, codec)
+            key_path = store_key_path
+        else:
+            key_path = '{path}/{pkg_name}'.format(path=path, pkg_name=pkg_name)
+        with timer.phase('package_upload'):
+            package_size, content_size, file_count = stream_package_to_s3(
+                path, bucket, key_path, codec, uid, gid, self._log_file, package_filter=package_filter,
+                metadata={'build-hash': build_hash} if build_hash else None,
+                part_size=int(self._config.get('deployment_package_upload_part_size', 16)) * 1024 * 1024,
+                concurrency=int(self._config.get('deployment_package_upload_concurrency', 4)))
+
+        sidecars = []
+        if boolify(self._config.get('deployment_package_delta', False)):
+            with timer.phase('package_delta'):
+                try:
+                    self._package_module_delta(module, path, bucket, pkg_name, uid, gid, package_filter, sidecars)
+                except GCallException as e:
+                    # Instances fall back to the full package
+                    log("Delta package creation failed: {0}".format(e), self._log_file)
+
+        return pkg_name, store_key_path, package_size, content_size, file_count, sidecars
+
+    def _package_module_delta(self, module, path, bucket, pkg_name, uid, gid, package_filter, sidecars):
+        """
+        Uploads the content index of the package, then a delta package against the package currently named
+        in the app manifest, if its index is available. Uploaded objects names are appended to sidecars.
+        """
+        index = get_package_index(path, package_filter)
+        upload_package_index(bucket, '{0}/{1}'.format(path, get_package_index_name(pkg_name)), index)
+        sidecars.append(get_package_index_name(pkg_name))
 
-        gcall("rm -f {0}".format(pkg_path), "Deleting local package: %s" % pkg_name, self._log_file)
+        base_pkg_name = self._manifest.get_module_package(module['name'])
+        if not base_pkg_name or base_pkg_name == pkg_name:
+            log("Delta package: no previous package deployed for module '{0}'".format(module['name']),
+                self._log_file)
+            return
+        base_index = download_package_index(bucket, '{0}/{1}'.format(path, get_package_index_name(base_pkg_name)))
+        if base_index is None:
+            log("Delta package: no content index for base package {0}".format(base_pkg_name), self._log_file)
+            return
+        files = sorted(index.keys())
+        if any('\n' in name for name in files):
+            log("Delta package: file names with line breaks are not supported", self._log_file)
+            return
 
+        paths = get_package_delta(base_index, index)
+        delta_name = get_package_delta_name(pkg_name, base_pkg_name)
+        log("Delta package: {0} of {1} files changed since {2}".format(len(paths), len(files), base_pkg_name),
+            self._log_file)
+        stream_delta_package_to_s3(
+            path, bucket, '{0}/{1}'.format(path, delta_name), paths, base_pkg_name, index, uid, gid, self._log_file,
+            part_size=int(self._config.get('deployment_package_upload_part_size', 16)) * 1024 * 1024,
+            concurrency=int(self._config.get('deployment_package_upload_concurrency', 4)))
+        sidecars.append(delta_name)
+
+    def _get_packages_retention(self):
+        """
+        Returns the number of packages to keep for each module of the app, None to keep them all
+
+        >>> class worker:
+        ...   app = {'env': 'prod'}
+        ...   job = None
+        ...   log_file = None
+        ...   _config = {}
+        >>> Deploy(worker=worker())._get_packages_retention() is None
+        True
+        >>> worker._config = {'deployment_package_retention': {'prod': 10, 'dev': 2}}
+        >>> Deploy(worker=worker())._get_packages_retention()
+        10
+        """
         deployment_package_retention_config = self._config.get('deployment_package_retention', None)
         if deployment_package_retention_config and self._app['env'] in deployment_package_retention_config:
-            deployment_package_retention = deployment_package_retention_config.get(self._app['env'], 42)
-            self._purge_s3_package(path, bucket, module, pkg_name, deployment_package_retention)
+            return deployment_package_retention_config.get(self._app['env'], 42)
+        return None
 
-        return pkg_name
+    def _purge_module_packages(self, module, retention):
+        """
+        Deletes the old packages of the module, using the packages catalog
+        """
+        path = get_buildpack_clone_path_from_module(self._app, module)
+        try:
+            conn = self._local_cloud_connection.get_connection(self._config.get('bucket_region', self._app['region']), ["s3"])
+            bucket = conn.get_bucket(self._config['bucket_s3'])
+            import_module_packages(self._worker._db.packages, self._worker._db.packages_imports, bucket, self._app,
+                                   module['name'], path,
+                                   '{path}/MANIFEST'.format(path=get_path_from_app_with_color(self._app)),
+                                   self._log_file)
+            purge_module_packages(self._worker._db.packages, bucket, path, module['name'], retention, self._log_file)
+        except Exception as e:
+            log("Packages Purge: Global exception | " + str(e), self._log_file)
+
+    def _schedule_packages_purge(self, module):
+        """
+        Purges the old packages of the module in background, the job waits for the purges before ending
+        """
+        retention = self._get_packages_retention()
+        if retention is None:
+            return
+        if not self._purge_pool:
+            self._purge_pool = ThreadPool(1)
+        self._purge_pool.apply_async(self._purge_module_packages, (module, retention))
+
+    def _wait_for_packages_purges(self):
+        if self._purge_pool:
+            self._purge_pool.close()
+            self._purge_pool.join()
+            self._purge_pool = None
+
+    def _get_build_cache(self):
+        bucket = None
+        if boolify(self._config.get('build_cache_s3', False)):
+            conn = self._local_cloud_connection.get_connection(self._config.get('bucket_region', self._app['region']),
+                                                               ["s3"])
+            bucket = conn.get_bucket(self._config['bucket_s3'])
+        return BuildCache(self._config, self._log_file, bucket)
+
+    def _get_module_build_hash(self, module, source_url, clone_path, revision):
+        """
+        Returns the build hash of the fetched module sources, None if the sources version cannot be pinned
+        """
+        protocol = module.get('source', {}).get('protocol', '').strip()
+        if protocol == 'git':
+            version = git('--no-pager', 'rev-parse', 'HEAD', _cwd=clone_path, _tty_out=False).strip()
+        elif protocol == 's3' and revision != 'latest':
+            version = revision
+        else:
+            return None
+        return get_module_build_hash(self._app, module, source_url, version, self._config)
+
+    def _find_cached_package(self, module, build_hash):
+        """
+        Returns the most recent package built from the same inputs, if it is still available in S3
+        With the package store, the package may have been built by any job of the app, the hash including its identity
+        """
+        if self._use_package_store():
+            conn = self._local_cloud_connection.get_connection(
+                self._config.get('bucket_region', self._app['region']), ["s3"])
+            bucket = conn.get_bucket(self._config['bucket_s3'])
+            return bucket.get_key(get_package_store_key_path(build_hash, get_package_codec(self._config,
+                                                                                           self._log_file)))
+        deployment = self._worker._db.deploy_histories.find_one(
+            {'app_id': self._app['_id'], 'module': module['name'], 'build_hash': build_hash},
+            sort=[('timestamp', -1)])
+        if not deployment:
+            return None
+        path = get_buildpack_clone_path_from_module(self._app, module)
+        conn = self._local_cloud_connection.get_connection(self._config.get('bucket_region', self._app['region']), ["s3"])
+        bucket = conn.get_bucket(self._config['bucket_s3'])
+        key = bucket.get_key('{path}/{pkg_name}'.format(path=path, pkg_name=deployment['package']))
+        if not key or key.get_metadata('build-hash') != build_hash:
+            log("Package cache: '{0}' was built from the same inputs but is no longer available".format(
+                deployment['package']), self._log_file)
+            return None
+        return key
+
+    def _extract_cached_package(self, module, key, clone_path):
+        """
+        Restores the built workspace from a cached package, needed by the after_all_deploy script
+        """
+        pkg_path = '{0}/{1}'.format(os.path.dirname(clone_path), key.name.split('/')[-1])
+        log("Downloading cached package: {0}".format(key.name), self._log_file)
+        key.get_contents_to_filename(pkg_path)
+        try:
+            gcall(get_package_extract_command(pkg_path, clone_path),
+                  "Extracting cached package into the module working directory", self._log_file)
+        finally:
+            gcall('rm -f "{0}"'.format(pkg_path), "Deleting local cached package", self._log_file)
 
     def _get_module_revision(self, module_name):
         for module in self._job['modules']:
@@ -136,6 +295,23 @@ class Deploy:
                     return module['rev']
                 return 'HEAD'
 
+    def _is_clean_build(self, module_name):
+        """
+        >>> class worker:
+        ...   app = {}
+        ...   job = {'modules': [{'name': 'mod1', 'rev': 'master'}, {'name': 'mod2', 'clean_build': True}]}
+        ...   log_file = None
+        ...   _config = None
+        >>> Deploy(worker=worker())._is_clean_build('mod1')
+        False
+        >>> Deploy(worker=worker())._is_clean_build('mod2')
+        True
+        """
+        for module in self._job['modules']:
+            if module.get('name') == module_name:
+                return bool(module.get('clean_build'))
+        return False
+
     def _get_notification_message_done(self, deploy_ids):
         """
         >>> from bson.objectid import ObjectId
@@ -187,229 +363,207 @@ class Deploy:
         message = ', '.join([module['name'] for module in modules])
         return "Deployment Aborted: missing modules [{0}]".format(message)
 
-    def execute(self):
-        fabric_execution_strategy = self._job['options'][0] if 'options' in self._job and len(self._job['options']) > 0 else None
-        safe_deployment_strategy = self._job['options'][1] if 'options' in self._job and len(self._job['options']) > 1 else None
-
-        self._apps_modules = self._find_modules_by_name(self._job['modules'])
-        if not self._apps_modules:
-            self._worker.update_status("aborted", message=self._get_notification_message_aborted(self._job['modules']))
-            return
-
-        # Cannot use self._cloud_connection, needs to use local one for S3 bucket
-        refresh_stage2(self._local_cloud_connection, self._config.get('bucket_region', self._app['region']), self._config)
-        module_list = []
-        for module in self._apps_modules:
-            if 'name' in module:
-                module_list.append(module['name'])
-        split_comma = ', '
-        module_list = split_comma.join(module_list)
-        try:
-            deploy_ids = {}
-            for module in self._apps_modules:
-                deploy_id = self._execute_deploy(module, fabric_execution_strategy, safe_deployment_strategy)
-                deploy_ids[module['name']] = deploy_id
-                self._worker._db.jobs.update({ '_id': self._job['_id'], 'modules.name': module['name']}, {'$set': { 'modules.$.deploy_id': deploy_id }})
-                self._worker._db.apps.update({ '_id': self._app['_id'], 'modules.name': module['name']}, {'$set': { 'modules.$.initialized': True }})
-
-            self._worker.update_status("done", message=self._get_notification_message_done(deploy_ids))
-        except GCallException as e:
-            self._worker.update_status("failed", message=self._get_notification_message_failed(module_list, e))
-
-    def _is_commit_hash(self, revision):
-        """
-        Returns True is revision is a valid commit hash, False otherwise.
-
-        ***NOTE***:
-        This test invokes git rev-parse in the current working directory and will fail
-        if git is not installed or run outside of a git workspace.
-
-        >>> class worker:
-        ...   app = {}
-        ...   job = None
-        ...   log_file = None
-        ...   _config = None
-
-        >>> Deploy(worker=worker())._is_commit_hash('HEAD')
-        False
-
-        >>> Deploy(worker=worker())._is_commit_hash('master')
-        False
-
-        >>> Deploy(worker=worker())._is_commit_hash('dev')
-        False
-
-        >>> current_git_hash = git('--no-pager', 'rev-parse', 'HEAD', _tty_out=False).strip()
-        >>> Deploy(worker=worker())._is_commit_hash(current_git_hash)
-        True
-
-        The length of a valid abbreviated hash depends on the current repository:
-
-        >>> shortest_hash = git('--no-pager', 'rev-parse', '--short', 'HEAD', _tty_out=False).strip()
-        >>> Deploy(worker=worker())._is_commit_hash(current_git_hash[:len(shortest_hash)])
-        True
-
-        Very short substrings won't match:
-
-        >>> Deploy(worker=worker())._is_commit_hash(current_git_hash[:3])
-        False
-        """
-
-        resolved_revision = ''
-        try:
-            # git rev-parse returns a complete hash from an abbreviated hash, if valid
-            resolved_revision = git('--no-pager', 'rev-parse', revision, _tty_out=False).strip()
-        except:
-            pass
-
-        # If resolved_revision begins with or equals revision, it is a commit hash
-        return resolved_revision.find(revision) == 0
-
-    def _get_module_git(self, module, git_repo, clone_path):
+    def _get_module_git(self, module, git_repo, clone_path, timer):
         """
         Fetch the module sources from Git
         :param module: Module object
         :param git_repo: Source git repository
         :param clone_path: Working directory
+        :param timer: PhaseTimer of the module deployment
         :return: (source url, working directory, source version, version uid, version message)
         """
         mirror_path = get_mirror_path_from_module(module)
         lock_path = get_lock_path_from_repo(git_repo)
         revision = self._get_module_revision(module['name'])
 
-        try:
-            git_acquire_lock(lock_path, self._log_file)
-
-            if not os.path.exists(mirror_path):
-                gcall('git --no-pager clone --bare --mirror {r} {m}'.format(r=git_repo, m=mirror_path),
-                      'Create local git mirror for remote {r}'.format(r=git_repo),
-                      self._log_file)
-
-            # Update existing git mirror
-            os.chdir(mirror_path)
-            gcall('git --no-pager gc --auto',
-                  'Cleanup local mirror before update {r}'.format(r=git_repo),
-                  self._log_file)
-            gcall('git --no-pager fetch --all --tags --prune',
-                  'Update local git mirror from remote {r}'.format(r=git_repo),
-                  self._log_file)
-        finally:
-            git_release_lock(lock_path, self._log_file)
+        with timer.phase('mirror_fetch'):
+            git_update_mirror(git_repo, mirror_path, lock_path, self._log_file, revision=revision,
+                              fetch_window=int(self._config.get('git_mirror_fetch_window', 0)))
 
         # Resolve HEAD symbolic reference to identify the default branch
-        head = git('--no-pager', 'symbolic-ref', '--short', 'HEAD', _tty_out=False).strip()
+        head = git('--no-pager', 'symbolic-ref', '--short', 'HEAD', _cwd=mirror_path, _tty_out=False).strip()
 
         # If revision is HEAD, replace it by the default branch
         if revision == 'HEAD':
             revision = head
 
-        # If revision is a commit hash, a full intermediate clone is required before getting a shallow clone
-        if self._is_commit_hash(revision):
-            # Create intermediate clone from the local git mirror, chdir into it and fetch all commits
-            source_path = get_intermediate_clone_path_from_module(self._app, module)
-            if os.path.exists(source_path):
-                gcall('chmod -R u+rwx {p}'.format(p=source_path), 'Update rights on previous intermediate clone', self._log_file)
-                gcall('rm -rf {p}'.format(p=source_path), 'Removing previous intermediate clone', self._log_file)
-            os.makedirs(source_path)
-            os.chdir(source_path)
-            gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
-            gcall('git --no-pager init', 'Git init intermediate clone', self._log_file)
-            gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
-            gcall('git --no-pager remote add origin file://{m}'.format(m=mirror_path), 'Git add local mirror as origin for intermediate clone', self._log_file)
-            gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
-            gcall('git --no-pager fetch origin', 'Git fetch all commits from origin', self._log_file)
-            gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
-            gcall('git --no-pager checkout {r}'.format(r=revision), 'Git checkout revision into intermediate clone: {r}'.format(r=revision), self._log_file)
-            gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
-
-            # Create shallow clone from the intermediate clone, chdir into it and retrieve submodules
-            if os.path.exists(clone_path):
-                gcall('chmod -R u+rwx {p}'.format(p=clone_path), 'Update rights on previous clone', self._log_file)
-                gcall('rm -rf {p}'.format(p=clone_path), 'Removing previous clone', self._log_file)
-            os.makedirs(clone_path)
-            os.chdir(clone_path)
-            gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
-            gcall('git --no-pager clone file://{s} .'.format(s=source_path), 'Git clone from intermediate clone', self._log_file)
-            gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
-            gcall('git --no-pager submodule update --init --recursive', 'Git update submodules', self._log_file)
-            gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
-
-            # Destroy intermediate clone
-            gcall('chmod -R u+rwx {p}'.format(p=source_path), 'Update rights on previous intermediate clone', self._log_file)
-            gcall('rm -rf {p}'.format(p=source_path), 'Removing intermediate clone', self._log_file)
-        else:
-            # Create clone from the local git mirror, chdir into it, fetch requested revision and retrieve submodules
-            if os.path.exists(clone_path):
-                gcall('chmod -R u+rwx {p}'.format(p=clone_path), 'Update rights on previous clone', self._log_file)
-                gcall('rm -rf {p}'.format(p=clone_path), 'Removing previous clone', self._log_file)
-            os.makedirs(clone_path)
-            os.chdir(clone_path)
-            gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
-            gcall('git --no-pager clone --depth=10 file://{m} -b {r} .'.format(m=mirror_path, r=revision), 'Git clone from local mirror with depth limited to 10 from a specific revision: {r}'.format(r=revision), self._log_file)
-            gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
-            gcall('git --no-pager submodule update --init --recursive', 'Git update submodules', self._log_file)
-            gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
+        with timer.phase('checkout'):
+            self._checkout_module_git(git_repo, mirror_path, clone_path, revision,
+                                      get_workspace_mode(module) == 'persistent')
 
         # Extract commit information
-        commit = git('--no-pager', 'rev-parse', '--short', 'HEAD', _tty_out=False).strip()
-        commit_message = git('--no-pager', 'log', '--max-count=1', '--format=%s', 'HEAD', _tty_out=False).strip()
+        commit = git('--no-pager', 'rev-parse', '--short', 'HEAD', _cwd=clone_path, _tty_out=False).strip()
+        commit_message = git('--no-pager', 'log', '--max-count=1', '--format=%s', 'HEAD', _cwd=clone_path, _tty_out=False).strip()
 
         # At last, reset remote origin URL
-        gcall('git --no-pager remote set-url origin {r}'.format(r=git_repo), 'Git reset remote origin to {r}'.format(r=git_repo), self._log_file)
+        gcall('git --no-pager remote set-url origin {r}'.format(r=git_repo), 'Git reset remote origin to {r}'.format(r=git_repo), self._log_file, cwd=clone_path)
 
         return git_repo, clone_path, revision, commit, commit_message
 
-    def _get_module_s3(self, module, source_url, working_directory):
+    def _resolve_mirror_revision(self, mirror_path, revision):
+        """
+        Returns the commit hash the revision points to in the local mirror and whether the revision is a branch
+        """
+        for ref, is_branch in (('refs/heads/{0}'.format(revision), True), (revision, False)):
+            try:
+                commit = git('--no-pager', 'rev-parse', '--verify', '--quiet', '{0}^{{commit}}'.format(ref),
+                             _cwd=mirror_path, _tty_out=False).strip()
+                return commit, is_branch
+            except ErrorReturnCode:
+                pass
+        raise GCallException('ERROR: Revision "{0}" not found in local mirror {1}'.format(revision, mirror_path))
+
+    def _is_mirror_clone(self, mirror_url, clone_path):
+        """
+        Returns True if clone_path is a working directory previously cloned from the given local mirror url
+        """
+        if not os.path.isdir(os.path.join(clone_path, '.git')):
+            return False
+        try:
+            return git('--no-pager', 'config', '--get', 'ghost.mirror', _cwd=clone_path, _tty_out=False).strip() == mirror_url
+        except ErrorReturnCode:
+            return False
+
+    def _checkout_module_git(self, git_repo, mirror_path, clone_path, revision, keep_ignored_files=False):
+        """
+        Updates in place the persistent module working directory to the revision from the local mirror.
+        Only the last GIT_CLONE_DEPTH commits are fetched, as the .git metadata is packaged unless excluded.
+        The working directory is only created again if it is missing or was not cloned from this mirror.
+        Files ignored by git are kept if requested, for incremental builds.
+        """
+        commit, is_branch = self._resolve_mirror_revision(mirror_path, revision)
+        # git ignores --depth for local paths, a file:// url is required for shallow fetches
+        mirror_url = 'file://{m}'.format(m=mirror_path)
+
+        if self._is_mirror_clone(mirror_url, clone_path):
+            gcall('git --no-pager remote set-url origin {m}'.format(m=mirror_url),
+                  'Git set local mirror as origin', self._log_file, cwd=clone_path)
+        else:
+            if os.path.exists(clone_path):
+                gcall('chmod -R u+rwx {p}'.format(p=clone_path), 'Update rights on previous clone', self._log_file)
+                gcall('rm -rf {p}'.format(p=clone_path), 'Removing previous clone', self._log_file)
+            gcall('git --no-pager init {c}'.format(c=clone_path), 'Git init clone', self._log_file)
+            gcall('git --no-pager remote add origin {m}'.format(m=mirror_url),
+                  'Git add local mirror as origin', self._log_file, cwd=clone_path)
+            gcall('git --no-pager config ghost.mirror {m}'.format(m=mirror_url),
+                  'Git record local mirror of clone', self._log_file, cwd=clone_path)
+        git_fetch_mirror_commit(clone_path, commit, GIT_CLONE_DEPTH, self._log_file)
+
+        if is_branch:
+            gcall('git --no-pager checkout --force -B {r} {c}'.format(r=revision, c=commit),
+                  'Git checkout branch {r} at {c}'.format(r=revision, c=commit), self._log_file, cwd=clone_path)
+        else:
+            gcall('git --no-pager checkout --force --detach {c}'.format(c=commit),
+                  'Git checkout revision {r} at {c}'.format(r=revision, c=commit), self._log_file, cwd=clone_path)
+
+        clean_command = 'git --no-pager clean -ffd' if keep_ignored_files else 'git --no-pager clean -ffdx'
+        try:
+            gcall(clean_command, 'Git remove files left by previous builds', self._log_file, cwd=clone_path)
+        except GCallException:
+            gcall('chmod -R u+rwx {p}'.format(p=clone_path), 'Update rights on previous build files', self._log_file)
+            gcall(clean_command, 'Git remove files left by previous builds', self._log_file, cwd=clone_path)
+        git_update_submodules(clone_path, git_repo, self._log_file,
+                              fetch_window=int(self._config.get('git_mirror_fetch_window', 0)),
+                              keep_ignored_files=keep_ignored_files)
+
+    def _get_module_s3(self, module, source_url, working_directory, timer):
         """
         Fetch the module sources from S3
         :param module:
         :param source_url:
         :param working_directory:
+        :param timer: PhaseTimer of the module deployment
         :return: (source url, working directory, source version, version uid, version message)
         """
         if not source_url.startswith('s3://'):
             raise GCallException('Invalid S3 source url given: "{}", it must starts with "s3://"'.format(source_url))
         revision = self._get_module_revision(module['name'])
-
-        # If revision is HEAD, use the latest S3 object version
-        if revision.lower().strip() in ['head', 'latest']:
-            revision = 'latest'
-            gcall('aws s3 cp "{s}" "{w}" --recursive'.format(s=source_url, w=working_directory),
-                  'Retrieving from S3 bucket ({url}) at latest revision'.format(url=source_url),
-                  self._log_file)
-        else:
-            log("Retrieving from S3 bucket ({url}) at revision '{rev}'".format(url=source_url, rev=revision),
-                self._log_file)
-            download_s3_object(self._app, source_url, working_directory, revision, self._log_file)
+        # No assume role, local S3 access
+        conn = self._local_cloud_connection.get_connection(self._config.get('bucket_region', self._app['region']),
+                                                           ["s3"], boto_version='boto3')
+        fetcher = S3SourcesFetcher(conn, self._config, self._log_file)
+
+        with timer.phase('source_download'):
+            # If revision is HEAD, use the latest S3 object version
+            if revision.lower().strip() in ['head', 'latest']:
+                revision = 'latest'
+                log("Retrieving from S3 bucket ({url}) at latest revision".format(url=source_url), self._log_file)
+                fetcher.fetch_latest(source_url, working_directory)
+            else:
+                log("Retrieving from S3 bucket ({url}) at revision '{rev}'".format(url=source_url, rev=revision),
+                    self._log_file)
+                fetcher.fetch_version(source_url, working_directory, revision)
 
         return source_url, working_directory, revision, '', ''
 
-    def _get_module_sources(self, module):
+    def _get_module_sources(self, module, timer):
         """
         Fetch the current module source, using the right protocol
         :param module: app module object
+        :param timer: PhaseTimer of the module deployment
         :return: (source url, working directory, source version, version uid, version message)
         """
         source = module.get('source', {})
         source_protocol = source['protocol'].strip()
         source_url = source['url'].strip()
         clone_path = get_buildpack_clone_path_from_module(self._app, module)
+        if self._is_clean_build(module['name']) and os.path.exists(clone_path):
+            log("Clean build requested for module '{0}'".format(module['name']), self._log_file)
+            remove_workspace(clone_path, self._log_file)
         if source_protocol == 'git':
-            return self._get_module_git(module, source_url, clone_path)
+            return self._get_module_git(module, source_url, clone_path, timer)
         elif source_protocol == 's3':
-            return self._get_module_s3(module, source_url, clone_path)
+            return self._get_module_s3(module, source_url, clone_path, timer)
         else:
             raise GCallException('Invalid source protocol provided ({})'.format(source_protocol))
 
-    def _execute_deploy(self, module, fabric_execution_strategy, safe_deployment_strategy):
+    def _build_module(self, module):
         """
-        Returns the deployment id
+        Fetches the module sources, runs its buildpack and uploads its package
+        Returns the build infos needed to push the module on instances
         """
-
+        log("Building module '{0}'".format(module['name']), self._log_file)
         now = datetime.datetime.utcnow()
         ts = calendar.timegm(now.timetuple())
-
-        git_repo, clone_path, revision, commit, commit_message = self._get_module_sources(module)
+        timer = PhaseTimer()
+
+        git_repo, clone_path, revision, commit, commit_message = self._get_module_sources(module, timer)
+        touch_workspace(clone_path)
+
+        build_hash = None
+        if boolify(self._config.get('deployment_package_cache', False)) or self._use_package_store():
+            with timer.phase('package_cache_lookup'):
+                build_hash = self._get_module_build_hash(module, git_repo, clone_path, revision)
+                cached_key = self._find_cached_package(module, build_hash) if build_hash else None
+            if cached_key:
+                if self._use_package_store():
+                    # The package store is shared, the package gets a name of its own in this app path
+                    pkg_name = self._get_package_name(module, ts, commit,
+                                                      get_package_codec(self._config, self._log_file))
+                    package_key_path = cached_key.name
+                else:
+                    pkg_name = cached_key.name.split('/')[-1]
+                    package_key_path = None
+                log("Package cache: module '{0}' is unchanged since package {1}, skipping build".format(
+                    module['name'], cached_key.name.split('/')[-1]), self._log_file)
+                if 'after_all_deploy' in module:
+                    with timer.phase('package_cache_extract'):
+                        self._extract_cached_package(module, cached_key, clone_path)
+                return {
+                    'ts': ts,
+                    'clone_path': clone_path,
+                    'revision': revision,
+                    'commit': commit,
+                    'commit_message': commit_message,
+                    'package': pkg_name,
+                    'package_key_path': package_key_path,
+                    'package_size': cached_key.size,
+                    'package_content_size': None,
+                    'package_file_count': None,
+                    'package_sidecars': [],
+                    'build_hash': build_hash,
+                    'timer': timer,
+                }
 
         # Store predeploy script in tarball
         if 'pre_deploy' in module:
@@ -417,11 +571,25 @@ class Deploy:
             predeploy_source = b64decode_utf8(module['pre_deploy'])
             with io.open(clone_path + '/predeploy', mode='w', encoding='utf-8') as f:
                 f.write(predeploy_source)
-            gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
+
+        # Restore the dependencies installed by previous builds
+        build_cache_key = None
+        if 'build_pack' in module:
+            build_cache_key = get_build_cache_key(self._app, module, clone_path,
+                                                  self._app['build_infos'].get('container_image'))
+        if build_cache_key:
+            build_cache = self._get_build_cache()
+            with timer.phase('build_cache_restore'):
+                build_cache.restore(build_cache_key, clone_path)
 
         # Execute buildpack
-        execute_module_script_on_ghost(self._app, module, 'build_pack', 'Buildpack', clone_path,
-                                       self._log_file, self._job, self._config)
+        with timer.phase('buildpack'):
+            execute_module_script_on_ghost(self._app, module, 'build_pack', 'Buildpack', clone_path,
+                                           self._log_file, self._job, self._config)
+
+        if build_cache_key:
+            with timer.phase('build_cache_save'):
+                build_cache.save(build_cache_key, clone_path, get_build_cache_config(module)[0])
 
         # Store postdeploy script in tarball
         if 'post_deploy' in module:
@@ -429,7 +597,6 @@ class Deploy:
             postdeploy_source = b64decode_utf8(module['post_deploy'])
             with io.open(clone_path + '/postdeploy', mode='w', encoding='utf-8') as f:
                 f.write(postdeploy_source)
-            gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
 
         # Store after_all_deploy script in tarball
         if 'after_all_deploy' in module:
@@ -437,7 +604,6 @@ class Deploy:
             afteralldeploy_source = b64decode_utf8(module['after_all_deploy'])
             with io.open(clone_path + '/after_all_deploy', mode='w', encoding='utf-8') as f:
                 f.write(afteralldeploy_source)
-            gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
 
         # Store module metadata in tarball
         log("Create metadata file for inclusion in target package", self._log_file)
@@ -464,41 +630,208 @@ GHOST_MODULE_USER="{user}"
             module_metadata = module_metadata + u''.join([u'export {key}="{val}" \n'.format(key=env_var['var_key'], val=env_var.get('var_value', '')) for env_var in custom_env_vars])
         with io.open(clone_path + '/.ghost-metadata', mode='w', encoding='utf-8') as f:
             f.write(module_metadata)
-        gcall('du -hs .', 'Display current build directory disk usage', self._log_file)
 
-        # Create tar archive
-        pkg_name = self._package_module(module, ts, commit)
+        # Create tar archive, its uncompressed size is the build directory disk usage
+        pkg_name, package_key_path, package_size, content_size, file_count, sidecars = self._package_module(
+            module, ts, commit, timer, build_hash)
+        log("Module '{0}' built: {1} ({2} bytes, {3} files)".format(module['name'], pkg_name, package_size,
+                                                                    file_count), self._log_file)
 
-        before_update_manifest = update_app_manifest(self._app, self._config, module, pkg_name, self._log_file)
+        return {
+            'ts': ts,
+            'clone_path': clone_path,
+            'revision': revision,
+            'commit': commit,
+            'commit_message': commit_message,
+            'package': pkg_name,
+            'package_key_path': package_key_path,
+            'package_size': package_size,
+            'package_content_size': content_size,
+            'package_file_count': file_count,
+            'package_sidecars': sidecars,
+            'build_hash': build_hash,
+            'timer': timer,
+        }
+
+    def _update_manifest(self, modules_builds):
+        """
+        Sets the built packages of the given modules in the app manifest, with a single write
+        """
+        manifest_timer = PhaseTimer()
+        with manifest_timer.phase('manifest_update'):
+            for module, build in modules_builds:
+                self._manifest.set_module_package(module, build['package'], build['package_key_path'])
+            self._manifest.save()
+        for module, build in modules_builds:
+            build['timer'].add('manifest_update', manifest_timer.as_dict()['manifest_update'])
+
+    def _get_push_batches(self, modules):
+        """
+        Splits the modules, in manifest order, in batches pushed with a single stage2 run by instance.
+        A batch ends with each module having an after_all_deploy script, run before the next modules are pushed.
+
+        >>> class worker:
+        ...   app = {}
+        ...   job = None
+        ...   log_file = None
+        ...   _config = None
+        >>> modules = [{'name': 'mod1'}, {'name': 'mod2', 'after_all_deploy': 'ZWNobw=='}, {'name': 'mod3'}]
+        >>> [[mod['name'] for mod in batch] for batch in Deploy(worker=worker())._get_push_batches(modules)]
+        [['mod1', 'mod2'], ['mod3']]
+        """
+        batches = [[]]
+        for module in modules:
+            if batches[-1] and 'after_all_deploy' in batches[-1][-1]:
+                batches.append([])
+            batches[-1].append(module)
+        return batches
+
+    def _push_modules(self, modules, builds, fabric_execution_strategy, safe_deployment_strategy, pending_modules):
+        """
+        Deploys the modules built packages, already set in the app manifest, on instances with a single stage2 run
+        by instance. On failure, the manifest entries of the pending modules (these ones and the ones not pushed yet)
+        are restored
+        Returns the deployment ids by module name
+        """
+        push_timer = PhaseTimer()
         try:
             all_app_modules_list = get_app_module_name_list(self._app['modules'])
             clean_local_module_workspace(get_path_from_app_with_color(self._app), all_app_modules_list, self._log_file)
-            self._deploy_module(module, fabric_execution_strategy, safe_deployment_strategy)
+            self._deploy_module(modules if len(modules) > 1 else modules[0], fabric_execution_strategy,
+                                safe_deployment_strategy, push_timer)
         except GCallException as e:
             log("Deploy error occured, app manifest will be restored to its previous state", self._log_file)
-            rollback_app_manifest(self._app, self._config, before_update_manifest, self._log_file)
+            self._manifest.rollback(pending_modules)
             raise e
 
+        deploy_ids = {}
+        for module in modules:
+            build = builds[module['name']]
+            for phase, seconds in push_timer.as_dict().items():
+                build['timer'].add(phase, seconds)
+            deploy_ids[module['name']] = self._record_module_deployment(module, build)
+        return deploy_ids
+
+    def _record_module_deployment(self, module, build):
+        """
+        Runs the module after_all_deploy script, if any, and records its deployment
+        Returns the deployment id
+        """
+        pkg_name = build['package']
+        timer = build['timer']
         if 'after_all_deploy' in module:
             log("After all deploy script found for '{0}'. Executing it.".format(module['name']), self._log_file)
-            execute_module_script_on_ghost(self._app, module, 'after_all_deploy', 'After all deploy', clone_path,
-                                           self._log_file, self._job, self._config)
-
+            with timer.phase('after_all_deploy'):
+                execute_module_script_on_ghost(self._app, module, 'after_all_deploy', 'After all deploy',
+                                               build['clone_path'], self._log_file, self._job, self._config)
+
+        timings = timer.as_dict()
+        log("Module '{0}' deployment timings (s): {1}".format(
+            module['name'], ', '.join('{0}={1}'.format(phase, seconds) for phase, seconds in sorted(timings.items()))),
+            self._log_file)
         now = datetime.datetime.utcnow()
         deployment = {
             'app_id': self._app['_id'],
             'job_id': self._job['_id'],
             'module': module['name'],
-            'revision': revision,
-            'commit': commit,
-            'commit_message': commit_message,
-            'timestamp': ts,
+            'revision': build['revision'],
+            'commit': build['commit'],
+            'commit_message': build['commit_message'],
+            'timestamp': build['ts'],
             'package': pkg_name,
+            'package_key_path': build['package_key_path'],
+            'package_size': build['package_size'],
+            'package_content_size': build['package_content_size'],
+            'package_file_count': build['package_file_count'],
+            'build_hash': build['build_hash'],
+            'timings': timings,
             'module_path': module['path'],
             '_created': now,
             '_updated': now,
         }
-        return self._worker._db.deploy_histories.insert(deployment)
+        deploy_id = self._worker._db.deploy_histories.insert(deployment)
+        register_package(self._worker._db.packages, self._app, module['name'],
+                         get_buildpack_clone_path_from_module(self._app, module), pkg_name,
+                         build['package_size'], build['package_sidecars'], deploy_id, build['package_key_path'])
+        self._schedule_packages_purge(module)
+        return deploy_id
+
+    def _get_build_concurrency(self):
+        """
+        Returns the number of modules that can be built at the same time
+
+        >>> class worker:
+        ...   app = {'build_infos': {}}
+        ...   job = None
+        ...   log_file = None
+        ...   _config = {}
+        >>> Deploy(worker=worker())._get_build_concurrency()
+        1
+        >>> worker._config = {'deployment_build_concurrency': 4}
+        >>> Deploy(worker=worker())._get_build_concurrency()
+        4
+        >>> worker._config = {'deployment_build_concurrency': 0}
+        >>> Deploy(worker=worker())._get_build_concurrency()
+        1
+        """
+        concurrency = max(int(self._config.get('deployment_build_concurrency', 1) or 1), 1)
+        if concurrency > 1 and self._app['build_infos'].get('container_image') and lxd_is_available(self._config):
+            log("Container builds are enabled for this app, modules will be built one at a time", self._log_file)
+            return 1
+        return concurrency
+
+    def _build_modules(self, modules, concurrency):
+        """
+        Builds the given modules one at a time, or using a pool of concurrent workers
+        Waits for every concurrent build to complete and raises a GCallException listing every build error, if any
+        Returns the build infos by module name
+        """
+        if concurrency == 1 or len(modules) == 1:
+            return dict((module['name'], self._build_module(module)) for module in modules)
+        log("Building {0} module(s) with {1} concurrent worker(s)".format(len(modules), concurrency), self._log_file)
+        pool = ThreadPool(min(concurrency, len(modules)))
+        try:
+            results = [(module, pool.apply_async(self._build_module, (module,))) for module in modules]
+            builds = {}
+            errors = []
+            for module, result in results:
+                try:
+                    builds[module['name']] = result.get()
+                except Exception as e:
+                    log("Build of module '{0}' failed: {1}".format(module['name'], e), self._log_file)
+                    errors.append("{0} ({1})".format(module['name'], e.value if isinstance(e, GCallException) else e))
+        finally:
+            pool.close()
+            pool.join()
+        if errors:
+            raise GCallException("Build failed for module(s): {0}".format(', '.join(errors)))
+        return builds
+
+    def _execute_batched_deploy(self, concurrency, fabric_execution_strategy, safe_deployment_strategy):
+        """
+        Builds all modules, concurrently if enabled, updates the app manifest once, then pushes them on instances
+        in manifest order, batched in single stage2 runs by instance
+        Returns the deployment ids by module name
+        """
+        builds = self._build_modules(self._apps_modules, concurrency)
+
+        deploy_ids = {}
+        manifest_order = get_app_module_name_list(self._app['modules'])
+        modules = sorted(self._apps_modules, key=lambda mod: manifest_order.index(mod['name']))
+        self._update_manifest([(module, builds[module['name']]) for module in modules])
+        pushed = 0
+        for batch in self._get_push_batches(modules):
+            batch_deploy_ids = self._push_modules(batch, builds, fabric_execution_strategy, safe_deployment_strategy,
+                                                  [mod['name'] for mod in modules[pushed:]])
+            pushed += len(batch)
+            for module in batch:
+                deploy_ids[module['name']] = batch_deploy_ids[module['name']]
+                self._update_deployed_module(module, batch_deploy_ids[module['name']])
+        return deploy_ids
+
+    def _update_deployed_module(self, module, deploy_id):
+        self._worker._db.jobs.update({ '_id': self._job['_id'], 'modules.name': module['name']}, {'$set': { 'modules.$.deploy_id': deploy_id }})
+        self._worker._db.apps.update({ '_id': self._app['_id'], 'modules.name': module['name']}, {'$set': { 'modules.$.initialized': True }})
 
     def execute(self):
         fabric_execution_strategy = self._job['options'][0] if 'options' in self._job and len(self._job['options']) > 0 else None
@@ -518,14 +851,22 @@ GHOST_MODULE_USER="{user}"
                 module_list.append(module['name'])
         split_comma = ', '
         module_list = split_comma.join(module_list)
-        try:
-            deploy_ids = {}
-            for module in self._apps_modules:
-                deploy_id = self._execute_deploy(module, fabric_execution_strategy, safe_deployment_strategy)
-                deploy_ids[module['name']] = deploy_id
-                self._worker._db.jobs.update({ '_id': self._job['_id'], 'modules.name': module['name']}, {'$set': { 'modules.$.deploy_id': deploy_id }})
-                self._worker._db.apps.update({ '_id': self._app['_id'], 'modules.name': module['name']}, {'$set': { 'modules.$.initialized': True }})
-
-            self._worker.update_status("done", message=self._get_notification_message_done(deploy_ids))
-        except GCallException as e:
-            self._worker.update_status("failed", message=self._get_notification_message_failed(module_list, e))
+        # Workspaces used by this job are locked so that the disk manager never removes them
+        with WorkspaceLocks([get_buildpack_clone_path_from_module(self._app, module) for module in self._apps_modules],
+                            self._log_file):
+            try:
+                self._manifest = get_app_manifest(self._app, self._config, self._log_file,
+                                                  self._worker._db.manifest_histories, self._job)
+                deploy_ids = self._execute_batched_deploy(self._get_build_concurrency(), fabric_execution_strategy,
+                                                          safe_deployment_strategy)
+
+                self._worker.update_status("done", message=self._get_notification_message_done(deploy_ids))
+            except GCallException as e:
+                self._worker.update_status("failed", message=self._get_notification_message_failed(module_list, e))
+            finally:
+                self._wait_for_packages_purges()
+                try:
+                    manage_disk_stores(self._config, self._worker._db.disk_usage, self._log_file,
+                                       get_disk_stores(['workspaces']))
+                except (GCallException, OSError) as e:
+                    log("Workspaces quota enforcement failed: {0}".format(e), self._log_file)
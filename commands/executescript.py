@@ -106,7 +106,9 @@ class Executescript():
                                                    'sudoer_uid': sudoer_uid,
                                                    'jobid': self._job['_id'],
                                                    'env_vars': ghost_env_vars,
-                                               })
+                                               }, hosts_results_recorder=lambda results: (
+                                                   self._worker.record_hosts_results(results, module_name or None)),
+                                               ssh_pool=self._worker.ssh_pool)
         deploy_manager.deployment(safe_deployment_strategy)
 
     def _exec_script_single_host(self, script, module_name, single_host_ip):
@@ -123,7 +125,9 @@ class Executescript():
             raise GCallException("Cannot execute script on this instance ({ip} - {id}), invalid Ghost tags".format(ip=single_host_ip, id=ec2_obj.id))
 
         log("EC2 instance found, ready to execute script ({ip} - {id} - {name})".format(ip=single_host_ip, id=ec2_obj.id, name=ec2_obj.tags.get('Name', '')), self._log_file)
-        launch_executescript(self._app, script, context_path, sudoer_uid, self._job['_id'], [single_host_ip], 'serial', self._log_file, ghost_env_vars)
+        launch_executescript(self._app, script, context_path, sudoer_uid, self._job['_id'], [single_host_ip], 'serial', self._log_file, ghost_env_vars,
+                             lambda results: self._worker.record_hosts_results(results, module_name or None),
+                             self._worker.ssh_pool)
 
     def execute(self):
         if not boolify(self._config.get('enable_executescript_command', True)):
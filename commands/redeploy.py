@@ -1,3 +1,5 @@
+from multiprocessing.pool import ThreadPool
+
 from bson.objectid import ObjectId
 
 from ghost_tools import GCallException, gcall, get_app_module_name_list, clean_local_module_workspace
@@ -6,7 +8,10 @@ from settings import cloud_connections, DEFAULT_PROVIDER
 from ghost_log import log
 from libs.host_deployment_manager import HostDeploymentManager
 from libs.deploy import execute_module_script_on_ghost
-from libs.deploy import get_path_from_app_with_color, get_buildpack_clone_path_from_module, update_app_manifest, rollback_app_manifest
+from libs.deploy import get_path_from_app_with_color, get_buildpack_clone_path_from_module, get_app_manifest
+from libs.package_catalog import set_referenced_package
+from libs.packaging import get_package_extract_command
+from libs.workspaces import get_workspace_mode
 
 COMMAND_DESCRIPTION = "Re-deploy an old module package"
 RELATED_APP_FIELDS = []
@@ -54,22 +59,24 @@ class Redeploy():
             module = {}
             module['path'] = deploy_infos['module_path']
             module['name'] = deploy_infos['module']
-            return module, deploy_infos['package']
-        return None, None
+            # Ghost-side scripts come from the current module definition
+            app_modules = self._find_modules_by_name([module])
+            if app_modules and 'after_all_deploy' in app_modules[0]:
+                module['after_all_deploy'] = app_modules[0]['after_all_deploy']
+            return module, deploy_infos['package'], deploy_infos.get('package_key_path')
+        return None, None, None
 
     def _deploy_module(self, module, fabric_execution_strategy, safe_deployment_strategy):
         deploy_manager = HostDeploymentManager(self._cloud_connection, self._app, module, self._log_file,
-                                               self._app.get('safe-deployment', {}), fabric_execution_strategy)
+                                               self._app.get('safe-deployment', {}), fabric_execution_strategy,
+                                               hosts_results_recorder=lambda results: (
+                                                   self._worker.record_hosts_results(results, module['name'])),
+                                               ssh_pool=self._worker.ssh_pool,
+                                               host_deploy_results=self._worker.host_deploy_results)
         deploy_manager.deployment(safe_deployment_strategy)
 
-    def _local_extract_package(self, module, package):
-        clone_path = get_buildpack_clone_path_from_module(self._app, module)
-        gcall('rm -rf "%s"' % clone_path, 'Cleaning old temporary redeploy module working directory "%s"' % clone_path, self._log_file)
-        gcall('mkdir -p "%s"' % clone_path, 'Recreating redeploy module working directory "%s"' % clone_path, self._log_file)
-
-        key_path = '{path}/{module}/{pkg_name}'.format(path=get_path_from_app_with_color(self._app), module=module['name'], pkg_name=package)
-        log("Downloading package: {0} from '{1}'".format(package, key_path), self._log_file)
-        dest_package_path = "{0}/{1}".format(clone_path, package)
+    def _get_package_key(self, module, package, package_key_path=None):
+        key_path = package_key_path or '{path}/{module}/{pkg_name}'.format(path=get_path_from_app_with_color(self._app), module=module['name'], pkg_name=package)
         # No assume role, local S3 access
         local_cloud_connection = cloud_connections.get(self._app.get('provider', DEFAULT_PROVIDER))(self._config)
         conn = local_cloud_connection.get_connection(self._config.get('bucket_region', self._app['region']), ["s3"])
@@ -77,31 +84,68 @@ class Redeploy():
         key = bucket.get_key(key_path)
         if not key:
             raise GCallException("Package '{0}' doesn't exist on bucket '{1}'".format(key_path, self._config['bucket_s3']))
+        return key
+
+    def _local_extract_package(self, module, package, package_key_path=None):
+        clone_path = get_buildpack_clone_path_from_module(self._app, module)
+        app_modules = self._find_modules_by_name([module])
+        if app_modules and get_workspace_mode(app_modules[0]) == 'persistent':
+            # Keep the build workspace of the module for its next deployment
+            clone_path = '{0}/.redeploy-{1}'.format(get_path_from_app_with_color(self._app), module['name'])
+        gcall('rm -rf "%s"' % clone_path, 'Cleaning old temporary redeploy module working directory "%s"' % clone_path, self._log_file)
+        gcall('mkdir -p "%s"' % clone_path, 'Recreating redeploy module working directory "%s"' % clone_path, self._log_file)
+
+        key = self._get_package_key(module, package, package_key_path)
+        log("Downloading package: {0} from '{1}'".format(package, key.name), self._log_file)
+        dest_package_path = "{0}/{1}".format(clone_path, package)
         key.get_contents_to_filename(dest_package_path)
 
-        gcall('tar -xf "{0}" -C "{1}"'.format(dest_package_path, clone_path), "Extracting package: %s" % package, self._log_file)
+        gcall(get_package_extract_command(dest_package_path, clone_path), "Extracting package: %s" % package, self._log_file)
         return clone_path
 
     def _execute_redeploy(self, deploy_id, fabric_execution_strategy, safe_deployment_strategy):
-        module, package = self._get_deploy_infos(deploy_id)
+        module, package, package_key_path = self._get_deploy_infos(deploy_id)
         if module and package:
-            before_update_manifest = update_app_manifest(self._app, self._config, module, package, self._log_file)
             all_app_modules_list = get_app_module_name_list(self._app['modules'])
             clean_local_module_workspace(get_path_from_app_with_color(self._app), all_app_modules_list, self._log_file)
-            # Download and extract package before launching deploy
-            clone_path = self._local_extract_package(module, package)
 
+            # A missing or broken package fails the redeploy before the app manifest and the instances are updated.
+            # The package content is only needed by the after all deploy script, run on Ghost once instances
+            # are updated: it is downloaded and extracted while the app manifest is loaded
+            extraction_pool = None
+            extraction = None
+            if 'after_all_deploy' in module:
+                extraction_pool = ThreadPool(1)
+                extraction = extraction_pool.apply_async(self._local_extract_package, (module, package, package_key_path))
+            else:
+                self._get_package_key(module, package, package_key_path)
+                log("No after all deploy script for module '{0}', package extraction skipped".format(module['name']),
+                    self._log_file)
+            try:
+                manifest = get_app_manifest(self._app, self._config, self._log_file, self._db.manifest_histories,
+                                            self._job)
+                clone_path = extraction.get() if extraction else None
+            finally:
+                if extraction_pool:
+                    extraction_pool.close()
+                    extraction_pool.join()
+
+            manifest.set_module_package(module, package, package_key_path)
+            manifest.save()
             try:
                 # Re-deploy
                 self._deploy_module(module, fabric_execution_strategy, safe_deployment_strategy)
             except GCallException as e:
                 log("Redeploy error occured, app manifest will be restored to its previous state", self._log_file)
-                rollback_app_manifest(self._app, self._config, before_update_manifest, self._log_file)
+                manifest.rollback([module['name']])
                 raise e
+            set_referenced_package(self._db.packages, get_buildpack_clone_path_from_module(self._app, module),
+                                   module['name'], package)
 
-            # After all deploy exec
-            execute_module_script_on_ghost(self._app, module, 'after_all_deploy', 'After all deploy',
-                                           clone_path, self._log_file, self._job, self._config)
+            if clone_path:
+                log("After all deploy script found for '{0}'. Executing it.".format(module['name']), self._log_file)
+                execute_module_script_on_ghost(self._app, module, 'after_all_deploy', 'After all deploy',
+                                               clone_path, self._log_file, self._job, self._config)
         else:
             raise GCallException("Redeploy on deployment ID: {0} failed".format(deploy_id))
 
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import os
 import yaml
 
@@ -6,6 +7,8 @@ from StringIO import StringIO
 from fabric.api import show, sudo, task, env, put, settings, output
 from fabric.context_managers import shell_env
 
+from ghost_log import log
+
 with open(os.path.dirname(os.path.realpath(__file__)) + '/config.yml', 'r') as conf_file:
     config = yaml.load(conf_file)
 
@@ -22,16 +25,63 @@ env.colorize_errors = True
 output.debug = True
 
 STAGE2_PATH = '/var/lib/ghost/stage2_deploy'
+STAGE2_DETACHED_LOG_DIR = '/var/log/ghost'
+
+
+def _upload_stage2(stage2, log_file):
+    """
+    Uploads stage2, unless the host already has the same content
+    """
+    if isinstance(stage2, unicode):
+        stage2 = stage2.encode('utf-8')
+    stage2_hash = hashlib.sha256(stage2).hexdigest()
+    res = sudo('mkdir -p "{w}" && chmod 755 "{w}" && test -x {s} && '
+               'test "$(sha256sum {s} | cut -d" " -f1)" = "{h}"'.format(w=os.path.dirname(STAGE2_PATH),
+                                                                        s=STAGE2_PATH, h=stage2_hash),
+               stdout=log_file)
+    if res.succeeded:
+        log('stage2 is up to date on the host ({h}), skipping its upload'.format(h=stage2_hash), log_file)
+        return
+    put(StringIO(stage2), STAGE2_PATH, use_sudo=True, mode=0755)
+
+
+def _run_stage2(module_names, stage2, notification_endpoint, log_file):
+    _upload_stage2(stage2, log_file)
+    res = sudo('NOTIFICATION_ENDPOINT={b} {s} {n}'.format(b=notification_endpoint, s=STAGE2_PATH,
+                                                          n=' '.join(module_names)),
+               stdout=log_file)
+    return res.return_code
 
 
 @task
 def deploy(app_module, ssh_username, key_filename, stage2, notification_endpoint, log_file):
     with settings(show('debug'), warn_only=True, user=ssh_username, key_filename=key_filename):
-        sudo('rm -rvf {s}'.format(s=STAGE2_PATH), stdout=log_file)
-        sudo('mkdir -p "{w}" && chmod 755 "{w}"'.format(w=os.path.dirname(STAGE2_PATH)), stdout=log_file)
-        put(StringIO(stage2), STAGE2_PATH, use_sudo=True, mode=0755)
-        res = sudo('NOTIFICATION_ENDPOINT={b} {s} {n}'.format(b=notification_endpoint, s=STAGE2_PATH, n=app_module['name']),
-                   stdout=log_file)
+        return _run_stage2([app_module['name']], stage2, notification_endpoint, log_file)
+
+
+@task
+def deploy_modules(module_names, ssh_username, key_filename, stage2, notification_endpoint, log_file):
+    """
+    Deploys the modules, in order, with a single stage2 run
+    """
+    with settings(show('debug'), warn_only=True, user=ssh_username, key_filename=key_filename):
+        return _run_stage2(module_names, stage2, notification_endpoint, log_file)
+
+
+@task
+def deploy_modules_detached(module_names, ssh_username, key_filename, stage2, notification_endpoint, results_endpoint,
+                            log_file):
+    """
+    Starts the deployment of the modules in a stage2 run detached from the SSH session, which sends its results to
+    the results endpoint
+    """
+    with settings(show('debug'), warn_only=True, user=ssh_username, key_filename=key_filename):
+        _upload_stage2(stage2, log_file)
+        res = sudo("mkdir -p {l} && NOTIFICATION_ENDPOINT={b} GHOST_RESULTS_ENDPOINT='{r}' "
+                   "nohup setsid {s} {n} > {l}/stage2_detached.log 2>&1 < /dev/null &".format(
+                       l=STAGE2_DETACHED_LOG_DIR, b=notification_endpoint, r=results_endpoint, s=STAGE2_PATH,
+                       n=' '.join(module_names)),
+                   stdout=log_file, pty=False)
         return res.return_code
 
 
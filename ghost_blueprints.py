@@ -3,21 +3,24 @@ import pkgutil
 import os
 
 from eve.auth import requires_auth
-from flask import abort, jsonify, send_from_directory
+from flask import abort, current_app, jsonify, request, send_from_directory
 from flask import Blueprint
 
 from hashlib import sha512
 from ghost_aws import download_file_from_s3
-from ghost_data import get_app, get_job
+from ghost_data import db, get_app, get_job
 from ghost_tools import config, get_job_log_remote_path, CURRENT_REVISION
 
 from command import LOG_ROOT
+from libs.host_deploy_results import HostDeployResultError, check_host_deploy_results_token
+from libs.host_deploy_results import parse_host_deploy_result, record_host_deploy_result
 from settings import cloud_connections, DEFAULT_PROVIDER
 
 commands_blueprint = Blueprint('commands_blueprint', 'commands')
 version_blueprint = Blueprint('version_blueprint', 'version')
 job_logs_blueprint = Blueprint('job_logs_blueprint', 'job_logs')
 websocket_token_blueprint = Blueprint('websocket_token_blueprint', 'websocket_token')
+host_deploy_results_blueprint = Blueprint('host_deploy_results_blueprint', 'host_deploy_results')
 
 
 def _get_commands(app_context=None):
@@ -123,4 +126,24 @@ def websocket_token(job_id=None):
 def get_websocket_token(job_id):
     return sha512(websocket_token.hash_seed + job_id).hexdigest()
 
-websocket_token.hash_seed = "%032x" % random.getrandbits(2048)
\ No newline at end of file
+websocket_token.hash_seed = "%032x" % random.getrandbits(2048)
+
+
+@host_deploy_results_blueprint.route(
+    '/jobs/<regex("[a-f0-9]{24}"):job_id>/host_deploy_results/<regex("[a-f0-9]{32}"):run_id>', methods=['POST'])
+def host_deploy_result(job_id=None, run_id=None):
+    """
+    Receives the notify_status payloads of the stage2 runs of a job, authenticated by the job token as instances
+    have no Ghost credentials
+    """
+    if not check_host_deploy_results_token(config.get('host_deploy_results_secret'), job_id,
+                                           request.args.get('token')):
+        abort(401, description='Invalid token.')
+    if get_job(job_id) is None:
+        abort(404, description='Specified job_id doesn\'t exist.')
+    try:
+        result = parse_host_deploy_result(request.get_json(force=True, silent=True))
+    except HostDeployResultError as e:
+        abort(400, description=str(e))
+    record_host_deploy_result(db.host_deploy_results, current_app.ghost_redis_connection, job_id, run_id, result)
+    return jsonify({'_status': 'OK'})
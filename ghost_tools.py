@@ -104,7 +104,30 @@ def render_stage2(config, s3_region):
         loader = FileSystemLoader(jinja_templates_path)
         jinja_env = Environment(loader=loader)
         template = jinja_env.get_template('stage2')
-        return template.render(bucket_s3=bucket_s3, max_deploy_history=max_deploy_history, bucket_region=s3_region)
+        return template.render(bucket_s3=bucket_s3, max_deploy_history=max_deploy_history, bucket_region=s3_region,
+                               deployment_agent=boolify(config.get('deployment_agent', False)))
+    return None
+
+
+def render_deployment_agent(config, s3_region):
+    """
+    Renders the deployment agent script, installed on instances by stage2 when 'deployment_agent' is enabled
+
+    >>> config = {'bucket_s3': 'my-s3-bucket', 'ghost_root_path': '.', 'deployment_agent_poll_interval': 5}
+    >>> agent = render_deployment_agent(config, 'eu-west-1')
+    >>> agent[agent.find('POLL_INTERVAL'):agent.find('\\n', agent.find('POLL_INTERVAL')+1)]
+    u'POLL_INTERVAL=5'
+    >>> agent[agent.find('HEARTBEAT_INTERVAL'):agent.find('\\n', agent.find('HEARTBEAT_INTERVAL')+1)]
+    u'HEARTBEAT_INTERVAL=300'
+    """
+    jinja_templates_path = '%s/scripts' % config['ghost_root_path']
+    if (os.path.exists('%s/ghost-agent' % jinja_templates_path)):
+        loader = FileSystemLoader(jinja_templates_path)
+        jinja_env = Environment(loader=loader)
+        template = jinja_env.get_template('ghost-agent')
+        return template.render(bucket_s3=config['bucket_s3'], bucket_region=s3_region,
+                               poll_interval=config.get('deployment_agent_poll_interval', 10),
+                               heartbeat_interval=config.get('deployment_agent_heartbeat_interval', 300))
     return None
 
 
@@ -122,6 +145,11 @@ def refresh_stage2(cloud_connection, region, config):
         key.close()
     else:
         bucket.delete_key("/ghost/stage2")
+    agent = render_deployment_agent(config, region) if boolify(config.get('deployment_agent', False)) else None
+    if agent is not None:
+        key = bucket.new_key("/ghost/agent")
+        key.set_contents_from_string(agent)
+        key.close()
 
 
 class GCallException(Exception):
@@ -132,11 +160,11 @@ class GCallException(Exception):
         return repr(self.value)
 
 
-def gcall(args, cmd_description, log_fd, dry_run=False, env=None):
+def gcall(args, cmd_description, log_fd, dry_run=False, env=None, cwd=None):
     log(cmd_description, log_fd)
     log("CMD: {0}".format(args), log_fd)
     if not dry_run:
-        ret = call(args, stdout=log_fd, stderr=log_fd, shell=True, env=env)
+        ret = call(args, stdout=log_fd, stderr=log_fd, shell=True, env=env, cwd=cwd)
         if (ret != 0):
             raise GCallException("ERROR: %s" % cmd_description)
 
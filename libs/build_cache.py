@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Library to cache the dependencies installed by modules buildpacks (vendor/, node_modules/...)
+    Caches are keyed on the app module and the content of its lock files, stored locally with an LRU eviction
+    and optionally shared between Ghost instances through the S3 bucket.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+from ghost_log import log
+from ghost_tools import boolify, gcall
+
+BUILD_CACHE_ROOT = '/ghost/.cache/build'
+BUILD_CACHE_S3_PREFIX = 'ghost-build-cache'
+BUILD_CACHE_EXTENSION = '.tar.gz'
+
+DEFAULT_BUILD_CACHE_MAX_SIZE = 10240
+
+
+def _is_relative_path(path):
+    """
+    >>> _is_relative_path('vendor/')
+    True
+    >>> _is_relative_path('/etc')
+    False
+    >>> _is_relative_path('../other_module')
+    False
+    >>> _is_relative_path('web/../../other_module')
+    False
+    """
+    normalized = os.path.normpath(path)
+    return not os.path.isabs(normalized) and normalized != '..' and not normalized.startswith('../')
+
+
+def get_build_cache_config(module):
+    """
+    Returns the cached paths and key files declared by the module, with paths escaping the module ignored
+
+    >>> get_build_cache_config({'name': 'mod1'})
+    ([], [])
+    >>> get_build_cache_config({'build_cache': {'paths': ['vendor/', 'node_modules', '/etc'],
+    ...                                         'key_files': ['package-lock.json', 'composer.lock']}})
+    (['node_modules', 'vendor'], ['composer.lock', 'package-lock.json'])
+    """
+    build_cache = module.get('build_cache') or {}
+    paths = sorted(set(os.path.normpath(path) for path in build_cache.get('paths', []) if _is_relative_path(path)))
+    key_files = sorted(set(os.path.normpath(path) for path in build_cache.get('key_files', [])
+                           if _is_relative_path(path)))
+    return paths, key_files
+
+
+def get_build_cache_key(app, module, clone_path, container_image=None):
+    """
+    Returns the cache key of the module dependencies, built from the app id, the module name and path
+    and the content of its key files, None if the module has no build cache or none of its key files exists.
+    The cache is saved after the buildpack has run, so it is never shared with another app or module.
+
+    >>> import shutil
+    >>> clone_path = tempfile.mkdtemp()
+    >>> app = {'_id': '5a0d3e08a2b9c2b5a1234567'}
+    >>> module = {'name': 'mod1', 'path': '/var/www', 'build_cache': {'paths': ['vendor'], 'key_files': ['composer.lock']}}
+    >>> get_build_cache_key(app, module, clone_path) is None
+    True
+    >>> open(clone_path + '/composer.lock', 'w').write('{"packages": []}')
+    >>> key = get_build_cache_key(app, module, clone_path)
+    >>> len(key)
+    64
+    >>> key == get_build_cache_key(app, module, clone_path)
+    True
+    >>> key == get_build_cache_key(app, module, clone_path, container_image='debian-9-php7')
+    False
+    >>> key == get_build_cache_key({'_id': '5a0d3e08a2b9c2b5a7654321'}, module, clone_path)
+    False
+    >>> key == get_build_cache_key(app, dict(module, name='mod2'), clone_path)
+    False
+    >>> key == get_build_cache_key(app, dict(module, path='/var/www/other'), clone_path)
+    False
+    >>> open(clone_path + '/composer.lock', 'w').write('{"packages": ["symfony/symfony"]}')
+    >>> key == get_build_cache_key(app, module, clone_path)
+    False
+    >>> shutil.rmtree(clone_path)
+    """
+    paths, key_files = get_build_cache_config(module)
+    if not paths:
+        return None
+    files = {}
+    for key_file in key_files:
+        key_file_path = os.path.join(clone_path, key_file)
+        if os.path.isfile(key_file_path):
+            with open(key_file_path, 'rb') as f:
+                files[key_file] = hashlib.sha256(f.read()).hexdigest()
+    if not files:
+        return None
+    inputs = {
+        'app_id': str(app.get('_id')),
+        'module': module.get('name'),
+        'module_path': module.get('path'),
+        'paths': paths,
+        'key_files': files,
+        'container_image': container_image,
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+
+class BuildCache(object):
+    """
+    Dependencies caches stored as tarballs in a local directory, evicted in least recently used order
+    when they exceed the configured size, and optionally in the S3 bucket given as a boto bucket.
+    """
+
+    def __init__(self, config, log_file, bucket=None, root=BUILD_CACHE_ROOT):
+        self._log_file = log_file
+        self._root = root
+        self._max_size = int(float(config.get('build_cache_max_size', DEFAULT_BUILD_CACHE_MAX_SIZE)) * 1024 * 1024)
+        self._bucket = bucket if boolify(config.get('build_cache_s3', False)) else None
+
+    def _get_local_path(self, key):
+        return os.path.join(self._root, key + BUILD_CACHE_EXTENSION)
+
+    def _get_s3_key_path(self, key):
+        return '{0}/{1}{2}'.format(BUILD_CACHE_S3_PREFIX, key, BUILD_CACHE_EXTENSION)
+
+    def _download(self, key, local_path):
+        s3_key = self._bucket.get_key(self._get_s3_key_path(key))
+        if not s3_key:
+            return False
+        fd, tmp_path = tempfile.mkstemp(dir=self._root, prefix='.download-')
+        os.close(fd)
+        try:
+            s3_key.get_contents_to_filename(tmp_path)
+            os.rename(tmp_path, local_path)
+        except:
+            os.remove(tmp_path)
+            raise
+        log("Build cache: {0} downloaded from S3".format(key), self._log_file)
+        return True
+
+    def restore(self, key, clone_path):
+        """
+        Extracts the cached dependencies into the module working directory
+        Returns True on cache hit
+        """
+        local_path = self._get_local_path(key)
+        if not os.path.isdir(self._root):
+            os.makedirs(self._root)
+        try:
+            if not os.path.exists(local_path) and not (self._bucket and self._download(key, local_path)):
+                log("Build cache: no cache found for key {0}".format(key), self._log_file)
+                return False
+            # Mark as recently used
+            os.utime(local_path, None)
+            gcall('tar -xzf "{0}" -C "{1}"'.format(local_path, clone_path),
+                  'Build cache: restoring dependencies from cache {0}'.format(key), self._log_file)
+        except Exception as e:
+            # A broken cache must not fail the build, the buildpack installs the dependencies anyway
+            log("Build cache: unable to restore cache {0}: {1}".format(key, e), self._log_file)
+            return False
+        return True
+
+    def save(self, key, clone_path, paths):
+        """
+        Stores the given paths of the module working directory in the cache, if not already cached
+        """
+        local_path = self._get_local_path(key)
+        if os.path.exists(local_path):
+            log("Build cache: cache {0} is up to date".format(key), self._log_file)
+            return
+        existing_paths = [path for path in paths if os.path.exists(os.path.join(clone_path, path))]
+        if not existing_paths:
+            log("Build cache: none of the cached paths exists after the build, nothing to save", self._log_file)
+            return
+        if not os.path.isdir(self._root):
+            os.makedirs(self._root)
+        fd, tmp_path = tempfile.mkstemp(dir=self._root, prefix='.save-')
+        os.close(fd)
+        try:
+            gcall('tar -czf "{0}" {1}'.format(tmp_path, ' '.join('"{0}"'.format(path) for path in existing_paths)),
+                  'Build cache: saving {0} in cache {1}'.format(', '.join(existing_paths), key), self._log_file,
+                  cwd=clone_path)
+            os.rename(tmp_path, local_path)
+            if self._bucket:
+                s3_key_path = self._get_s3_key_path(key)
+                if not self._bucket.get_key(s3_key_path):
+                    self._bucket.new_key(s3_key_path).set_contents_from_filename(local_path)
+                    log("Build cache: {0} uploaded to S3".format(key), self._log_file)
+        except Exception as e:
+            log("Build cache: unable to save cache {0}: {1}".format(key, e), self._log_file)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used caches until the local caches fit in the configured size
+        """
+        caches = []
+        for name in os.listdir(self._root):
+            path = os.path.join(self._root, name)
+            if name.endswith(BUILD_CACHE_EXTENSION) and not name.startswith('.'):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                caches.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum(size for mtime, size, path in caches)
+        for mtime, size, path in sorted(caches):
+            if total_size <= self._max_size:
+                break
+            try:
+                os.remove(path)
+                log("Build cache: evicted {0}".format(os.path.basename(path)), self._log_file)
+            except OSError:
+                pass
+            total_size -= size
@@ -3,20 +3,22 @@
 """
 # -*- coding: utf-8 -*-
 
+import hashlib
 import io
+import json
 import os.path
-from copy import copy
-import re
-import sys
 import os
 import tempfile
+from collections import OrderedDict
 from libs.builders.image_builder_lxd import LXDImageBuilder
+from libs.deploy_agent import DEFAULT_DEPLOYMENT_AGENT_ACK_TIMEOUT, DEFAULT_DEPLOYMENT_AGENT_TIMEOUT
+from libs.deploy_agent import get_agent_heartbeat_max_age, get_agent_hosts, publish_agent_release, wait_agent_reports
 from libs.lxd import lxd_is_available
-from fabric.api import execute as fab_execute
-from fabfile import deploy, executescript
+from libs.manifest import AppManifest
+from libs.ssh_executor import HOST_STATUS_SUCCESS, get_failed_hosts, get_ssh_executor
 from ghost_tools import config
 from ghost_tools import render_stage2, get_app_module_name_list
-from ghost_tools import b64decode_utf8, get_ghost_env_variables
+from ghost_tools import b64decode_utf8, boolify, get_ghost_env_variables
 from ghost_log import log
 from ghost_tools import GCallException, gcall
 from settings import cloud_connections, DEFAULT_PROVIDER
@@ -55,11 +57,10 @@ def execute_module_script_on_ghost(app, module, script_name, script_friendly_nam
             if not container.deploy(script_path, module, source_module):
                 raise GCallException("ERROR: %s execution on container failed" % script_name)
         else:
-            log("Change directory to working dir ({w})".format(w=clone_path), log_file)
-            os.chdir(clone_path)
-            gcall('bash %s' % script_path, '%s: Execute' % script_friendly_name, log_file, env=script_env)
-        
-        gcall('du -hs .', 'Display current build directory disk usage', log_file)
+            log("Using working dir ({w})".format(w=clone_path), log_file)
+            gcall('bash %s' % script_path, '%s: Execute' % script_friendly_name, log_file, env=script_env,
+                  cwd=clone_path)
+
         gcall('rm -vf %s' % script_path, '%s: Done, cleaning temporary file' % script_friendly_name, log_file)
 
 
@@ -104,17 +105,6 @@ def get_buildpack_clone_path_from_module(app, module):
     return "{app_path}/{module}".format(app_path=get_path_from_app_with_color(app), module=module['name'])
 
 
-def get_intermediate_clone_path_from_module(app, module):
-    """
-    >>> app = {'name': 'AppName', 'env': 'prod', 'role': 'webfront'}
-    >>> module = {'name': 'mod1', 'git_repo': 'git@github.com:claranet/ghost.git'}
-    >>> get_intermediate_clone_path_from_module(app, module)
-    '/ghost/.tmp/AppName/prod/webfront/mod1'
-    """
-    clone_path = get_buildpack_clone_path_from_module(app, module)
-    return '{}/.tmp{}'.format(clone_path[:6], clone_path[6:])
-
-
 def _get_app_manifest_from_s3(app, config, log_file):
     key_path = get_path_from_app_with_color(app) + '/MANIFEST'
     cloud_connection = cloud_connections.get(app.get('provider', DEFAULT_PROVIDER))(config)
@@ -139,69 +129,72 @@ def touch_app_manifest(app, config, log_file):
         key.close()
 
 
-def rollback_app_manifest(app, config, old_manifest, log_file):
+def get_app_manifest(app, config, log_file, history=None, job=None):
     """
-    Restores app manifest data to its previous state
+    Returns the app manifest model, loaded from S3
+    Written versions are recorded in the given history collection
     """
     key, key_path, bucket = _get_app_manifest_from_s3(app, config, log_file)
-
-    if old_manifest:
-        key.set_contents_from_string(old_manifest)
-    key.close()
+    history_infos = {'app_id': app['_id'], 'job_id': job['_id'] if job else None}
+    manifest = AppManifest(bucket, key_path, get_app_module_name_list(app['modules']), log_file,
+                           legacy_key_path=(get_path_from_app(app) + '/MANIFEST')[1:],
+                           history=history, history_infos=history_infos)
+    return manifest.load()
 
 
-def update_app_manifest(app, config, module, package, log_file):
+def get_module_build_hash(app, module, source_url, source_version, config):
     """
-    Update the app manifest into S3
-    and Returns the manifest before update (used in case of rollback)
+    Computes a hash of every input that ends up in a module package:
+    the app identity (name, env, role and color) and module path given to the build scripts,
+    the module sources version, its scripts, its files ownership, the app custom env vars
+    and the packaging options and rules.
+
+    >>> app = {'name': 'AppName', 'env': 'prod', 'role': 'webfront', 'blue_green': {'color': 'blue'},
+    ...        'env_vars': [{'var_key': 'ENV', 'var_value': 'prod'}]}
+    >>> module = {'name': 'mod1', 'path': '/var/www', 'build_pack': 'ZWNobyBidWlsZA==', 'uid': 0, 'gid': 0}
+    >>> build_hash = get_module_build_hash(app, module, 'git@github.com:claranet/ghost.git', 'd41d8cd9', {})
+    >>> len(build_hash)
+    64
+    >>> build_hash == get_module_build_hash(app, dict(module), 'git@github.com:claranet/ghost.git', 'd41d8cd9', {})
+    True
+
+    Any change to the inputs changes the hash:
+
+    >>> build_hash == get_module_build_hash(app, module, 'git@github.com:claranet/ghost.git', 'a5c3d1f2', {})
+    False
+    >>> build_hash == get_module_build_hash(app, dict(module, post_deploy='ZWNobw=='), 'git@github.com:claranet/ghost.git', 'd41d8cd9', {})
+    False
+    >>> build_hash == get_module_build_hash(dict(app, env_vars=[]), module, 'git@github.com:claranet/ghost.git', 'd41d8cd9', {})
+    False
+    >>> build_hash == get_module_build_hash(dict(app, name='OtherApp'), module, 'git@github.com:claranet/ghost.git', 'd41d8cd9', {})
+    False
+    >>> build_hash == get_module_build_hash(dict(app, blue_green={'color': 'green'}), module, 'git@github.com:claranet/ghost.git', 'd41d8cd9', {})
+    False
+    >>> build_hash == get_module_build_hash(app, dict(module, path='/var/www/other'), 'git@github.com:claranet/ghost.git', 'd41d8cd9', {})
+    False
+    >>> build_hash == get_module_build_hash(app, module, 'git@github.com:claranet/ghost.git', 'd41d8cd9', {'deployment_package_exclude_git_metadata': True})
+    False
+    >>> build_hash == get_module_build_hash(app, dict(module, packaging={'exclude': ['tests/']}), 'git@github.com:claranet/ghost.git', 'd41d8cd9', {})
+    False
     """
-    key, key_path, bucket = _get_app_manifest_from_s3(app, config, log_file)
-
-    modules = []
-    module_exist = False
-    all_app_modules_list = get_app_module_name_list(app['modules'])
-    data = ""
-    old_manifest = None
-    if not key:  # if the 'colored' MANIFEST doesn't' exist, maybe the legacy one exists and we should clone it
-        legacy_key_path = get_path_from_app(app) + '/MANIFEST'
-        legacy_key = bucket.get_key(legacy_key_path[1:])
-        if legacy_key:
-            key = legacy_key.copy(bucket, key_path)
-    if key:
-        old_manifest = key.get_contents_as_string()
-        if sys.version > '3':
-            old_manifest = old_manifest.decode('utf-8')
-        for line in old_manifest.split('\n'):
-            if line:
-                mod = {}
-                tmp = line.split(':')
-                mod['name'] = tmp[0]
-                if mod['name'] == module['name']:
-                    mod['package'] = package
-                    mod['path'] = module['path']
-                    module_exist = True
-                else:
-                    mod['package'] = tmp[1]
-                    mod['path'] = tmp[2]
-                # Only keep modules that have not been removed from the app
-                if mod['name'] in all_app_modules_list:
-                    mod['index'] = all_app_modules_list.index(mod['name'])
-                    modules.append(mod)
-    if not key:
-        key = bucket.new_key(key_path)
-    if not module_exist:
-        modules.append({
-            'name': module['name'],
-            'package': package,
-            'path': module['path'],
-            'index': all_app_modules_list.index(module['name'])
-        })
-    for mod in sorted(modules, key=lambda mod: mod['index']):
-        data = data + mod['name'] + ':' + mod['package'] + ':' + mod['path'] + '\n'
-
-    key.set_contents_from_string(data)
-    key.close()
-    return old_manifest
+    build_inputs = {
+        # The build scripts get GHOST_APP, GHOST_ENV, GHOST_ROLE, GHOST_ENV_COLOR and GHOST_MODULE_PATH
+        'app_path': get_path_from_app_with_color(app),
+        'module': module.get('name'),
+        'module_path': module.get('path'),
+        'source': source_url,
+        'version': source_version,
+        'scripts': dict((script, module.get(script)) for script in ('build_pack', 'pre_deploy', 'post_deploy',
+                                                                    'after_all_deploy')),
+        'uid': module.get('uid'),
+        'gid': module.get('gid'),
+        'env_vars': [(env_var['var_key'], env_var.get('var_value', '')) for env_var in app.get('env_vars') or []],
+        'exclude_git_metadata': boolify(config.get('deployment_package_exclude_git_metadata', False)),
+    }
+    # Only hashed when defined, to keep the hashes of the packages built before packaging rules existed
+    if module.get('packaging'):
+        build_inputs['packaging'] = module['packaging']
+    return hashlib.sha256(json.dumps(build_inputs, sort_keys=True)).hexdigest()
 
 
 def get_key_path(config, region, account, key_name, log_file):
@@ -357,7 +350,7 @@ def get_key_path(config, region, account, key_name, log_file):
     return key_path
 
 
-def _get_fabric_params(app, fabric_execution_strategy, task, log_file):
+def _get_fabric_params(app, fabric_execution_strategy, log_file):
     app_region = app['region']
     app_assumed_account_id = app.get('assumed_account_id', '')
 
@@ -373,53 +366,120 @@ def _get_fabric_params(app, fabric_execution_strategy, task, log_file):
     if fabric_execution_strategy not in ['serial', 'parallel']:
         fabric_execution_strategy = config.get('fabric_execution_strategy', 'serial')
 
-    if fabric_execution_strategy == 'parallel':
-        setattr(task, 'serial', False)
-        setattr(task, 'parallel', True)
-    else:
-        setattr(task, 'serial', True)
-        setattr(task, 'parallel', False)
+    return app_ssh_username, key_filename, fabric_execution_strategy
 
-    return task, app_ssh_username, key_filename, fabric_execution_strategy
 
-
-def _handle_fabric_errors(result, message):
-    hosts_error = []
-    for host, ret_code in result.items():
-        if ret_code != 0:
-            hosts_error.append(host)
+def _handle_hosts_results(results, message, hosts_results_recorder):
+    if hosts_results_recorder:
+        hosts_results_recorder(results)
+    hosts_error = get_failed_hosts(results)
     if len(hosts_error):
-        raise GCallException("{0} on: {1}".format(message, ", ".join(hosts_error)))
+        raise GCallException("{0} on: {1}".format(message, ", ".join(
+            '{0} ({1})'.format(host, results[host]['message']) for host in hosts_error)))
 
 
-def launch_deploy(app, module, hosts_list, fabric_execution_strategy, log_file):
+def launch_deploy(app, module, hosts_list, fabric_execution_strategy, log_file, hosts_results_recorder=None,
+                  ssh_pool=None, host_deploy_results=None):
     """ Launch fabric tasks on remote hosts.
 
         :param  app:          dict: Ghost object which describe the application parameters.
-        :param  module:       dict: Ghost object which describe the module parameters.
+        :param  module:       dict: Ghost object which describe the module parameters, or list of modules.
         :param  hosts_list:   list: Instances private IP.
         :param  fabric_execution_strategy: string: Deployment strategy(serial or parallel).
         :param  log_file:     object for logging.
+        :param  hosts_results_recorder: function: Called with the results by host, if any.
+        :param  ssh_pool:     SSHConnectionPool: Connections of the job to reuse, if any.
+        :param  host_deploy_results: HostDeployResultsCollector: Results sent by the hosts to the Ghost API, if any.
+
+        Every host deploys the modules in order with a single stage2 run. With a results collector, stage2 runs
+        detached from the SSH session, which is closed as soon as stage2 is started.
     """
-    # Clone the deploy task function to avoid modifying the original shared instance
-    task = copy(deploy)
+    results = _push_deploy(app, module, hosts_list, fabric_execution_strategy, log_file, ssh_pool, host_deploy_results)
+    _handle_hosts_results(results, "Deploy error", hosts_results_recorder)
 
-    task, app_ssh_username, key_filename, fabric_execution_strategy = _get_fabric_params(app, fabric_execution_strategy,
-                                                                                         task, log_file)
+
+def _push_deploy(app, module, hosts_list, fabric_execution_strategy, log_file, ssh_pool, host_deploy_results):
+    """
+    Runs stage2 on the hosts through SSH, returns the results by host
+    """
+    modules = module if isinstance(module, list) else [module]
+    module_names = [mod['name'] for mod in modules]
+    app_ssh_username, key_filename, fabric_execution_strategy = _get_fabric_params(app, fabric_execution_strategy,
+                                                                                   log_file)
 
     bucket_region = config.get('bucket_region', app['region'])
     notification_endpoint = config.get('notification_endpoint', '')
     stage2 = render_stage2(config, bucket_region)
 
-    log("Updating current instances in {}: {}".format(fabric_execution_strategy, hosts_list), log_file)
-    result = fab_execute(task, module, app_ssh_username, key_filename, stage2, notification_endpoint,
-                         log_file, hosts=hosts_list)
+    executor = get_ssh_executor(config, fabric_execution_strategy, len(hosts_list), log_file, ssh_pool)
+    log("Updating current instances in {} ({} at a time): {}".format(
+        fabric_execution_strategy, executor.concurrency, hosts_list), log_file)
+    if host_deploy_results:
+        run_id, results_endpoint = host_deploy_results.new_run()
+        results = executor.run(hosts_list, 'deploy_modules_detached', module_names, app_ssh_username, key_filename,
+                               stage2, notification_endpoint, results_endpoint, log_file)
+        started_hosts = [host for host in results if results[host]['status'] == HOST_STATUS_SUCCESS]
+        if started_hosts:
+            log("stage2 started on {0} instance(s), waiting for their results".format(len(started_hosts)), log_file)
+            results.update(host_deploy_results.wait(run_id, started_hosts, log_file))
+    else:
+        results = executor.run(hosts_list, 'deploy_modules', module_names, app_ssh_username, key_filename, stage2,
+                               notification_endpoint, log_file)
+    return results
 
-    _handle_fabric_errors(result, "Deploy error")
+
+def is_deployment_agent_enabled():
+    """
+    Returns True if modules are deployed by the agents of the instances, which pull the releases published by Ghost,
+    instead of stage2 runs pushed through SSH
+    """
+    return boolify(config.get('deployment_agent', False))
+
+
+def launch_agent_deploy(app, module, hosts_list, fabric_execution_strategy, log_file, hosts_results_recorder=None,
+                        ssh_pool=None, host_deploy_results=None):
+    """ Publish a release for the deployment agents of remote hosts and wait for their reports.
+
+        :param  app:          dict: Ghost object which describe the application parameters.
+        :param  module:       dict: Ghost object which describe the module parameters, or list of modules.
+        :param  hosts_list:   list: Instances private IP.
+        :param  fabric_execution_strategy: string: Deployment strategy(serial or parallel) of the SSH pushes.
+        :param  log_file:     object for logging.
+        :param  hosts_results_recorder: function: Called with the results by host, if any.
+        :param  ssh_pool:     SSHConnectionPool: Connections of the job to reuse, if any.
+        :param  host_deploy_results: HostDeployResultsCollector: Results sent by the hosts to the Ghost API, if any.
+
+        Hosts without a recent agent heartbeat are deployed through SSH, which installs their agent.
+    """
+    modules = module if isinstance(module, list) else [module]
+    timeout = int(config.get('deployment_agent_timeout', DEFAULT_DEPLOYMENT_AGENT_TIMEOUT))
+    ack_timeout = int(config.get('deployment_agent_ack_timeout', DEFAULT_DEPLOYMENT_AGENT_ACK_TIMEOUT))
+
+    cloud_connection = cloud_connections.get(app.get('provider', DEFAULT_PROVIDER))(config)
+    conn = cloud_connection.get_connection(config.get('bucket_region', app['region']), ["s3"])
+    bucket = conn.get_bucket(config['bucket_s3'])
+    app_path = get_path_from_app_with_color(app)
+
+    agent_hosts = get_agent_hosts(bucket, app_path, hosts_list, get_agent_heartbeat_max_age(config))
+    ssh_hosts = [host for host in hosts_list if host not in agent_hosts]
+    release_id = None
+    if agent_hosts:
+        release_id = publish_agent_release(bucket, app_path, [mod['name'] for mod in modules], agent_hosts,
+                                           ack_timeout, log_file)
+    results = {}
+    if ssh_hosts:
+        log("No deployment agent running on {0}, deploying through SSH".format(ssh_hosts), log_file)
+        results.update(_push_deploy(app, module, ssh_hosts, fabric_execution_strategy, log_file, ssh_pool,
+                                    host_deploy_results))
+    if release_id:
+        results.update(wait_agent_reports(bucket, app_path, release_id, agent_hosts, ack_timeout, timeout, log_file))
+
+    _handle_hosts_results(OrderedDict((host, results[host]) for host in hosts_list), "Deploy error",
+                          hosts_results_recorder)
 
 
 def launch_executescript(app, script, context_path, sudoer_user, jobid, hosts_list, fabric_execution_strategy, log_file,
-                         ghost_env):
+                         ghost_env, hosts_results_recorder=None, ssh_pool=None):
     """ Launch fabric tasks on remote hosts.
 
         :param  app:          dict: Ghost object which describe the application parameters.
@@ -431,26 +491,16 @@ def launch_executescript(app, script, context_path, sudoer_user, jobid, hosts_li
         :param  fabric_execution_strategy:  string: Deployment strategy(serial or parallel).
         :param  log_file:     object for logging.
         :param  ghost_env:    dict: all Ghost env variables
+        :param  hosts_results_recorder: function: Called with the results by host, if any.
+        :param  ssh_pool:     SSHConnectionPool: Connections of the job to reuse, if any.
     """
-    # Clone the executescript task function to avoid modifying the original shared instance
-    task = copy(executescript)
-
-    task, app_ssh_username, key_filename, fabric_execution_strategy = _get_fabric_params(app, fabric_execution_strategy,
-                                                                                         task, log_file)
-
-    log("Updating current instances in {}: {}".format(fabric_execution_strategy, hosts_list), log_file)
-    result = fab_execute(task, app_ssh_username, key_filename, context_path, sudoer_user, jobid, script, log_file,
-                         ghost_env, hosts=hosts_list)
-
-    _handle_fabric_errors(result, "Script execution error")
+    app_ssh_username, key_filename, fabric_execution_strategy = _get_fabric_params(app, fabric_execution_strategy,
+                                                                                   log_file)
 
+    executor = get_ssh_executor(config, fabric_execution_strategy, len(hosts_list), log_file, ssh_pool)
+    log("Updating current instances in {} ({} at a time): {}".format(
+        fabric_execution_strategy, executor.concurrency, hosts_list), log_file)
+    results = executor.run(hosts_list, 'executescript', app_ssh_username, key_filename, context_path, sudoer_user, jobid,
+                           script, log_file, ghost_env)
 
-def download_s3_object(app, source_url, working_directory, revision, log_file):
-    cloud_connection = cloud_connections.get(app.get('provider', DEFAULT_PROVIDER))(log_file)
-    conn = cloud_connection.get_connection(config.get('bucket_region', app['region']), ["s3"], boto_version='boto3')
-    pattern = re.compile('s3://([a-z0-9][a-z0-9-.]*)?/(.*)')
-    matches = pattern.search(source_url)
-    bucket_name = matches.group(1)
-    bucket_key_path = matches.group(2)
-    conn.download_file(bucket_name, bucket_key_path, os.path.join(working_directory, os.path.basename(bucket_key_path)),
-                       ExtraArgs={'VersionId': revision})
+    _handle_hosts_results(results, "Script execution error", hosts_results_recorder)
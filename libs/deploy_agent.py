@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Library of the pull-based deployment mode: instead of pushing stage2 through SSH, Ghost publishes a release
+    next to the app MANIFEST in S3 and the deployment agent of every instance, which watches the release ETag,
+    runs stage2 locally. Each agent acknowledges the release, then reports its stage2 return code, as empty S3 keys
+    named <app path>/agent_reports/<release id>/<host>/<started|return code>, so that the reports of thousands of
+    instances are collected with a few listings. Running agents also refresh an <app path>/agent_heartbeats/<host>
+    key, hosts without a recent heartbeat are deployed through SSH, which installs their agent.
+"""
+
+import datetime
+import json
+import time
+import uuid
+from collections import OrderedDict
+
+from boto.utils import parse_ts
+
+from ghost_log import log
+from libs.ssh_executor import HOST_STATUS_FAILED, HOST_STATUS_SUCCESS, HOST_STATUS_TIMEOUT, get_host_result
+
+AGENT_RELEASE_NAME = 'AGENT_RELEASE'
+AGENT_REPORTS_DIR = 'agent_reports'
+AGENT_HEARTBEATS_DIR = 'agent_heartbeats'
+AGENT_RELEASE_STARTED = 'started'
+
+DEFAULT_DEPLOYMENT_AGENT_TIMEOUT = 1800
+DEFAULT_DEPLOYMENT_AGENT_ACK_TIMEOUT = 60
+DEFAULT_DEPLOYMENT_AGENT_POLL_INTERVAL = 10
+DEFAULT_DEPLOYMENT_AGENT_HEARTBEAT_INTERVAL = 300
+
+# Interval in seconds between two listings of the agents reports
+REPORTS_POLL_INTERVAL = 5
+
+
+def get_agent_release_key_path(app_path):
+    """
+    >>> get_agent_release_key_path('/ghost/AppName/prod/webfront/blue')
+    '/ghost/AppName/prod/webfront/blue/AGENT_RELEASE'
+    """
+    return '{0}/{1}'.format(app_path, AGENT_RELEASE_NAME)
+
+
+def get_agent_reports_prefix(app_path, release_id):
+    """
+    >>> get_agent_reports_prefix('/ghost/AppName/prod/webfront', '0d23e96a')
+    'ghost/AppName/prod/webfront/agent_reports/0d23e96a/'
+    """
+    return '{0}/{1}/{2}/'.format(app_path.lstrip('/'), AGENT_REPORTS_DIR, release_id)
+
+
+def get_agent_heartbeats_prefix(app_path):
+    """
+    >>> get_agent_heartbeats_prefix('/ghost/AppName/prod/webfront')
+    'ghost/AppName/prod/webfront/agent_heartbeats/'
+    """
+    return '{0}/{1}/'.format(app_path.lstrip('/'), AGENT_HEARTBEATS_DIR)
+
+
+def get_agent_heartbeat_max_age(config):
+    """
+    Returns the age in seconds past which the heartbeat of an agent is outdated: two missed heartbeats,
+    the agent only sending them between its polls
+
+    >>> get_agent_heartbeat_max_age({})
+    610
+    >>> get_agent_heartbeat_max_age({'deployment_agent_heartbeat_interval': 60, 'deployment_agent_poll_interval': 5})
+    125
+    """
+    return (2 * int(config.get('deployment_agent_heartbeat_interval', DEFAULT_DEPLOYMENT_AGENT_HEARTBEAT_INTERVAL)) +
+            int(config.get('deployment_agent_poll_interval', DEFAULT_DEPLOYMENT_AGENT_POLL_INTERVAL)))
+
+
+def get_agent_hosts(bucket, app_path, hosts, max_age):
+    """
+    Returns the hosts, in order, whose agent sent a heartbeat in the last max_age seconds
+    """
+    prefix = get_agent_heartbeats_prefix(app_path)
+    now = datetime.datetime.utcnow()
+    alive = set(key.name[len(prefix):] for key in bucket.list(prefix)
+                if (now - parse_ts(key.last_modified)).total_seconds() <= max_age)
+    return [host for host in hosts if host in alive]
+
+
+def format_agent_release(release_id, module_names, hosts, deadline):
+    """
+    Returns the release read by the agents: the modules to deploy, in order, on the given hosts.
+    Agents ignore the release past its deadline, a timestamp, so that a release they did not acknowledge in time
+    is never deployed.
+
+    >>> format_agent_release('0d23e96a', ['mod1', 'mod2'], ['10.0.0.1', '10.0.0.2'], 1485857801)
+    '{"deadline": 1485857801, "hosts": ["10.0.0.1", "10.0.0.2"], "modules": ["mod1", "mod2"], "release_id": "0d23e96a"}'
+    """
+    return json.dumps({'release_id': release_id, 'modules': module_names, 'hosts': hosts, 'deadline': deadline},
+                      sort_keys=True)
+
+
+def parse_agent_reports(key_names, prefix):
+    """
+    Returns the hosts which acknowledged the release and the stage2 return codes by host of the reports keys
+
+    >>> prefix = 'ghost/AppName/prod/webfront/agent_reports/0d23e96a/'
+    >>> started, reports = parse_agent_reports([prefix + '10.0.0.1/started', prefix + '10.0.0.1/0',
+    ...                                         prefix + '10.0.0.2/-12', prefix + '10.0.0.3/started',
+    ...                                         prefix + 'invalid'], prefix)
+    >>> sorted(started)
+    ['10.0.0.1', '10.0.0.3']
+    >>> sorted(reports.items())
+    [('10.0.0.1', 0), ('10.0.0.2', -12)]
+    """
+    started = set()
+    reports = {}
+    for name in key_names:
+        fields = name[len(prefix):].split('/')
+        if len(fields) != 2:
+            continue
+        if fields[1] == AGENT_RELEASE_STARTED:
+            started.add(fields[0])
+            continue
+        try:
+            reports[fields[0]] = int(fields[1])
+        except ValueError:
+            continue
+    return started, reports
+
+
+def publish_agent_release(bucket, app_path, module_names, hosts, ack_timeout, log_file):
+    """
+    Writes the release of the modules for the agents of the given hosts, to be acknowledged within ack_timeout seconds
+    Returns the release id
+    """
+    release_id = uuid.uuid4().hex
+    key = bucket.new_key(get_agent_release_key_path(app_path))
+    key.set_contents_from_string(format_agent_release(release_id, module_names, hosts,
+                                                      int(time.time() + ack_timeout)))
+    key.close()
+    log("Release {0} of {1} published for the deployment agents of {2} instance(s)".format(
+        release_id, ', '.join(module_names), len(hosts)), log_file)
+    return release_id
+
+
+def wait_agent_reports(bucket, app_path, release_id, hosts, ack_timeout, timeout, log_file):
+    """
+    Waits until the agents of every host reported the release, at most timeout seconds, then removes the reports.
+    Hosts which did not acknowledge the release within ack_timeout seconds are not waited for.
+    Returns the results by host, in hosts order, hosts which did not report being timed out
+    """
+    prefix = get_agent_reports_prefix(app_path, release_id)
+    results = OrderedDict((host, None) for host in hosts)
+    start = time.time()
+    done = 0
+    try:
+        while True:
+            duration = time.time() - start
+            started, reports = parse_agent_reports([key.name for key in bucket.list(prefix)], prefix)
+            for host, return_code in reports.items():
+                if host in results and results[host] is None:
+                    if return_code == 0:
+                        results[host] = get_host_result(HOST_STATUS_SUCCESS, return_code, duration)
+                    else:
+                        results[host] = get_host_result(HOST_STATUS_FAILED, return_code, duration,
+                                                        'exited with code {0}'.format(return_code))
+            # Agents check the release deadline when they pick it up, the acknowledgement upload gets a poll more
+            if duration > ack_timeout + REPORTS_POLL_INTERVAL:
+                for host, result in results.items():
+                    if result is None and host not in started:
+                        results[host] = get_host_result(
+                            HOST_STATUS_TIMEOUT, None, duration,
+                            'deployment agent did not acknowledge the release after {0}s'.format(ack_timeout))
+            reported = len([result for result in results.values() if result])
+            if reported != done:
+                done = reported
+                log("Deployment agents reports: {0}/{1} instance(s) done".format(done, len(hosts)), log_file)
+            if done == len(hosts) or duration > timeout:
+                break
+            time.sleep(REPORTS_POLL_INTERVAL)
+    finally:
+        report_keys = [key.name for key in bucket.list(prefix)]
+        if report_keys:
+            bucket.delete_keys(report_keys)
+
+    for host, result in results.items():
+        if result is None:
+            results[host] = get_host_result(HOST_STATUS_TIMEOUT, None, time.time() - start,
+                                            'no deployment agent report after {0}s'.format(timeout))
+    return results
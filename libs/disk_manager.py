@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Library accounting the disk usage of the local stores of Ghost (workspaces, git mirrors, provisioners trees,
+    Packer directories, job logs) and evicting their least recently used entries beyond their configured quota
+"""
+
+import datetime
+import os
+import socket
+
+from ghost_log import log
+from ghost_tools import GCallException, gcall
+from libs.git_helper import git_get_mirror_last_fetch
+from libs.git_maintenance import GIT_MIRRORS_ROOT, get_directory_size, get_mirror_lock_path, list_git_mirrors
+from libs.locks import FairFileLock, JobLockRegistry
+from libs.workspaces import WORKSPACES_ROOT, DEFAULT_WORKSPACES_MAX_SIZE, get_workspace_lock_path, list_workspaces
+
+PROVISIONERS_ROOT = '/tmp/ghost-features-provisioner'
+PACKER_ROOT = '/tmp/packer'
+JOB_LOGS_ROOT = '/var/log/ghost'
+
+DEFAULT_GIT_MIRRORS_MAX_SIZE = 51200
+DEFAULT_PROVISIONERS_MAX_SIZE = 5120
+DEFAULT_PACKER_MAX_SIZE = 1024
+DEFAULT_JOB_LOGS_MAX_SIZE = 10240
+
+DEFAULT_DISK_MANAGER_INTERVAL = 900
+
+
+def list_directories(root):
+    """
+    Returns the paths of the directories directly under root
+
+    >>> import tempfile, shutil
+    >>> root = tempfile.mkdtemp()
+    >>> for path in ['salt-5a0d3e08a2b9c2b5a1234567', 'ansible-5a0d3e08a2b9c2b5a1234567', '.tmp']:
+    ...     os.makedirs(os.path.join(root, path))
+    >>> open(os.path.join(root, 'file'), 'w').write('')
+    >>> [os.path.basename(path) for path in list_directories(root)]
+    ['ansible-5a0d3e08a2b9c2b5a1234567', 'salt-5a0d3e08a2b9c2b5a1234567']
+    >>> list_directories(root + '/missing')
+    []
+    >>> shutil.rmtree(root)
+    """
+    if not os.path.isdir(root):
+        return []
+    return sorted(os.path.join(root, name) for name in os.listdir(root)
+                  if not name.startswith('.') and os.path.isdir(os.path.join(root, name)))
+
+
+def list_job_logs(root=JOB_LOGS_ROOT):
+    """
+    Returns the paths of the job logs, named by their log id
+
+    >>> import tempfile, shutil
+    >>> root = tempfile.mkdtemp()
+    >>> for name in ['5a0d3e08-fe0e-4b9f-a1b2-c3d4e5f6a7b8.txt', 'git_mirrors_maintenance.log']:
+    ...     open(os.path.join(root, name), 'w').write('')
+    >>> [os.path.basename(path) for path in list_job_logs(root)]
+    ['5a0d3e08-fe0e-4b9f-a1b2-c3d4e5f6a7b8.txt']
+    >>> shutil.rmtree(root)
+    """
+    if not os.path.isdir(root):
+        return []
+    return sorted(os.path.join(root, name) for name in os.listdir(root)
+                  if name.endswith('.txt') and os.path.isfile(os.path.join(root, name)))
+
+
+def get_provisioner_tree_job_id(path):
+    """
+    >>> get_provisioner_tree_job_id('/tmp/ghost-features-provisioner/salt-5a0d3e08a2b9c2b5a1234567')
+    '5a0d3e08a2b9c2b5a1234567'
+    """
+    return os.path.basename(path).rsplit('-', 1)[-1]
+
+
+def get_job_log_id(path):
+    """
+    >>> get_job_log_id('/var/log/ghost/5a0d3e08-fe0e-4b9f-a1b2-c3d4e5f6a7b8.txt')
+    '5a0d3e08-fe0e-4b9f-a1b2-c3d4e5f6a7b8'
+    """
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def get_mirror_last_use(mirror_path):
+    return max(git_get_mirror_last_fetch(mirror_path) or 0, os.stat(mirror_path).st_mtime)
+
+
+class _JobEntryLock(object):
+    """
+    Lock of a store entry owned by a single job: available once the job is not running anymore
+    """
+
+    def __init__(self, registry, job_id):
+        self._registry = registry
+        self._job_id = job_id
+
+    def acquire(self, blocking=False):
+        return not self._registry.is_running(self._job_id)
+
+    def release(self):
+        pass
+
+
+class DiskStore(object):
+    """
+    Local store made of entries (directories or files) listed by list_entries. Entries are evicted in least
+    recently used order beyond the size in MB configured by max_size_key. get_lock returns the lock a job holds
+    while it uses the entry (given the entry path and a log file): locked entries are never evicted.
+    """
+
+    def __init__(self, name, root, list_entries, get_lock, max_size_key, default_max_size, get_last_use=None):
+        self.name = name
+        self.root = root
+        self._list_entries = list_entries
+        self._get_lock = get_lock
+        self._max_size_key = max_size_key
+        self._default_max_size = default_max_size
+        self._get_last_use = get_last_use or (lambda path: os.stat(path).st_mtime)
+
+    def get_max_size(self, config):
+        return int(float(config.get(self._max_size_key, self._default_max_size)) * 1024 * 1024)
+
+    def get_entries(self):
+        """
+        Returns the entries of the store as (last use timestamp, size, path), least recently used first
+        """
+        entries = []
+        for path in self._list_entries(self.root):
+            try:
+                size = get_directory_size(path) if os.path.isdir(path) else os.lstat(path).st_size
+                entries.append((self._get_last_use(path), size, path))
+            except OSError:
+                continue
+        return sorted(entries)
+
+    def _remove_entry(self, path, log_file):
+        if os.path.isdir(path):
+            gcall('chmod -R u+rwx "{p}"'.format(p=path), 'Update rights on {p}'.format(p=path), log_file)
+            gcall('rm -rf "{p}"'.format(p=path), 'Removing {p}'.format(p=path), log_file)
+        else:
+            os.remove(path)
+
+    def evict(self, config, log_file):
+        """
+        Removes the least recently used entries not in use until the store fits in its quota
+        Returns the store usage statistics
+        """
+        max_size = self.get_max_size(config)
+        entries = self.get_entries()
+        total_size = sum(size for last_use, size, path in entries)
+        evicted = []
+        for last_use, size, path in entries:
+            if total_size <= max_size:
+                break
+            lock = self._get_lock(path, log_file)
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                self._remove_entry(path, log_file)
+            except (GCallException, OSError) as e:
+                log('Unable to remove {p}: {e}'.format(p=path, e=e), log_file)
+                continue
+            finally:
+                lock.release()
+            total_size -= size
+            evicted.append((size, path))
+        if evicted:
+            log('Disk store {n}: {c} least recently used entry(ies) removed ({s:.1f} MB), {u:.1f} MB used'.format(
+                n=self.name, c=len(evicted), s=sum(size for size, path in evicted) / 1024.0 / 1024.0,
+                u=total_size / 1024.0 / 1024.0), log_file)
+        return {
+            'host': socket.gethostname(),
+            'store': self.name,
+            'path': self.root,
+            'size': total_size,
+            'max_size': max_size,
+            'entries': len(entries) - len(evicted),
+            'evicted_entries': len(evicted),
+            'evicted_size': sum(size for size, path in evicted),
+            '_updated': datetime.datetime.utcnow(),
+        }
+
+
+def _get_workspace_lock(path, log_file):
+    return FairFileLock(get_workspace_lock_path(path), log_file, 'on workspace {p}'.format(p=path))
+
+
+def _get_mirror_lock(path, log_file):
+    return FairFileLock(get_mirror_lock_path(path), log_file, 'on git mirror {m}'.format(m=path))
+
+
+def _get_provisioner_tree_lock(path, log_file):
+    return _JobEntryLock(JobLockRegistry(), get_provisioner_tree_job_id(path))
+
+
+def _get_packer_directory_lock(path, log_file):
+    return _JobEntryLock(JobLockRegistry(), os.path.basename(path))
+
+
+def _get_job_log_lock(path, log_file):
+    return _JobEntryLock(JobLockRegistry(), get_job_log_id(path))
+
+
+def get_disk_stores(names=None):
+    """
+    Returns the local stores of Ghost, or the given ones
+
+    >>> [store.name for store in get_disk_stores()]
+    ['workspaces', 'git_mirrors', 'provisioners', 'packer', 'job_logs']
+    >>> [store.root for store in get_disk_stores(['workspaces'])]
+    ['/ghost']
+    """
+    stores = [
+        DiskStore('workspaces', WORKSPACES_ROOT, list_workspaces, _get_workspace_lock,
+                  'workspaces_max_size', DEFAULT_WORKSPACES_MAX_SIZE),
+        DiskStore('git_mirrors', GIT_MIRRORS_ROOT, list_git_mirrors, _get_mirror_lock,
+                  'git_mirrors_max_size', DEFAULT_GIT_MIRRORS_MAX_SIZE, get_last_use=get_mirror_last_use),
+        DiskStore('provisioners', PROVISIONERS_ROOT, list_directories, _get_provisioner_tree_lock,
+                  'provisioners_max_size', DEFAULT_PROVISIONERS_MAX_SIZE),
+        DiskStore('packer', PACKER_ROOT, list_directories, _get_packer_directory_lock,
+                  'packer_max_size', DEFAULT_PACKER_MAX_SIZE),
+        DiskStore('job_logs', JOB_LOGS_ROOT, list_job_logs, _get_job_log_lock,
+                  'job_logs_max_size', DEFAULT_JOB_LOGS_MAX_SIZE),
+    ]
+    return [store for store in stores if names is None or store.name in names]
+
+
+def manage_disk_stores(config, stats_collection, log_file, stores=None):
+    """
+    Evicts the least recently used entries of every store beyond its quota and stores the stores usage statistics
+    """
+    for store in stores if stores is not None else get_disk_stores():
+        stats = store.evict(config, log_file)
+        if stats_collection is not None:
+            stats_collection.update({'host': stats['host'], 'store': store.name}, {'$set': stats}, upsert=True)
@@ -4,68 +4,26 @@
     Library to have common git operations
 """
 
+import json
 import os
 import time
+
+from redis import Redis
+from redis.exceptions import RedisError
+
 from ghost_log import log
-from sh import git
+from ghost_tools import config, gcall, get_mirror_path_from_module, get_lock_path_from_repo
+from libs.locks import FairFileLock
+from sh import git, ErrorReturnCode_1
 
+MIRROR_FETCH_STAMP_FILE = 'ghost-last-fetch'
 
-def git_acquire_lock(lock_path, log_file=None):
-    """
-    >>> import os
-    >>> lock_test = '/tmp/lock-test'
-    >>> git_acquire_lock(lock_test)
-    >>> os.path.exists(lock_test)
-    True
-    >>> os.rmdir(lock_test)
-    """
-    locked = False
-    attempt = 1
-    while not locked:
-        try:
-            # 600 attempts * 5s = 50min of waits max
-            if attempt > 600:
-                msg = 'Cannot lock: "{}" after {} attempts'.format(lock_path, attempt)
-                if log_file:
-                    log(msg, log_file)
-                raise Exception(msg)
-            os.makedirs(lock_path)
-            if log_file:
-                log('Locking git mirror local directory with %s' % lock_path, log_file)
-            locked = True
-        except OSError as err:
-            if err.errno == os.errno.EEXIST:
-                # If the lock directory exists, wait until it disappears before trying to update the mirror
-                attempt += 1
-                if log_file:
-                    log('The git mirror is locked by another process, waiting 5s... (attempt %s/600)' % attempt, log_file)
-                time.sleep(5)
-            else:
-                if log_file:
-                    log('Cannot lock: %s' % err, log_file)
-                raise
-
-
-def git_release_lock(lock_path, log_file=None):
-    """
-    >>> import tempfile
-    >>> temp_dir = tempfile.mkdtemp()
-    >>> git_release_lock(temp_dir)
-    >>> os.path.exists(temp_dir)
-    False
-    """
-    if log_file:
-        log('Removing git mirror lock (%s)' % lock_path, log_file)
-    try:
-        os.rmdir(lock_path)
-    except OSError as err:
-        if err.errno == os.errno.ENOENT:
-            if log_file:
-                log('Lock (%s) already released.' % lock_path, log_file)
-        else:
-            if log_file:
-                log('Cannot unlock: %s' % err, log_file)
-            raise
+GIT_REFS_CACHE_KEY_PREFIX = 'ghost_git_refs:'
+GIT_REFS_STALE_KEY_PREFIX = 'ghost_git_refs_stale:'
+GIT_REFS_MIRROR_CACHE_TTL = 24 * 3600
+DEFAULT_LS_REMOTE_CACHE_TTL = 300
+
+_redis_connection = None
 
 
 def git_remap_submodule(git_local_repo, submodule_repo, submodule_mirror, log_file):
@@ -81,33 +39,324 @@ def git_remap_submodule(git_local_repo, submodule_repo, submodule_mirror, log_fi
         submodule_config.write(filedata)
 
 
-def git_ls_remote_branches_tags(git_repo, log_file=None):
+def _git_parse_branches_tags(refs):
     """
-    This function trigger the `ls-remote` git command on the remote git repo
-    and retrieve all available branches and tags, sorted by name.
+    Returns the branches and tags from a list of (sha, ref) tuples as listed by `ls-remote`:
+    other revisions first, then tags sorted in reverse order, then branches sorted by name.
+
+    >>> _git_parse_branches_tags([('a1', 'HEAD'), ('a1', 'refs/heads/master'), ('b2', 'refs/heads/dev'),
+    ...                           ('c3', 'refs/tags/v1.0'), ('d4', 'refs/tags/v1.0^{}'), ('c5', 'refs/tags/v1.1'),
+    ...                           ('e5', 'refs/pull/1/head'), ('f6', 'refs/remotes/origin/master')])
+    [('HEAD', 'HEAD'), ('v1.1', 'tag: v1.1'), ('v1.0', 'tag: v1.0'), ('dev', 'branch: dev'), ('master', 'branch: master')]
     """
     revs = []
     branches = []
     tags = []
+    for sha, ref in refs:
+        if ref.endswith('{}'):  # ignore github releases
+            continue
+        if ref.startswith('refs/pull'):  # ignore PR
+            continue
+        if ref.startswith('refs/remotes'):  # ignore remotes
+            continue
+        key = ref.replace('refs/heads/', '').replace('refs/tags/', '')
+        val = ref.replace('refs/heads/', 'branch: ').replace('refs/tags/', 'tag: ')
+        if val.startswith('tag'):
+            tags.append((key, val))
+        elif val.startswith('branch'):
+            branches.append((key, val))
+        else:
+            revs.append((key, val))
+    return revs + sorted(tags, key=lambda k: k[0], reverse=True) + sorted(branches, key=lambda k: k[0])
+
+
+def _git_ls_remote(git_repo):
+    refs = []
+    for line in git("--no-pager", "ls-remote", git_repo, _tty_out=False, _timeout=20, _iter=True):
+        refs.append(tuple(line.strip().split("\t")))
+    return _git_parse_branches_tags(refs)
+
+
+def _get_redis_connection():
+    global _redis_connection
+    if _redis_connection is None:
+        _redis_connection = Redis(host=os.getenv('REDIS_HOST', config.get('redis_host', 'localhost')))
+    return _redis_connection
+
+
+def git_mark_branches_tags_stale(git_repos, redis_connection=None):
+    """
+    Invalidates the cached branches and tags of the given repositories (all the urls of a repository
+    notified by a webhook). Their local mirrors are not used to list refs until their next fetch.
+    """
+    redis_connection = redis_connection or _get_redis_connection()
+    now = time.time()
+    for git_repo in git_repos:
+        redis_connection.setex(GIT_REFS_STALE_KEY_PREFIX + git_repo, repr(now), GIT_REFS_MIRROR_CACHE_TTL)
+        redis_connection.delete(GIT_REFS_CACHE_KEY_PREFIX + git_repo)
+
+
+def git_ls_remote_branches_tags(git_repo, log_file=None, redis_connection=None):
+    """
+    This function retrieves all available branches and tags of the git repo, sorted by name.
+
+    Refs are listed from the local mirror maintained by deployment jobs, unless there is no mirror or a webhook
+    notified a change after its last fetch: the `ls-remote` command is then triggered on the remote git repo.
+    Results are cached in Redis, until the next fetch of the mirror or for `git_ls_remote_cache_ttl` seconds
+    when listed from the remote.
+    """
+    mirror_path = get_mirror_path_from_module({'git_repo': git_repo})
+    cache_key = GIT_REFS_CACHE_KEY_PREFIX + git_repo
     try:
-        for line in git("--no-pager", "ls-remote", git_repo, _tty_out=False, _timeout=20, _iter=True):
-            refs = line.strip().split("\t")
-            if refs[1].endswith('{}'):  # ignore github releases
-                continue
-            if refs[1].startswith('refs/pull'):  # ignore PR
-                continue
-            if refs[1].startswith('refs/remotes'):  # ignore remotes
-                continue
-            key = refs[1].replace('refs/heads/', '').replace('refs/tags/', '')
-            val = refs[1].replace('refs/heads/', 'branch: ').replace('refs/tags/', 'tag: ')
-            if val.startswith('tag'):
-                tags.append((key, val))
-            elif val.startswith('branch'):
-                branches.append((key, val))
-            else:
-                revs.append((key, val))
+        redis_connection = redis_connection or _get_redis_connection()
+        cached, stale_at = redis_connection.mget(cache_key, GIT_REFS_STALE_KEY_PREFIX + git_repo)
+    except RedisError as e:
+        if log_file:
+            log('git_ls_remote_branches_tags("{git}") cache unavailable: {ex}'.format(git=git_repo, ex=str(e)),
+                log_file)
+        redis_connection = cached = stale_at = None
+
+    last_fetch = git_get_mirror_last_fetch(mirror_path) if os.path.isdir(mirror_path) else None
+    use_mirror = last_fetch is not None and (not stale_at or last_fetch >= float(stale_at))
+    if cached:
+        cached = json.loads(cached)
+        if (use_mirror and cached['last_fetch'] == last_fetch) or (not use_mirror and cached['last_fetch'] is None):
+            return [tuple(ref) for ref in cached['refs']]
+
+    try:
+        refs = _git_ls_remote(mirror_path if use_mirror else git_repo)
     except Exception as e:
         print str(e)
         if log_file:
             log('git_ls_remote_branches_tags("{git}") call failed: {ex}'.format(git=git_repo, ex=str(e)), log_file)
-    return revs + sorted(tags, key=lambda k: k[0], reverse=True) + sorted(branches, key=lambda k: k[0])
+        return []
+
+    if redis_connection:
+        ttl = GIT_REFS_MIRROR_CACHE_TTL if use_mirror else int(config.get('git_ls_remote_cache_ttl',
+                                                                          DEFAULT_LS_REMOTE_CACHE_TTL))
+        try:
+            redis_connection.setex(cache_key, json.dumps({'last_fetch': last_fetch if use_mirror else None,
+                                                          'refs': refs}), ttl)
+        except RedisError:
+            pass
+    return refs
+
+
+def git_is_commit_hash(revision, cwd=None):
+    """
+    Returns True is revision is a valid commit hash, False otherwise.
+
+    ***NOTE***:
+    This test invokes git rev-parse in the given git workspace (current working directory by default)
+    and will fail if git is not installed or run outside of a git workspace.
+
+    >>> git_is_commit_hash('HEAD')
+    False
+
+    >>> git_is_commit_hash('master')
+    False
+
+    >>> git_is_commit_hash('dev')
+    False
+
+    >>> current_git_hash = git('--no-pager', 'rev-parse', 'HEAD', _tty_out=False).strip()
+    >>> git_is_commit_hash(current_git_hash)
+    True
+
+    The length of a valid abbreviated hash depends on the current repository:
+
+    >>> shortest_hash = git('--no-pager', 'rev-parse', '--short', 'HEAD', _tty_out=False).strip()
+    >>> git_is_commit_hash(current_git_hash[:len(shortest_hash)])
+    True
+
+    Very short substrings won't match:
+
+    >>> git_is_commit_hash(current_git_hash[:3])
+    False
+    """
+
+    resolved_revision = ''
+    try:
+        # git rev-parse returns a complete hash from an abbreviated hash, if valid
+        resolved_revision = git('--no-pager', 'rev-parse', revision, _cwd=cwd, _tty_out=False).strip()
+    except:
+        pass
+
+    # If resolved_revision begins with or equals revision, it is a commit hash
+    return resolved_revision.find(revision) == 0
+
+
+def git_get_mirror_last_fetch(mirror_path):
+    """
+    Returns the timestamp of the start of the last successful fetch of the local mirror, None if unknown
+
+    >>> import tempfile, shutil
+    >>> mirror_path = tempfile.mkdtemp()
+    >>> git_get_mirror_last_fetch(mirror_path) is None
+    True
+    >>> git_set_mirror_last_fetch(mirror_path, 1485857801.5)
+    >>> git_get_mirror_last_fetch(mirror_path)
+    1485857801.5
+    >>> shutil.rmtree(mirror_path)
+    """
+    try:
+        with open(os.path.join(mirror_path, MIRROR_FETCH_STAMP_FILE)) as f:
+            return float(f.read().strip())
+    except (IOError, ValueError):
+        return None
+
+
+def git_set_mirror_last_fetch(mirror_path, timestamp):
+    with open(os.path.join(mirror_path, MIRROR_FETCH_STAMP_FILE), 'w') as f:
+        f.write(repr(timestamp))
+
+
+def git_update_mirror(git_repo, mirror_path, lock_path, log_file, revision=None, fetch_window=0):
+    """
+    Creates or updates the local bare mirror of git_repo.
+
+    Concurrent jobs using the same mirror coalesce their fetches: the fetch is skipped if the requested
+    revision is a commit hash already available in the mirror, if another job fetched the mirror after this
+    one requested it (while it was waiting for the lock), or if the last fetch is more recent than
+    fetch_window seconds.
+    Returns True if the mirror has been fetched.
+    """
+    requested_at = time.time()
+    if revision and os.path.exists(mirror_path) and git_is_commit_hash(revision, cwd=mirror_path):
+        log('Revision {rev} is already available in local mirror {m}, skipping fetch'.format(
+            rev=revision, m=mirror_path), log_file)
+        return False
+
+    with FairFileLock(lock_path, log_file, 'on git mirror {m}'.format(m=mirror_path)):
+        fetch_started_at = time.time()
+        if not os.path.exists(mirror_path):
+            gcall('git --no-pager clone --bare --mirror {r} {m}'.format(r=git_repo, m=mirror_path),
+                  'Create local git mirror for remote {r}'.format(r=git_repo),
+                  log_file)
+            git_set_mirror_last_fetch(mirror_path, fetch_started_at)
+            return True
+
+        last_fetch = git_get_mirror_last_fetch(mirror_path)
+        if last_fetch and (last_fetch >= requested_at or fetch_started_at - last_fetch < fetch_window):
+            log('Local mirror {m} was fetched {s:.0f}s ago, reusing it'.format(
+                m=mirror_path, s=fetch_started_at - last_fetch), log_file)
+            return False
+
+        # Update existing git mirror, housekeeping is left to the background mirrors maintenance
+        gcall('git --no-pager -c gc.auto=0 -c maintenance.auto=false fetch --all --tags --prune',
+              'Update local git mirror from remote {r}'.format(r=git_repo),
+              log_file, cwd=mirror_path)
+        git_set_mirror_last_fetch(mirror_path, fetch_started_at)
+    return True
+
+
+def git_fetch_mirror_commit(repo_path, commit, depth, log_file, remote='origin'):
+    """
+    Fetches the commit from the local mirror remote of the working directory, with a history limited to depth commits.
+    Before the git protocol v2, upload-pack only serves the commits which are not a branch or tag tip when allowed
+    by its own config, which local transports do not take from the client '-c' options.
+    """
+    gcall('git --no-pager fetch --depth={d} --upload-pack="git -c uploadpack.allowAnySHA1InWant=true upload-pack" '
+          '{r} {c}'.format(d=depth, r=remote, c=commit),
+          'Git fetch commit {c} from local mirror with depth limited to {d}'.format(c=commit, d=depth),
+          log_file, cwd=repo_path)
+
+
+def git_resolve_submodule_url(parent_url, url):
+    """
+    Returns the absolute url of a submodule, relative urls being relative to the parent repository url
+
+    >>> git_resolve_submodule_url('git@github.com:claranet/ghost.git', '../spaces.git')
+    'git@github.com:claranet/spaces.git'
+    >>> git_resolve_submodule_url('https://github.com/claranet/ghost.git', '../spaces.git')
+    'https://github.com/claranet/spaces.git'
+    >>> git_resolve_submodule_url('https://github.com/claranet/ghost/', './libs/sub.git')
+    'https://github.com/claranet/ghost/libs/sub.git'
+    >>> git_resolve_submodule_url('git@bitbucket.org:ghost.git', '../zabbix.git')
+    'git@bitbucket.org:zabbix.git'
+    >>> git_resolve_submodule_url('git@github.com:claranet/ghost.git', 'git@bitbucket.org:morea/zabbix.git')
+    'git@bitbucket.org:morea/zabbix.git'
+    """
+    if not url.startswith('./') and not url.startswith('../'):
+        return url
+    base = parent_url.rstrip('/')
+    while True:
+        if url.startswith('./'):
+            url = url[2:]
+        elif url.startswith('../'):
+            url = url[3:]
+            index = max(base.rfind('/'), base.rfind(':'))
+            base = base[:index + 1] if base[index] == ':' else base[:index]
+        else:
+            break
+    return base + url if base.endswith(':') else base + '/' + url
+
+
+def git_get_submodules(repo_path):
+    """
+    Returns the submodules declared in the '.gitmodules' file of the working directory
+    as a list of {'name', 'path', 'url'} dicts
+    """
+    if not os.path.isfile(os.path.join(repo_path, '.gitmodules')):
+        return []
+    submodules = {}
+    try:
+        lines = git('--no-pager', 'config', '-f', '.gitmodules', '--get-regexp', r'^submodule\..*\.(path|url)$',
+                    _cwd=repo_path, _tty_out=False, _iter=True)
+        for line in lines:
+            key, _, value = line.strip().partition(' ')
+            name, _, attribute = key[len('submodule.'):].rpartition('.')
+            submodules.setdefault(name, {'name': name})[attribute] = value
+    except ErrorReturnCode_1:
+        # No submodule declared
+        pass
+    return [submodule for name, submodule in sorted(submodules.items()) if 'path' in submodule and 'url' in submodule]
+
+
+def git_get_gitlink_commit(repo_path, path):
+    """
+    Returns the submodule commit recorded in the repository HEAD for path, None if path is not a submodule
+    """
+    entry = git('--no-pager', 'ls-tree', 'HEAD', '--', path, _cwd=repo_path, _tty_out=False).strip()
+    if not entry:
+        return None
+    mode, object_type, commit = entry.split('\t')[0].split()
+    return commit if object_type == 'commit' else None
+
+
+def git_update_submodules(repo_path, repo_url, log_file, fetch_window=0, keep_ignored_files=False):
+    """
+    Checks out the submodules of the working directory recursively from local mirrors, updated with the same
+    coalesced fetches as the module mirrors. The local mirrors are only referenced from '.git/config' during
+    the update, submodules urls are reset to their remote urls afterwards.
+    Files ignored by git are kept if requested, as in the working directory.
+    """
+    clean_command = 'git --no-pager clean -ffd' if keep_ignored_files else 'git --no-pager clean -ffdx'
+    for submodule in git_get_submodules(repo_path):
+        commit = git_get_gitlink_commit(repo_path, submodule['path'])
+        if not commit:
+            continue
+        url = git_resolve_submodule_url(repo_url, submodule['url'])
+        mirror_path = get_mirror_path_from_module({'git_repo': url})
+        submodule_path = os.path.join(repo_path, submodule['path'])
+        git_update_mirror(url, mirror_path, get_lock_path_from_repo(url), log_file, revision=commit,
+                          fetch_window=fetch_window)
+
+        gcall('git --no-pager config "submodule.{n}.url" "{m}"'.format(n=submodule['name'], m=mirror_path),
+              'Git use local mirror for submodule {n}'.format(n=submodule['name']), log_file, cwd=repo_path)
+        if os.path.exists(os.path.join(submodule_path, '.git')):
+            gcall('git --no-pager remote set-url origin "{m}"'.format(m=mirror_path),
+                  'Git use local mirror as submodule {n} origin'.format(n=submodule['name']), log_file,
+                  cwd=submodule_path)
+        gcall('git --no-pager submodule update --init --force -- "{p}"'.format(p=submodule['path']),
+              'Git update submodule {n} at {c}'.format(n=submodule['name'], c=commit), log_file, cwd=repo_path)
+        gcall(clean_command, 'Git remove submodule {n} files left by previous builds'.format(
+            n=submodule['name']), log_file, cwd=submodule_path)
+
+        git_update_submodules(submodule_path, url, log_file, fetch_window, keep_ignored_files)
+
+        gcall('git --no-pager config "submodule.{n}.url" "{u}"'.format(n=submodule['name'], u=url),
+              'Git reset submodule {n} url to {u}'.format(n=submodule['name'], u=url), log_file, cwd=repo_path)
+        gcall('git --no-pager remote set-url origin "{u}"'.format(u=url),
+              'Git reset submodule {n} origin to {u}'.format(n=submodule['name'], u=url), log_file,
+              cwd=submodule_path)
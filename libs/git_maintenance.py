@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Library to run the local git mirrors housekeeping out of the deployment jobs critical path
+"""
+
+import datetime
+import os
+import socket
+import time
+
+from ghost_log import log
+from ghost_tools import GCallException, gcall
+from libs.git_helper import git_get_mirror_last_fetch
+from libs.locks import FairFileLock
+from sh import git
+
+GIT_MIRRORS_ROOT = '/ghost/.mirrors'
+MIRROR_MAINTENANCE_STAMP_FILE = 'ghost-last-maintenance'
+
+DEFAULT_MAINTENANCE_INTERVAL = 6 * 3600
+DEFAULT_MAX_PACKS = 20
+
+
+def is_bare_repository(path):
+    """
+    >>> import tempfile, shutil
+    >>> repo_path = tempfile.mkdtemp()
+    >>> is_bare_repository(repo_path)
+    False
+    >>> os.makedirs(repo_path + '/objects/pack')
+    >>> os.makedirs(repo_path + '/refs')
+    >>> open(repo_path + '/HEAD', 'w').write('ref: refs/heads/master')
+    >>> is_bare_repository(repo_path)
+    True
+    >>> shutil.rmtree(repo_path)
+    """
+    return (os.path.isfile(os.path.join(path, 'HEAD')) and os.path.isdir(os.path.join(path, 'objects'))
+            and os.path.isdir(os.path.join(path, 'refs')))
+
+
+def list_git_mirrors(root=GIT_MIRRORS_ROOT):
+    """
+    Returns the paths of every bare repository under root (locks excluded)
+
+    >>> import tempfile, shutil
+    >>> root = tempfile.mkdtemp()
+    >>> for path in ['git@github.com:claranet/ghost.git', 'git@github.com:claranet/spaces.git', '.locks/git@github.com:claranet/ghost.git']:
+    ...     os.makedirs(root + '/' + path + '/objects')
+    ...     os.makedirs(root + '/' + path + '/refs')
+    ...     open(root + '/' + path + '/HEAD', 'w').write('ref: refs/heads/master')
+    >>> [os.path.relpath(path, root) for path in list_git_mirrors(root)]
+    ['git@github.com:claranet/ghost.git', 'git@github.com:claranet/spaces.git']
+    >>> shutil.rmtree(root)
+    """
+    mirrors = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if dirpath == root and '.locks' in dirnames:
+            dirnames.remove('.locks')
+        if is_bare_repository(dirpath):
+            mirrors.append(dirpath)
+            # Do not walk through the repository content
+            del dirnames[:]
+        dirnames.sort()
+    return mirrors
+
+
+def get_mirror_lock_path(mirror_path, root=GIT_MIRRORS_ROOT):
+    """
+    Returns the lock path used by jobs updating the mirror
+
+    >>> get_mirror_lock_path('/ghost/.mirrors/git@github.com:claranet/ghost.git')
+    '/ghost/.mirrors/.locks/git@github.com:claranet/ghost.git'
+    """
+    return os.path.join(root, '.locks', os.path.relpath(mirror_path, root))
+
+
+def get_directory_size(path):
+    """
+    Returns the disk usage of a directory in bytes
+
+    >>> import tempfile, shutil
+    >>> path = tempfile.mkdtemp()
+    >>> open(path + '/file', 'w').write('1234')
+    >>> get_directory_size(path)
+    4
+    >>> shutil.rmtree(path)
+    """
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def get_mirror_objects_stats(mirror_path):
+    """
+    Returns the objects statistics of the mirror, as reported by 'git count-objects -v'
+    """
+    stats = {}
+    for line in git('--no-pager', 'count-objects', '-v', _cwd=mirror_path, _tty_out=False, _iter=True):
+        key, _, value = line.strip().partition(': ')
+        if value.isdigit():
+            stats[key.replace('-', '_')] = int(value)
+    return stats
+
+
+def get_mirror_last_maintenance(mirror_path):
+    try:
+        with open(os.path.join(mirror_path, MIRROR_MAINTENANCE_STAMP_FILE)) as f:
+            return float(f.read().strip())
+    except (IOError, ValueError):
+        return None
+
+
+def maintain_git_mirror(mirror_path, log_file, max_packs=DEFAULT_MAX_PACKS):
+    """
+    Runs the housekeeping of a mirror: objects repacking, pruning, refs packing and commit-graph write
+    The caller must hold the mirror lock
+    """
+    packs = get_mirror_objects_stats(mirror_path).get('packs', 0)
+    if packs > max_packs:
+        gcall('git --no-pager repack -a -d -l', 'Repack all objects of {m} ({p} packs)'.format(m=mirror_path, p=packs),
+              log_file, cwd=mirror_path)
+    else:
+        gcall('git --no-pager repack -d -l', 'Pack loose objects of {m}'.format(m=mirror_path), log_file,
+              cwd=mirror_path)
+    gcall('git --no-pager prune --expire=2.weeks.ago', 'Prune unreachable objects of {m}'.format(m=mirror_path),
+          log_file, cwd=mirror_path)
+    gcall('git --no-pager pack-refs --all', 'Pack refs of {m}'.format(m=mirror_path), log_file, cwd=mirror_path)
+    try:
+        gcall('git --no-pager commit-graph write --reachable', 'Write commit-graph of {m}'.format(m=mirror_path),
+              log_file, cwd=mirror_path)
+    except GCallException:
+        # Not supported by git < 2.18
+        log('Unable to write commit-graph of {m}, skipping'.format(m=mirror_path), log_file)
+    with open(os.path.join(mirror_path, MIRROR_MAINTENANCE_STAMP_FILE), 'w') as f:
+        f.write(repr(time.time()))
+
+
+def get_git_mirror_stats(mirror_path):
+    objects_stats = get_mirror_objects_stats(mirror_path)
+    last_maintenance = get_mirror_last_maintenance(mirror_path)
+    last_fetch = git_get_mirror_last_fetch(mirror_path)
+    return {
+        'host': socket.gethostname(),
+        'path': mirror_path,
+        'size': get_directory_size(mirror_path),
+        'packs': objects_stats.get('packs', 0),
+        'loose_objects': objects_stats.get('count', 0),
+        'last_maintenance': datetime.datetime.utcfromtimestamp(last_maintenance) if last_maintenance else None,
+        'last_fetch': datetime.datetime.utcfromtimestamp(last_fetch) if last_fetch else None,
+        '_updated': datetime.datetime.utcnow(),
+    }
+
+
+def maintain_git_mirrors(config, stats_collection, log_file, root=GIT_MIRRORS_ROOT):
+    """
+    Runs the housekeeping of every local mirror not maintained for the configured interval and stores
+    the mirrors statistics. Mirrors currently locked by a job are skipped until the next run.
+    """
+    interval = int(config.get('git_mirrors_maintenance_interval', DEFAULT_MAINTENANCE_INTERVAL))
+    max_packs = int(config.get('git_mirrors_maintenance_max_packs', DEFAULT_MAX_PACKS))
+    mirrors = list_git_mirrors(root)
+    for mirror_path in mirrors:
+        last_maintenance = get_mirror_last_maintenance(mirror_path)
+        if not last_maintenance or time.time() - last_maintenance >= interval:
+            lock = FairFileLock(get_mirror_lock_path(mirror_path, root), log_file,
+                                'on git mirror {m}'.format(m=mirror_path))
+            if lock.acquire(blocking=False):
+                start = time.time()
+                try:
+                    maintain_git_mirror(mirror_path, log_file, max_packs)
+                    log('Maintenance of {m} done in {s:.1f}s'.format(m=mirror_path, s=time.time() - start),
+                        log_file)
+                except GCallException as e:
+                    log('Maintenance of {m} failed: {e}'.format(m=mirror_path, e=e), log_file)
+                finally:
+                    lock.release()
+            else:
+                log('Mirror {m} is in use, maintenance postponed'.format(m=mirror_path), log_file)
+            stats = get_git_mirror_stats(mirror_path)
+            stats_collection.update({'host': stats['host'], 'path': mirror_path}, {'$set': stats}, upsert=True)
+    # Forget the mirrors removed from this host
+    stats_collection.remove({'host': socket.gethostname(), 'path': {'$nin': mirrors}})
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Library collecting the deploy results sent by stage2 runs to the Ghost API.
+    Each stage2 `notify_status` POST is stored by job, run and host in the host_deploy_results collection and
+    published on the Redis channel of the job, so that the job waiting for a detached stage2 run (and the web UI)
+    get the results of the hosts as soon as they are known.
+"""
+
+import datetime
+import hashlib
+import hmac
+import json
+import time
+import uuid
+from collections import OrderedDict
+
+from ghost_log import log
+from libs.ssh_executor import HOST_STATUS_FAILED, HOST_STATUS_SUCCESS, HOST_STATUS_TIMEOUT, get_host_result
+
+HOST_DEPLOY_RESULTS_CHANNEL_PREFIX = 'ghost:host_deploy_results:'
+HOST_DEPLOY_STATUSES = ['starting', 'started', 'done', 'failed']
+HOST_DEPLOY_FINAL_STATUSES = ['done', 'failed']
+
+DEFAULT_HOST_DEPLOY_RESULTS_TIMEOUT = 1800
+
+# Interval in seconds between two reads of the stored results, in case a published result was missed
+RESULTS_REFRESH_INTERVAL = 10
+
+
+class HostDeployResultError(ValueError):
+    pass
+
+
+def get_host_deploy_results_channel(job_id):
+    """
+    >>> get_host_deploy_results_channel('5a0d3e08a2b9c2b5a1234567')
+    'ghost:host_deploy_results:5a0d3e08a2b9c2b5a1234567'
+    """
+    return HOST_DEPLOY_RESULTS_CHANNEL_PREFIX + str(job_id)
+
+
+def get_host_deploy_results_token(secret, job_id):
+    """
+    Returns the token authenticating the results of the job sent by instances
+
+    >>> get_host_deploy_results_token('s3cr3t', '5a0d3e08a2b9c2b5a1234567') == get_host_deploy_results_token(
+    ...     's3cr3t', '5a0d3e08a2b9c2b5a1234567')
+    True
+    >>> get_host_deploy_results_token('s3cr3t', '5a0d3e08a2b9c2b5a1234567') == get_host_deploy_results_token(
+    ...     'other', '5a0d3e08a2b9c2b5a1234567')
+    False
+    """
+    return hmac.new(str(secret), str(job_id), hashlib.sha256).hexdigest()
+
+
+def check_host_deploy_results_token(secret, job_id, token):
+    """
+    >>> check_host_deploy_results_token('s3cr3t', '5a0d', get_host_deploy_results_token('s3cr3t', '5a0d'))
+    True
+    >>> check_host_deploy_results_token('s3cr3t', '5a0d', 'invalid')
+    False
+    >>> check_host_deploy_results_token('', '5a0d', get_host_deploy_results_token('', '5a0d'))
+    False
+    """
+    return bool(secret) and hmac.compare_digest(get_host_deploy_results_token(secret, job_id), str(token or ''))
+
+
+def parse_host_deploy_result(payload):
+    """
+    Returns the result of a stage2 notify_status payload
+
+    >>> result = parse_host_deploy_result({'status': 'done', 'return_code': 0, 'hostname': 'web-10-0-0-1',
+    ...                                    'ip': '10.0.0.1'})
+    >>> sorted(result.items())
+    [('host', '10.0.0.1'), ('hostname', 'web-10-0-0-1'), ('return_code', 0), ('status', 'done')]
+    >>> parse_host_deploy_result({'status': 'started', 'hostname': 'web-10-0-0-1', 'ip': '10.0.0.1'})['return_code']
+    >>> parse_host_deploy_result({'status': 'unknown', 'ip': '10.0.0.1'})
+    Traceback (most recent call last):
+    HostDeployResultError: Invalid status: unknown
+    >>> parse_host_deploy_result({'status': 'done', 'return_code': 0})
+    Traceback (most recent call last):
+    HostDeployResultError: Missing host ip
+    """
+    if not isinstance(payload, dict):
+        raise HostDeployResultError('Invalid payload')
+    if payload.get('status') not in HOST_DEPLOY_STATUSES:
+        raise HostDeployResultError('Invalid status: {0}'.format(payload.get('status')))
+    if not payload.get('ip'):
+        raise HostDeployResultError('Missing host ip')
+    return_code = payload.get('return_code')
+    if return_code is not None and not isinstance(return_code, int):
+        raise HostDeployResultError('Invalid return code: {0}'.format(return_code))
+    return {
+        'host': str(payload['ip']),
+        'hostname': payload.get('hostname'),
+        'status': payload['status'],
+        'return_code': return_code,
+    }
+
+
+def format_host_deploy_result(document):
+    """
+    Returns the stored result as published on the job channel
+
+    >>> document = {'_id': 1, 'job_id': '5a0d', 'run_id': '0d23', 'host': '10.0.0.1', 'status': 'started',
+    ...             '_updated': datetime.datetime(2018, 2, 8, 16, 34, 44)}
+    >>> sorted(format_host_deploy_result(document).items())
+    [('_updated', '2018-02-08T16:34:44'), ('host', '10.0.0.1'), ('job_id', '5a0d'), ('run_id', '0d23'), ('status', 'started')]
+    """
+    return dict((name, value.isoformat() if isinstance(value, datetime.datetime) else value)
+                for name, value in document.items() if name not in ['_id', '_created'])
+
+
+def record_host_deploy_result(collection, redis_connection, job_id, run_id, result):
+    """
+    Stores the result of the host for the stage2 run of the job and publishes it on the job channel
+    """
+    now = datetime.datetime.utcnow()
+    document = dict(result, job_id=str(job_id), run_id=run_id, _updated=now)
+    collection.update({'job_id': document['job_id'], 'run_id': run_id, 'host': result['host']},
+                      {'$set': document, '$setOnInsert': {'_created': now}}, upsert=True)
+    redis_connection.publish(get_host_deploy_results_channel(job_id), json.dumps(format_host_deploy_result(document)))
+
+
+def get_host_deploy_results_collector(config, job_id, collection, redis_connection):
+    """
+    Returns the collector of the job when instances can send their results to the Ghost API, None otherwise
+
+    >>> get_host_deploy_results_collector({}, '5a0d', None, None)
+    >>> config = {'host_deploy_results_endpoint': 'https://ghost.example.com/', 'host_deploy_results_secret': 's'}
+    >>> get_host_deploy_results_collector(config, '5a0d', None, None)._endpoint
+    'https://ghost.example.com'
+    """
+    if not config.get('host_deploy_results_endpoint') or not config.get('host_deploy_results_secret'):
+        return None
+    return HostDeployResultsCollector(job_id, collection, redis_connection,
+                                      config['host_deploy_results_endpoint'], config['host_deploy_results_secret'],
+                                      config.get('host_deploy_results_timeout', DEFAULT_HOST_DEPLOY_RESULTS_TIMEOUT))
+
+
+class HostDeployResultsCollector(object):
+    """
+    Results of the detached stage2 runs of a job: each run gets its own notification URL on the Ghost API, and the
+    job waits for the results of the run hosts, at most timeout seconds
+    """
+
+    def __init__(self, job_id, collection, redis_connection, endpoint, secret, timeout):
+        self._job_id = str(job_id)
+        self._collection = collection
+        self._redis_connection = redis_connection
+        self._endpoint = endpoint.rstrip('/')
+        self._secret = secret
+        self._timeout = float(timeout)
+
+    def new_run(self):
+        """
+        Returns the id and the notification URL of a new stage2 run
+        """
+        run_id = uuid.uuid4().hex
+        return run_id, '{e}/jobs/{j}/host_deploy_results/{r}?token={t}'.format(
+            e=self._endpoint, j=self._job_id, r=run_id, t=get_host_deploy_results_token(self._secret, self._job_id))
+
+    def _set_results(self, results, run_id, documents, start):
+        for document in documents:
+            host = document.get('host')
+            if document.get('run_id') != run_id or document.get('status') not in HOST_DEPLOY_FINAL_STATUSES:
+                continue
+            if host not in results or results[host] is not None:
+                continue
+            return_code = document.get('return_code')
+            if document['status'] == 'done' and not return_code:
+                results[host] = get_host_result(HOST_STATUS_SUCCESS, 0, time.time() - start)
+            else:
+                results[host] = get_host_result(HOST_STATUS_FAILED, return_code, time.time() - start,
+                                                'exited with code {0}'.format(return_code))
+
+    def wait(self, run_id, hosts, log_file):
+        """
+        Waits for the final results of the hosts of the stage2 run
+        Returns the results by host, in hosts order, hosts without result being timed out
+        """
+        results = OrderedDict((host, None) for host in hosts)
+        start = time.time()
+        pubsub = self._redis_connection.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(get_host_deploy_results_channel(self._job_id))
+        try:
+            refreshed = 0
+            done = 0
+            while None in results.values() and time.time() - start < self._timeout:
+                if time.time() - refreshed > RESULTS_REFRESH_INTERVAL:
+                    # Results stored before the subscription, or not received from the channel
+                    self._set_results(results, run_id, self._collection.find({'job_id': self._job_id,
+                                                                             'run_id': run_id}), start)
+                    refreshed = time.time()
+                message = pubsub.get_message(timeout=1.0)
+                if message and message['type'] == 'message':
+                    self._set_results(results, run_id, [json.loads(message['data'])], start)
+                reported = len([result for result in results.values() if result])
+                if reported != done:
+                    done = reported
+                    log("Host deploy results: {0}/{1} instance(s) done".format(done, len(hosts)), log_file)
+        finally:
+            pubsub.close()
+
+        for host, result in results.items():
+            if result is None:
+                results[host] = get_host_result(HOST_STATUS_TIMEOUT, None, time.time() - start,
+                                                'no deploy result after {0:.0f}s'.format(self._timeout))
+        return results
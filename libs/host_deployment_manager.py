@@ -26,12 +26,13 @@ import time
 from ghost_tools import GCallException
 from ghost_tools import log, split_hosts_list
 from libs import load_balancing
+from libs.timings import PhaseTimer
 
 from ghost_aws import get_autoscaling_group_and_processes_to_suspend
 from ghost_aws import suspend_autoscaling_group_processes, resume_autoscaling_group_processes
 
 from .blue_green import get_blue_green_from_app
-from .deploy import launch_deploy, launch_executescript
+from .deploy import is_deployment_agent_enabled, launch_agent_deploy, launch_deploy, launch_executescript
 from .ec2 import find_ec2_pending_instances, find_ec2_running_instances
 
 
@@ -39,15 +40,22 @@ class HostDeploymentManager:
     """ Class which will manage the host deployment process """
 
     def __init__(self, cloud_connection, app, module, log_file, safe_infos, fabric_exec_strategy, deployment_type=None,
-                 execute_script_params=None):
+                 execute_script_params=None, timer=None, hosts_results_recorder=None, ssh_pool=None,
+                 host_deploy_results=None):
         """
-            :param  module:               dict: Ghost object wich describe the module parameters.
+            :param  module:               dict: Ghost object wich describe the module parameters, or a list of
+                                          modules deployed in order with a single stage2 run by host.
             :param  app:                  dict: Ghost object which describe the application parameters.
             :param  log_file:             object for logging
             :param  safe_infos:           dict: The safe deployment parameters.
             :param  fabric_exec_strategy: string: Deployment strategy(serial or parrallel).
             :param  deployment_type:      string: Deploy or Executescript
             :param execute_script_params: dict: All necessary params for `launch_executescript`
+            :param  timer:                PhaseTimer: Records the host pushes and load balancers waits durations
+            :param  hosts_results_recorder: function: Called with the results by host of each push
+            :param  ssh_pool:             SSHConnectionPool: Connections to instances shared by the job
+            :param  host_deploy_results:  HostDeployResultsCollector: Results sent by instances to the Ghost API,
+                                          if any: stage2 then runs detached from the SSH sessions
         """
         self._cloud_connection = cloud_connection
         self._app = app
@@ -59,6 +67,10 @@ class HostDeploymentManager:
         self._as_name = None
         self._deployment_type = deployment_type
         self._execute_script_params = execute_script_params
+        self._timer = timer or PhaseTimer()
+        self._hosts_results_recorder = hosts_results_recorder
+        self._ssh_pool = ssh_pool
+        self._host_deploy_results = host_deploy_results
 
     def elb_safe_deployment(self, instances_list):
         """ Manage the safe deployment process for the ELB.
@@ -79,26 +91,28 @@ class HostDeploymentManager:
         elif len([i for i in elb_instances.values() if 'outofservice' in i.values()]):
             raise GCallException('Cannot continue because one or more instances are in the out of service state')
         else:
-            lb_mgr.deregister_instances_from_lbs(self._as_name, [host['id'] for host in instances_list],
-                                                 self._log_file)
-            wait_before_deploy = int(lb_mgr.get_lbs_max_connection_draining_value(self._as_name)) + int(
-                self._safe_infos['wait_before_deploy'])
-            log('Waiting {0}s: The connection draining time plus the custom value set for wait_before_deploy'.format(
-                wait_before_deploy), self._log_file)
-            time.sleep(wait_before_deploy)
+            with self._timer.phase('lb_wait'):
+                lb_mgr.deregister_instances_from_lbs(self._as_name, [host['id'] for host in instances_list],
+                                                     self._log_file)
+                wait_before_deploy = int(lb_mgr.get_lbs_max_connection_draining_value(self._as_name)) + int(
+                    self._safe_infos['wait_before_deploy'])
+                log('Waiting {0}s: The connection draining time plus the custom value set for wait_before_deploy'.format(
+                    wait_before_deploy), self._log_file)
+                time.sleep(wait_before_deploy)
 
             host_list = [host['private_ip_address'] for host in instances_list]
             self.trigger_launch(host_list)
 
-            log('Waiting {0}s: The value set for wait_after_deploy'.format(self._safe_infos['wait_after_deploy']),
-                self._log_file)
-            time.sleep(int(self._safe_infos['wait_after_deploy']))
-            lb_mgr.register_instances_from_lbs(self._as_name, [host['id'] for host in instances_list],
-                                               self._log_file)
-            while len([i for i in lb_mgr.get_instances_status_from_autoscale(self._as_name, self._log_file).values() if
-                       'outofservice' in i.values()]):
-                log('Waiting 10s because the instance is not in service in the ELB', self._log_file)
-                time.sleep(10)
+            with self._timer.phase('lb_wait'):
+                log('Waiting {0}s: The value set for wait_after_deploy'.format(self._safe_infos['wait_after_deploy']),
+                    self._log_file)
+                time.sleep(int(self._safe_infos['wait_after_deploy']))
+                lb_mgr.register_instances_from_lbs(self._as_name, [host['id'] for host in instances_list],
+                                                   self._log_file)
+                while len([i for i in lb_mgr.get_instances_status_from_autoscale(self._as_name, self._log_file).values() if
+                           'outofservice' in i.values()]):
+                    log('Waiting 10s because the instance is not in service in the ELB', self._log_file)
+                    time.sleep(10)
             log('Instances: {0} have been deployed and are registered in their ELB'.format(
                 str([host['private_ip_address'] for host in instances_list])), self._log_file)
             return True
@@ -124,28 +138,30 @@ class HostDeploymentManager:
         elif len([i for i in alb_targets.values() if 'unhealthy' in i.values()]):
             raise GCallException('Cannot continue because one or more instances are in the unhealthy state')
         else:
-            alb_mgr.deregister_instances_from_lbs(self._as_name,
-                                                  [host['id'] for host in instances_list],
-                                                  self._log_file)
-            wait_before_deploy = int(alb_mgr.get_lbs_max_connection_draining_value(self._as_name)) + int(
-                self._safe_infos['wait_before_deploy'])
-            log('Waiting {0}s: The deregistation delay time plus the custom value set for wait_before_deploy'.format(
-                wait_before_deploy), self._log_file)
-            time.sleep(wait_before_deploy)
+            with self._timer.phase('lb_wait'):
+                alb_mgr.deregister_instances_from_lbs(self._as_name,
+                                                      [host['id'] for host in instances_list],
+                                                      self._log_file)
+                wait_before_deploy = int(alb_mgr.get_lbs_max_connection_draining_value(self._as_name)) + int(
+                    self._safe_infos['wait_before_deploy'])
+                log('Waiting {0}s: The deregistation delay time plus the custom value set for wait_before_deploy'.format(
+                    wait_before_deploy), self._log_file)
+                time.sleep(wait_before_deploy)
 
             host_list = [host['private_ip_address'] for host in instances_list]
             self.trigger_launch(host_list)
 
-            log('Waiting {0}s: The value set for wait_after_deploy'.format(self._safe_infos['wait_after_deploy']),
-                self._log_file)
-            time.sleep(int(self._safe_infos['wait_after_deploy']))
-            alb_mgr.register_instances_from_lbs(self._as_name,
-                                                [host['id'] for host in instances_list],
-                                                self._log_file)
-            while len([i for i in alb_mgr.get_instances_status_from_autoscale(self._as_name, self._log_file).values() if
-                       'unhealthy' in i.values()]):
-                log('Waiting 10s because the instance is unhealthy in the ALB', self._log_file)
-                time.sleep(10)
+            with self._timer.phase('lb_wait'):
+                log('Waiting {0}s: The value set for wait_after_deploy'.format(self._safe_infos['wait_after_deploy']),
+                    self._log_file)
+                time.sleep(int(self._safe_infos['wait_after_deploy']))
+                alb_mgr.register_instances_from_lbs(self._as_name,
+                                                    [host['id'] for host in instances_list],
+                                                    self._log_file)
+                while len([i for i in alb_mgr.get_instances_status_from_autoscale(self._as_name, self._log_file).values() if
+                           'unhealthy' in i.values()]):
+                    log('Waiting 10s because the instance is unhealthy in the ALB', self._log_file)
+                    time.sleep(10)
             log('Instances: {0} have been deployed and are registered in their ALB'.format(
                 str([host['private_ip_address'] for host in instances_list])), self._log_file)
             return True
@@ -180,26 +196,28 @@ class HostDeploymentManager:
             if not self.haproxy_configuration_validation(hapi, ha_urls, self._safe_infos['ha_backend']):
                 raise GCallException('Cannot initialize the safe deployment process because there are differences in the Haproxy \
                                       configuration files between the instances: {0}'.format(lb_infos))
-            if not hapi.change_instance_state('disableserver', self._safe_infos['ha_backend'],
-                                              [host['private_ip_address'] for host in instances_list]):
-                raise GCallException(
-                    'Cannot disable some instances: {0} in {1}. Deployment aborted'.format(instances_list, lb_infos))
-            log('Waiting {0}s: The value set for wait_before_deploy'.format(self._safe_infos['wait_before_deploy']),
-                self._log_file)
-            time.sleep(int(self._safe_infos['wait_before_deploy']))
+            with self._timer.phase('lb_wait'):
+                if not hapi.change_instance_state('disableserver', self._safe_infos['ha_backend'],
+                                                  [host['private_ip_address'] for host in instances_list]):
+                    raise GCallException(
+                        'Cannot disable some instances: {0} in {1}. Deployment aborted'.format(instances_list, lb_infos))
+                log('Waiting {0}s: The value set for wait_before_deploy'.format(self._safe_infos['wait_before_deploy']),
+                    self._log_file)
+                time.sleep(int(self._safe_infos['wait_before_deploy']))
 
             host_list = [host['private_ip_address'] for host in instances_list]
             self.trigger_launch(host_list)
 
-            log('Waiting {0}s: The value set for wait_after_deploy'.format(self._safe_infos['wait_after_deploy']),
-                self._log_file)
-            time.sleep(int(self._safe_infos['wait_after_deploy']))
-            if not hapi.change_instance_state('enableserver', self._safe_infos['ha_backend'],
-                                              [host['private_ip_address'] for host in instances_list]):
-                raise GCallException(
-                    'Cannot enabled some instances: {0} in {1}. Deployment aborted'.format(instances_list, lb_infos))
-            # Add a sleep to let the time to pass the health check process
-            time.sleep(5)
+            with self._timer.phase('lb_wait'):
+                log('Waiting {0}s: The value set for wait_after_deploy'.format(self._safe_infos['wait_after_deploy']),
+                    self._log_file)
+                time.sleep(int(self._safe_infos['wait_after_deploy']))
+                if not hapi.change_instance_state('enableserver', self._safe_infos['ha_backend'],
+                                                  [host['private_ip_address'] for host in instances_list]):
+                    raise GCallException(
+                        'Cannot enabled some instances: {0} in {1}. Deployment aborted'.format(instances_list, lb_infos))
+                # Add a sleep to let the time to pass the health check process
+                time.sleep(5)
             if not self.haproxy_configuration_validation(hapi, ha_urls, self._safe_infos['ha_backend']):
                 raise GCallException('Error in the post safe deployment process because there are differences in the Haproxy \
                                     configuration files between the instances: {0}. Instances: {1} have been deployed but not well enabled'.format(
@@ -217,14 +235,21 @@ class HostDeploymentManager:
                                                          self._app['region']))
 
     def trigger_launch(self, host_list):
-        if self._deployment_type == 'executescript':
-            launch_executescript(self._app,
-                                 self._execute_script_params['script'], self._execute_script_params['context_path'],
-                                 self._execute_script_params['sudoer_uid'], self._execute_script_params['jobid'],
-                                 host_list, self._fabric_exec_strategy, self._log_file,
-                                 self._execute_script_params['env_vars'])
-        else:
-            launch_deploy(self._app, self._module, host_list, self._fabric_exec_strategy, self._log_file)
+        with self._timer.phase('host_push'):
+            if self._deployment_type == 'executescript':
+                launch_executescript(self._app,
+                                     self._execute_script_params['script'], self._execute_script_params['context_path'],
+                                     self._execute_script_params['sudoer_uid'], self._execute_script_params['jobid'],
+                                     host_list, self._fabric_exec_strategy, self._log_file,
+                                     self._execute_script_params['env_vars'], self._hosts_results_recorder,
+                                     self._ssh_pool)
+            elif is_deployment_agent_enabled():
+                # The instances agents deploy the release by themselves, no SSH session is held while they do
+                launch_agent_deploy(self._app, self._module, host_list, self._fabric_exec_strategy, self._log_file,
+                                    self._hosts_results_recorder, self._ssh_pool, self._host_deploy_results)
+            else:
+                launch_deploy(self._app, self._module, host_list, self._fabric_exec_strategy, self._log_file,
+                              self._hosts_results_recorder, self._ssh_pool, self._host_deploy_results)
 
     def safe_manager(self, safe_strategy):
         """  Global manager for the safe deployment process.
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Library providing fair inter-process locks based on fcntl file locks
+"""
+
+import errno
+import fcntl
+import os
+import tempfile
+import time
+
+from ghost_log import log
+
+COUNTER_FILE_NAME = '.counter'
+TICKET_NAME_FORMAT = '{0:012d}'
+
+
+def _set_cloexec(fd):
+    """
+    Prevents child processes (git, buildpacks...) from inheriting lock files descriptors
+    """
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+
+def _open_locked(path, flags, operation):
+    """
+    Opens path and applies the fcntl.flock operation on it.
+    Returns the file descriptor, None if the lock is held by another process (non blocking operation).
+    """
+    fd = os.open(path, flags, 0o644)
+    _set_cloexec(fd)
+    try:
+        fcntl.flock(fd, operation)
+    except IOError as e:
+        os.close(fd)
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    except:
+        os.close(fd)
+        raise
+    return fd
+
+
+class FairFileLock(object):
+    """
+    Inter-process lock granted in request order.
+
+    Each requester takes a numbered ticket in the lock directory and holds an exclusive fcntl lock on it
+    until it releases the lock. A requester waits on the lock of the ticket just before its own, so it is
+    woken up as soon as the previous one is done. The kernel drops the locks of dead processes, so their
+    tickets are detected as stale and removed by the next requester.
+
+    >>> import shutil
+    >>> from StringIO import StringIO
+    >>> lock_dir = tempfile.mkdtemp()
+    >>> lock = FairFileLock(lock_dir + '/repo', StringIO())
+    >>> lock.acquire()
+    True
+    >>> FairFileLock(lock_dir + '/repo', StringIO()).acquire(blocking=False)
+    False
+    >>> lock.release()
+    >>> with FairFileLock(lock_dir + '/repo', StringIO()):
+    ...     FairFileLock(lock_dir + '/repo', StringIO()).acquire(blocking=False)
+    False
+    >>> FairFileLock(lock_dir + '/repo', StringIO()).acquire(blocking=False)
+    True
+
+    A ticket left by a dead process (no fcntl lock on it) does not block anyone:
+
+    >>> shutil.rmtree(lock_dir)
+    >>> os.makedirs(lock_dir + '/repo')
+    >>> open(lock_dir + '/repo/000000000001', 'w').write('12345')
+    >>> open(lock_dir + '/repo/.counter', 'w').write('1')
+    >>> lock = FairFileLock(lock_dir + '/repo', StringIO())
+    >>> lock.acquire(blocking=False)
+    True
+    >>> sorted(os.listdir(lock_dir + '/repo'))
+    ['.counter', '000000000002']
+    >>> lock.release()
+    >>> shutil.rmtree(lock_dir)
+    """
+
+    def __init__(self, path, log_file, description=None):
+        self._path = path
+        self._log_file = log_file
+        self._description = description or path
+        self._ticket_path = None
+        self._ticket_fd = None
+
+    def _take_ticket(self):
+        try:
+            os.makedirs(self._path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        counter_fd = _open_locked(os.path.join(self._path, COUNTER_FILE_NAME), os.O_RDWR | os.O_CREAT, fcntl.LOCK_EX)
+        try:
+            try:
+                ticket = int(os.read(counter_fd, 32).strip() or 0) + 1
+            except ValueError:
+                ticket = 1
+            os.lseek(counter_fd, 0, os.SEEK_SET)
+            os.ftruncate(counter_fd, 0)
+            os.write(counter_fd, str(ticket))
+
+            # Tickets are locked before being published, and published in order while holding the counter lock:
+            # a published ticket which is not locked always belongs to a dead process
+            fd, tmp_path = tempfile.mkstemp(dir=self._path, prefix='.ticket-')
+            _set_cloexec(fd)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.write(fd, str(os.getpid()))
+            self._ticket_fd = fd
+            self._ticket_path = os.path.join(self._path, TICKET_NAME_FORMAT.format(ticket))
+            os.rename(tmp_path, self._ticket_path)
+        finally:
+            os.close(counter_fd)
+
+    def _drop_ticket(self):
+        try:
+            os.unlink(self._ticket_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        finally:
+            # Closing the descriptor releases the fcntl lock and wakes the next requester up
+            os.close(self._ticket_fd)
+            self._ticket_fd = self._ticket_path = None
+
+    def _get_predecessors(self):
+        own_ticket = os.path.basename(self._ticket_path)
+        return sorted(name for name in os.listdir(self._path) if name.isdigit() and name < own_ticket)
+
+    def _get_ticket_pid(self, ticket):
+        try:
+            with open(os.path.join(self._path, ticket)) as f:
+                return f.read().strip() or 'unknown'
+        except IOError:
+            return 'unknown'
+
+    def _wait_for_ticket(self, ticket, blocking):
+        """
+        Waits for the given ticket to be released
+        Returns False if it is still held and blocking is False
+        """
+        ticket_path = os.path.join(self._path, ticket)
+        try:
+            fd = _open_locked(ticket_path, os.O_RDONLY, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                # Released in the meantime
+                return True
+            raise
+        if fd is None:
+            return False
+        try:
+            # Owners remove their ticket before releasing its lock, a remaining ticket is a stale one
+            if os.path.exists(ticket_path):
+                log("Removing stale lock ticket {t} of dead process {p}".format(
+                    t=ticket_path, p=self._get_ticket_pid(ticket)), self._log_file)
+                os.unlink(ticket_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        finally:
+            os.close(fd)
+        return True
+
+    def acquire(self, blocking=True):
+        """
+        Acquires the lock, waiting for previous requesters if blocking is True
+        Returns True if the lock is acquired
+        """
+        start = time.time()
+        self._take_ticket()
+        waiting = False
+        try:
+            while True:
+                predecessors = self._get_predecessors()
+                if not predecessors:
+                    break
+                if blocking and not waiting:
+                    waiting = True
+                    log("Waiting for lock {d} held by process {p} ({n} request(s) ahead)".format(
+                        d=self._description, p=self._get_ticket_pid(predecessors[0]), n=len(predecessors)),
+                        self._log_file)
+                if not self._wait_for_ticket(predecessors[-1], blocking):
+                    self._drop_ticket()
+                    return False
+        except:
+            self._drop_ticket()
+            raise
+        if waiting:
+            log("Lock {d} acquired after waiting {s:.1f}s".format(d=self._description, s=time.time() - start),
+                self._log_file)
+        else:
+            log("Lock {d} acquired".format(d=self._description), self._log_file)
+        return True
+
+    def release(self):
+        if self._ticket_fd is not None:
+            self._drop_ticket()
+            log("Lock {d} released".format(d=self._description), self._log_file)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+JOB_LOCKS_ROOT = '/ghost/.locks/jobs'
+
+
+class JobLockRegistry(object):
+    """
+    Registry of the jobs running on this host.
+
+    A running job holds an exclusive fcntl lock on a file named by each of its ids (job id, log id), so that
+    housekeeping processes never remove the files of a running job. The kernel drops the locks of dead processes.
+
+    >>> import shutil
+    >>> root = tempfile.mkdtemp()
+    >>> registry = JobLockRegistry(root)
+    >>> registry.register('5a0d3e08a2b9c2b5a1234567')
+    >>> JobLockRegistry(root).is_running('5a0d3e08a2b9c2b5a1234567')
+    True
+    >>> registry.unregister('5a0d3e08a2b9c2b5a1234567')
+    >>> JobLockRegistry(root).is_running('5a0d3e08a2b9c2b5a1234567')
+    False
+    >>> shutil.rmtree(root)
+    """
+
+    def __init__(self, root=JOB_LOCKS_ROOT):
+        self._root = root
+        self._fds = {}
+
+    def _get_path(self, job_id):
+        return os.path.join(self._root, str(job_id))
+
+    def register(self, job_id):
+        try:
+            os.makedirs(self._root)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd = _open_locked(self._get_path(job_id), os.O_RDWR | os.O_CREAT, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if fd is None:
+            raise RuntimeError("Job {0} is already registered by another process".format(job_id))
+        os.write(fd, str(os.getpid()))
+        self._fds[str(job_id)] = fd
+
+    def unregister(self, job_id):
+        fd = self._fds.pop(str(job_id), None)
+        if fd is None:
+            return
+        try:
+            os.unlink(self._get_path(job_id))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        finally:
+            os.close(fd)
+
+    def is_running(self, job_id):
+        try:
+            fd = _open_locked(self._get_path(job_id), os.O_RDONLY, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        if fd is None:
+            return True
+        os.close(fd)
+        return False
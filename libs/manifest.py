@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Library to read and update the app MANIFEST stored in S3, which names the package deployed for each module.
+    Each line is `module:package:path`, followed by `:key` for packages stored outside of the module S3 path
+    (in the content-addressed package store).
+    The MANIFEST is loaded once per job, updated in memory, and written back with conditional S3 requests so that
+    concurrent jobs on the same app path do not overwrite each other.
+"""
+
+import datetime
+import sys
+from collections import OrderedDict
+
+from boto.exception import S3ResponseError
+
+from ghost_log import log
+from ghost_tools import GCallException
+
+MANIFEST_WRITE_RETRIES = 3
+
+# S3 statuses of a conditional write lost against a concurrent write
+MANIFEST_CONFLICT_STATUSES = (409, 412)
+
+
+def parse_manifest(content):
+    """
+    Returns the modules of a MANIFEST as an ordered dict of (package, path, key) by module name
+
+    >>> parse_manifest('mod1:1485857801_mod1_0d23e96:/var/www\\nmod2:1485857802_mod2_a1b2c3d:/var/www/mod2\\n')
+    OrderedDict([('mod1', ('1485857801_mod1_0d23e96', '/var/www', None)), ('mod2', ('1485857802_mod2_a1b2c3d', '/var/www/mod2', None))])
+    >>> parse_manifest('mod1:1485857801_mod1_0d23e96:/var/www:ghost/.packages/d41d8cd9\\n')
+    OrderedDict([('mod1', ('1485857801_mod1_0d23e96', '/var/www', 'ghost/.packages/d41d8cd9'))])
+    >>> parse_manifest('')
+    OrderedDict()
+    """
+    entries = OrderedDict()
+    for line in content.split('\n'):
+        if line:
+            fields = line.split(':')
+            entries[fields[0]] = (fields[1], fields[2], fields[3] if len(fields) > 3 and fields[3] else None)
+    return entries
+
+
+def format_manifest(entries, module_names):
+    """
+    Returns the MANIFEST content of the given entries, sorted in the app modules order,
+    modules that have been removed from the app being dropped
+
+    >>> entries = OrderedDict([('mod2', ('1485857802_mod2_a1b2c3d', '/var/www/mod2', 'ghost/.packages/d41d8cd9')),
+    ...                        ('old', ('1485857800_old_a1b2c3d', '/var/www/old', None)),
+    ...                        ('mod1', ('1485857801_mod1_0d23e96', '/var/www', None))])
+    >>> format_manifest(entries, ['mod1', 'mod2'])
+    'mod1:1485857801_mod1_0d23e96:/var/www\\nmod2:1485857802_mod2_a1b2c3d:/var/www/mod2:ghost/.packages/d41d8cd9\\n'
+    >>> format_manifest(OrderedDict(), ['mod1'])
+    ''
+    """
+    return ''.join('{0}:{1}:{2}{3}\n'.format(name, entries[name][0], entries[name][1],
+                                            ':' + entries[name][2] if entries[name][2] else '')
+                   for name in module_names if name in entries)
+
+
+class AppManifest(object):
+    """
+    In-memory model of the MANIFEST of an app path, given as a boto bucket and a key path.
+
+    Module changes are staged with set_module_package and written at once by save(), conditionally on the ETag
+    of the loaded MANIFEST. On conflict with a concurrent job, the MANIFEST is reloaded and the staged changes are
+    applied again. Each written version is recorded in the history collection, if any, and the MANIFEST as loaded
+    is kept in memory so that rolling modules back does not read S3 again.
+    """
+
+    def __init__(self, bucket, key_path, module_names, log_file, legacy_key_path=None, history=None, history_infos=None):
+        self._bucket = bucket
+        self._key_path = key_path
+        self._module_names = module_names
+        self._log_file = log_file
+        self._legacy_key_path = legacy_key_path
+        self._history = history
+        self._history_infos = history_infos or {}
+        self._entries = OrderedDict()
+        self._base_entries = OrderedDict()
+        self._changes = OrderedDict()
+        self._etag = None
+        self._loaded = False
+
+    def _read(self):
+        """
+        Reads the MANIFEST from S3, or the legacy uncolored one if the MANIFEST does not exist yet
+        Returns the content and the ETag to match on write, None for a MANIFEST to be created
+        """
+        key = self._bucket.get_key(self._key_path)
+        etag = key.etag if key else None
+        if not key and self._legacy_key_path:
+            key = self._bucket.get_key(self._legacy_key_path)
+        if not key:
+            return '', None
+        content = key.get_contents_as_string()
+        if sys.version > '3':
+            content = content.decode('utf-8')
+        return content, etag
+
+    def load(self):
+        content, self._etag = self._read()
+        self._entries = parse_manifest(content)
+        self._base_entries = OrderedDict(self._entries)
+        self._changes = OrderedDict()
+        self._loaded = True
+        return self
+
+    def get_module_package(self, module_name):
+        if not self._loaded:
+            self.load()
+        return self._entries.get(module_name, (None, None, None))[0]
+
+    def set_module_package(self, module, package, package_key_path=None):
+        """
+        Stages the package of the module, written by the next save()
+        The key path is given for packages stored outside of the module S3 path
+        """
+        if not self._loaded:
+            self.load()
+        entry = (package, module['path'], package_key_path.lstrip('/') if package_key_path else None)
+        self._changes[module['name']] = entry
+        self._entries[module['name']] = entry
+
+    def _reset_module(self, module_name):
+        entry = self._base_entries.get(module_name)
+        self._changes[module_name] = entry
+        if entry:
+            self._entries[module_name] = entry
+        else:
+            self._entries.pop(module_name, None)
+
+    def _apply_changes(self, entries):
+        for name, entry in self._changes.items():
+            if entry:
+                entries[name] = entry
+            else:
+                entries.pop(name, None)
+        return entries
+
+    def save(self):
+        """
+        Writes the MANIFEST with the staged changes, retrying on conflict with a concurrent write
+        """
+        if not self._loaded:
+            self.load()
+        for attempt in range(MANIFEST_WRITE_RETRIES + 1):
+            content = format_manifest(self._entries, self._module_names)
+            headers = {'If-Match': self._etag} if self._etag else {'If-None-Match': '*'}
+            key = self._bucket.new_key(self._key_path)
+            try:
+                key.set_contents_from_string(content, headers=headers)
+            except S3ResponseError as e:
+                if e.status not in MANIFEST_CONFLICT_STATUSES:
+                    raise GCallException("Unable to write MANIFEST {0}: {1}".format(self._key_path, e))
+                if attempt == MANIFEST_WRITE_RETRIES:
+                    raise GCallException("Unable to write MANIFEST {0}: still modified concurrently after {1} "
+                                         "attempts".format(self._key_path, attempt + 1))
+                log("MANIFEST {0} modified concurrently, reloading it".format(self._key_path), self._log_file)
+                content, self._etag = self._read()
+                self._entries = self._apply_changes(parse_manifest(content))
+                continue
+            finally:
+                key.close()
+            self._etag = key.etag
+            self._changes = OrderedDict()
+            self._record_version(content)
+            log("MANIFEST {0} updated".format(self._key_path), self._log_file)
+            return
+
+    def rollback(self, module_names):
+        """
+        Restores the packages the given modules had when the MANIFEST was loaded, other modules are kept
+        """
+        for name in module_names:
+            self._reset_module(name)
+        self.save()
+
+    def _record_version(self, content):
+        if self._history is None:
+            return
+        version = dict(self._history_infos)
+        version.update({
+            'path': self._key_path,
+            'content': content,
+            'etag': self._etag,
+            '_created': datetime.datetime.utcnow(),
+        })
+        self._history.insert(version)
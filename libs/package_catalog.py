@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Library to maintain the catalog of the modules packages stored in S3 and to purge old packages from it
+"""
+
+import datetime
+import re
+
+from ghost_log import log
+from ghost_tools import get_module_package_rev_from_manifest
+
+from libs.packaging import get_package_sidecar_owner
+
+# Maximum number of keys of an S3 DeleteObjects request
+S3_DELETE_BATCH_SIZE = 1000
+
+
+def get_package_timestamp(pkg_name):
+    """
+    Returns the build timestamp of a package, from its name
+
+    >>> get_package_timestamp('1485857801_mod1_0d23e96')
+    1485857801
+    >>> get_package_timestamp('1485857801_mod1_0d23e96.zst')
+    1485857801
+    >>> get_package_timestamp('mod1.tar.gz')
+    0
+    """
+    match = re.match(r'^(\d+)_', pkg_name)
+    return int(match.group(1)) if match else 0
+
+
+def register_package(collection, app, module_name, path, pkg_name, size=None, sidecars=None, deploy_id=None,
+                     key_path=None):
+    """
+    Adds or updates a package in the catalog, as the one referenced by the MANIFEST of its app path
+    The key path is given for packages of the content-addressed package store
+    """
+    now = datetime.datetime.utcnow()
+    update = {
+        '$set': {
+            'app_id': app['_id'],
+            'module': module_name,
+            'color': (app.get('blue_green') or {}).get('color'),
+            'timestamp': get_package_timestamp(pkg_name),
+            '_updated': now,
+        },
+        '$setOnInsert': {'_created': now},
+    }
+    if size is not None:
+        update['$set']['size'] = size
+    if deploy_id:
+        update['$set']['deploy_id'] = deploy_id
+    if key_path:
+        update['$set']['key_path'] = key_path
+    if sidecars:
+        update['$addToSet'] = {'sidecars': {'$each': sidecars}}
+    collection.update({'path': path, 'package': pkg_name}, update, upsert=True)
+    set_referenced_package(collection, path, module_name, pkg_name)
+
+
+def set_referenced_package(collection, path, module_name, pkg_name):
+    """
+    Flags the package as the one named in the MANIFEST of its app path, the other packages of the module are not
+    """
+    collection.update({'path': path, 'module': module_name, 'referenced': True, 'package': {'$ne': pkg_name}},
+                      {'$set': {'referenced': False}}, multi=True)
+    collection.update({'path': path, 'package': pkg_name},
+                      {'$set': {'module': module_name, 'referenced': True},
+                       '$setOnInsert': {'timestamp': get_package_timestamp(pkg_name), 'sidecars': []}},
+                      upsert=True)
+
+
+def import_module_packages(collection, imports_collection, bucket, app, module_name, path, manifest_key_path,
+                           log_file):
+    """
+    Fills the catalog with the packages already stored in S3 for the module, only once per module.
+    Imports are recorded in their own collection, as deployments register their package in the catalog first.
+    """
+    if imports_collection.find_one({'path': path, 'module': module_name}):
+        return
+    log("Packages catalog: importing existing packages of {0}".format(path), log_file)
+    packages = {}
+    sidecars = []
+    for key in bucket.list(path.lstrip('/') + '/'):
+        name = key.name.split('/')[-1]
+        if get_package_sidecar_owner(name):
+            sidecars.append(name)
+        else:
+            packages[name] = key.size
+    referenced = None
+    if bucket.get_key(manifest_key_path):
+        referenced = get_module_package_rev_from_manifest(bucket, manifest_key_path, module_name)
+    now = datetime.datetime.utcnow()
+    for name, size in packages.items():
+        collection.update({'path': path, 'package': name}, {'$setOnInsert': {
+            'app_id': app['_id'],
+            'module': module_name,
+            'color': (app.get('blue_green') or {}).get('color'),
+            'timestamp': get_package_timestamp(name),
+            'size': size,
+            'sidecars': [sidecar for sidecar in sidecars if get_package_sidecar_owner(sidecar) == name],
+            'referenced': name == referenced,
+            '_created': now,
+            '_updated': now,
+        }}, upsert=True)
+    imports_collection.update({'path': path, 'module': module_name}, {'$setOnInsert': {'_created': now}}, upsert=True)
+
+
+def purge_module_packages(collection, bucket, path, module_name, retention, log_file):
+    """
+    Deletes the packages of the module beyond the retention count, the package referenced by the MANIFEST
+    being always kept, with batched S3 DeleteObjects requests
+    Packages of the package store are only deleted once no other catalog entry, of any app path, uses them
+    Returns the number of deleted packages
+    """
+    expired = list(collection.find({'path': path, 'module': module_name, 'referenced': {'$ne': True}},
+                                   sort=[('timestamp', -1)]).skip(retention))
+    if not expired:
+        return 0
+    expired_ids = [package['_id'] for package in expired]
+    keys = {}
+    for package in expired:
+        for name in [package['package']] + package.get('sidecars', []):
+            keys['{0}/{1}'.format(path.lstrip('/'), name)] = package['_id']
+        key_path = package.get('key_path')
+        if key_path and not collection.find_one({'key_path': key_path, '_id': {'$nin': expired_ids}}):
+            keys[key_path.lstrip('/')] = package['_id']
+
+    failed = set()
+    key_names = sorted(keys.keys())
+    for start in range(0, len(key_names), S3_DELETE_BATCH_SIZE):
+        result = bucket.delete_keys(key_names[start:start + S3_DELETE_BATCH_SIZE], quiet=True)
+        for error in result.errors:
+            log("Packages Purge: Delete FAILED for S3 Object: {0} ({1})".format(error.key, error.message), log_file)
+            failed.add(keys.get(error.key))
+
+    deleted_ids = [package_id for package_id in expired_ids if package_id not in failed]
+    if deleted_ids:
+        collection.remove({'_id': {'$in': deleted_ids}})
+    log("Packages Purge: {0} package(s) of {1} deleted".format(len(deleted_ids), path), log_file)
+    return len(deleted_ids)
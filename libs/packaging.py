@@ -0,0 +1,528 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Library to create module packages and stream them to the Ghost S3 bucket
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import tarfile
+import threading
+from cStringIO import StringIO
+from fnmatch import fnmatchcase
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
+from subprocess import Popen, PIPE
+
+from ghost_log import log
+from ghost_tools import GCallException
+
+PACKAGE_CODECS = {
+    # In-process gzip, the historical package format
+    'gzip': {'extension': '', 'command': None},
+    # Multi-threaded gzip, packages are still extracted with 'tar -xzf'
+    'pigz': {'extension': '', 'command': ['pigz', '-c', '-6']},
+    # Multi-threaded zstd, requires zstd on the instances to extract packages
+    'zstd': {'extension': '.zst', 'command': ['zstd', '-c', '-q', '-T0']},
+}
+DEFAULT_PACKAGE_CODEC = 'gzip'
+
+# S3 multipart uploads require parts of at least 5MB (except the last one)
+MIN_UPLOAD_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_UPLOAD_PART_SIZE = 16 * 1024 * 1024
+DEFAULT_UPLOAD_CONCURRENCY = 4
+
+STREAM_READ_SIZE = 1024 * 1024
+
+# Delta packages only contain the files changed since a base package, stage2 applies them on the base release
+PACKAGE_INDEX_SUFFIX = '.index'
+PACKAGE_DELTA_SEPARATOR = '.delta-'
+DELTA_BASE_FILE = '.ghost-delta-base'
+DELTA_FILES_LIST = '.ghost-delta-files'
+# Digests of the files taken from the base release, checked by stage2 with sha256sum -c
+DELTA_DIGESTS_FILE = '.ghost-delta-digests'
+# Files removed from the release directory by stage2 once used, always shipped in deltas
+DELTA_ALWAYS_INCLUDED = ['./.ghost-metadata', './postdeploy', './predeploy']
+
+# Packaging rules file of the module sources, with a .gitignore syntax
+PACKAGE_IGNORE_FILE = '.ghostignore'
+# Files written by Ghost in the module working directory, never excluded from packages
+ALWAYS_PACKAGED = ['.ghost-metadata', 'predeploy', 'postdeploy', 'after_all_deploy']
+
+# Content-addressed packages, shared by every app path building the same module inputs
+PACKAGE_STORE_PATH = '/ghost/.packages'
+
+
+def get_package_codec(config, log_file):
+    """
+    Returns the package codec to use, falls back to gzip if the configured one is not available
+
+    >>> from StringIO import StringIO
+    >>> get_package_codec({}, StringIO())
+    'gzip'
+    >>> get_package_codec({'deployment_package_codec': 'gzip'}, StringIO())
+    'gzip'
+    >>> get_package_codec({'deployment_package_codec': 'unknown'}, StringIO())
+    'gzip'
+    """
+    codec = config.get('deployment_package_codec', DEFAULT_PACKAGE_CODEC) or DEFAULT_PACKAGE_CODEC
+    if codec not in PACKAGE_CODECS:
+        log("Unknown package codec '{0}', using {1}".format(codec, DEFAULT_PACKAGE_CODEC), log_file)
+        return DEFAULT_PACKAGE_CODEC
+    command = PACKAGE_CODECS[codec]['command']
+    if command and not find_executable(command[0]):
+        log("Package codec '{0}' is not installed, using {1}".format(codec, DEFAULT_PACKAGE_CODEC), log_file)
+        return DEFAULT_PACKAGE_CODEC
+    return codec
+
+
+def get_package_extension(codec):
+    """
+    Returns the suffix added to package names built with the given codec
+
+    >>> get_package_extension('gzip')
+    ''
+    >>> get_package_extension('pigz')
+    ''
+    >>> get_package_extension('zstd')
+    '.zst'
+    """
+    return PACKAGE_CODECS[codec]['extension']
+
+
+def get_package_extract_command(package_path, destination_path):
+    """
+    Returns the shell command extracting a package, whatever its codec
+
+    >>> get_package_extract_command('/tmp/1485857801_mod1_0d23e96', '/ghost/App/prod/webfront/mod1')
+    'tar -xzf "/tmp/1485857801_mod1_0d23e96" -C "/ghost/App/prod/webfront/mod1"'
+    >>> get_package_extract_command('/tmp/1485857801_mod1_0d23e96.zst', '/ghost/App/prod/webfront/mod1')
+    'tar -I zstd -xf "/tmp/1485857801_mod1_0d23e96.zst" -C "/ghost/App/prod/webfront/mod1"'
+    """
+    if package_path.endswith(PACKAGE_CODECS['zstd']['extension']):
+        return 'tar -I zstd -xf "{0}" -C "{1}"'.format(package_path, destination_path)
+    return 'tar -xzf "{0}" -C "{1}"'.format(package_path, destination_path)
+
+
+def get_package_index_name(pkg_name):
+    """
+    >>> get_package_index_name('1485857801_mod1_0d23e96')
+    '1485857801_mod1_0d23e96.index'
+    """
+    return pkg_name + PACKAGE_INDEX_SUFFIX
+
+
+def get_package_delta_name(pkg_name, base_pkg_name):
+    """
+    >>> get_package_delta_name('1485858044_mod1_9f1e3a2', '1485857801_mod1_0d23e96')
+    '1485858044_mod1_9f1e3a2.delta-1485857801_mod1_0d23e96'
+    """
+    return pkg_name + PACKAGE_DELTA_SEPARATOR + base_pkg_name
+
+
+def get_package_store_key_path(build_hash, codec):
+    """
+    Returns the key path of a package in the content-addressed package store,
+    the build hash identifying the package content
+
+    >>> get_package_store_key_path('d41d8cd98f00b204e9800998ecf8427e', 'gzip')
+    '/ghost/.packages/d41d8cd98f00b204e9800998ecf8427e'
+    >>> get_package_store_key_path('d41d8cd98f00b204e9800998ecf8427e', 'zstd')
+    '/ghost/.packages/d41d8cd98f00b204e9800998ecf8427e.zst'
+    """
+    return '{0}/{1}{2}'.format(PACKAGE_STORE_PATH, build_hash, get_package_extension(codec))
+
+
+def get_package_sidecar_owner(name):
+    """
+    Returns the package a package index or delta belongs to, None for a package
+
+    >>> get_package_sidecar_owner('1485857801_mod1_0d23e96') is None
+    True
+    >>> get_package_sidecar_owner('1485857801_mod1_0d23e96.zst.index')
+    '1485857801_mod1_0d23e96.zst'
+    >>> get_package_sidecar_owner('1485858044_mod1_9f1e3a2.delta-1485857801_mod1_0d23e96')
+    '1485858044_mod1_9f1e3a2'
+    """
+    if PACKAGE_DELTA_SEPARATOR in name:
+        return name.split(PACKAGE_DELTA_SEPARATOR)[0]
+    if name.endswith(PACKAGE_INDEX_SUFFIX):
+        return name[:-len(PACKAGE_INDEX_SUFFIX)]
+    return None
+
+
+class PackageFilter(object):
+    """
+    Selects the paths of a module working directory to package, from ordered rules with a .gitignore syntax:
+    - `pattern` excludes the paths matching it, `!pattern` includes them again
+    - patterns without a slash match file and directory names at any depth, others match the path from the root
+    - a trailing slash only matches directories
+    The last matching rule wins. Excluded directories are not walked, their content cannot be included again.
+
+    >>> package_filter = PackageFilter.parse(['.git', '# Tests and docs', 'tests/', '/docs', '*.md', '!README.md'])
+    >>> [path for path in ['src/app.php', 'src/.git', 'tests', 'src/tests', 'docs', 'src/docs', 'CHANGELOG.md',
+    ...                    'README.md', 'tests.php'] if package_filter.is_excluded(path, path != 'tests.php' and
+    ...                                                                             '.' not in path)]
+    ['src/.git', 'tests', 'src/tests', 'docs', 'CHANGELOG.md']
+    >>> package_filter.is_excluded('tests', False)
+    False
+    >>> PackageFilter.parse(['*']).is_excluded('predeploy', False)
+    False
+    >>> PackageFilter.parse([]).is_excluded('.git', True)
+    False
+    """
+
+    def __init__(self, rules=None):
+        self._rules = rules or []
+
+    @classmethod
+    def parse(cls, lines):
+        rules = []
+        for line in lines:
+            pattern = line.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            include = pattern.startswith('!')
+            pattern = pattern.lstrip('!')
+            dir_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            anchored = '/' in pattern
+            pattern = pattern.lstrip('/')
+            if pattern:
+                rules.append((pattern, include, dir_only, anchored))
+        return cls(rules)
+
+    @classmethod
+    def from_module(cls, module, source_path, exclude_git_metadata=False):
+        """
+        Returns the filter of the module: the git metadata exclusion, then the rules of the module .ghostignore file,
+        then the exclude and include patterns of the module packaging settings
+        """
+        lines = ['.git'] if exclude_git_metadata else []
+        ignore_file_path = os.path.join(source_path, PACKAGE_IGNORE_FILE)
+        if os.path.isfile(ignore_file_path):
+            with open(ignore_file_path) as f:
+                lines.extend(f.read().splitlines())
+        packaging = module.get('packaging') or {}
+        lines.extend(packaging.get('exclude') or [])
+        lines.extend('!' + pattern for pattern in packaging.get('include') or [])
+        return cls.parse(lines)
+
+    def is_excluded(self, path, is_dir):
+        """
+        Returns whether the path, relative to the module working directory, is excluded from the package
+        """
+        if path in ALWAYS_PACKAGED:
+            return False
+        excluded = False
+        name = os.path.basename(path)
+        for pattern, include, dir_only, anchored in self._rules:
+            if dir_only and not is_dir:
+                continue
+            if fnmatchcase(path if anchored else name, pattern):
+                excluded = not include
+        return excluded
+
+
+def _get_file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(STREAM_READ_SIZE), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_package_index(source_path, package_filter=None):
+    """
+    Returns the content index of a package, as {path in package: digest of the mode and content}
+
+    >>> import shutil, tempfile
+    >>> source_path = tempfile.mkdtemp()
+    >>> os.makedirs(source_path + '/src/.git')
+    >>> open(source_path + '/src/app.php', 'w').write('<?php')
+    >>> os.symlink('src/app.php', source_path + '/index.php')
+    >>> os.chmod(source_path + '/src', 0o755)
+    >>> os.chmod(source_path + '/src/app.php', 0o644)
+    >>> sorted(get_package_index(source_path, PackageFilter.parse(['.git'])).items())
+    [('./index.php', 'l:src/app.php'), ('./src', 'd:755'), ('./src/app.php', 'f:644:fe5bcb54c56e0b9f456a060364dd28b2248f3a0e21c168d4ce9d009b73e83e3c')]
+    >>> shutil.rmtree(source_path)
+    """
+    package_filter = package_filter or PackageFilter()
+    index = {}
+    for dirpath, dirnames, filenames in os.walk(source_path):
+        relative_dirpath = os.path.relpath(dirpath, source_path)
+        relative_dirpath = '' if relative_dirpath == '.' else relative_dirpath
+        dirnames[:] = [name for name in dirnames
+                       if not package_filter.is_excluded(os.path.join(relative_dirpath, name), True)]
+        for name in dirnames + [name for name in filenames
+                                if not package_filter.is_excluded(os.path.join(relative_dirpath, name), False)]:
+            path = os.path.join(dirpath, name)
+            arcname = './' + os.path.relpath(path, source_path)
+            stat = os.lstat(path)
+            mode = oct(stat.st_mode & 0o7777)[-3:]
+            if os.path.islink(path):
+                index[arcname] = 'l:' + os.readlink(path)
+            elif os.path.isdir(path):
+                index[arcname] = 'd:' + mode
+            else:
+                index[arcname] = 'f:{0}:{1}'.format(mode, _get_file_digest(path))
+    return index
+
+
+def get_package_delta(base_index, index):
+    """
+    Returns the sorted paths to ship in a delta package to turn the base package content into the indexed one
+
+    >>> base_index = {'./src': 'd:755', './src/app.php': 'f:644:aaa', './README': 'f:644:bbb', './predeploy': 'f:644:ccc'}
+    >>> index = {'./src': 'd:755', './src/app.php': 'f:644:ddd', './src/lib.php': 'f:644:eee', './predeploy': 'f:644:ccc'}
+    >>> get_package_delta(base_index, index)
+    ['./predeploy', './src/app.php', './src/lib.php']
+    """
+    return sorted(path for path, digest in index.items()
+                  if base_index.get(path) != digest or path in DELTA_ALWAYS_INCLUDED)
+
+
+def get_package_delta_digests(index, paths):
+    """
+    Returns the digests of the regular files a delta package takes from the base release, in sha256sum format
+
+    >>> index = {'./src': 'd:755', './src/app.php': 'f:644:aaa', './src/lib.php': 'f:644:eee', './index.php': 'l:src/app.php'}
+    >>> get_package_delta_digests(index, ['./src/lib.php'])
+    'aaa  ./src/app.php\\n'
+    """
+    return ''.join('{0}  {1}\n'.format(index[path].split(':', 2)[2], path) for path in sorted(index)
+                   if index[path].startswith('f:') and path not in paths)
+
+
+def upload_package_index(bucket, key_path, index):
+    data = StringIO()
+    compressed = gzip.GzipFile(filename='', mode='wb', fileobj=data)
+    compressed.write(json.dumps(index))
+    compressed.close()
+    bucket.new_key(key_path).set_contents_from_string(data.getvalue())
+
+
+def download_package_index(bucket, key_path):
+    """
+    Returns the package index stored with upload_package_index, None if missing
+    """
+    key = bucket.get_key(key_path)
+    if not key:
+        return None
+    return json.loads(gzip.GzipFile(fileobj=StringIO(key.get_contents_as_string())).read())
+
+
+class S3MultipartWriter(object):
+    """
+    File-like object uploading everything written to it as an S3 multipart upload.
+    Parts are uploaded by a pool of threads while the caller keeps writing,
+    the number of parts held in memory is bounded by the upload concurrency.
+    """
+
+    def __init__(self, bucket, key_path, metadata=None, part_size=DEFAULT_UPLOAD_PART_SIZE,
+                 concurrency=DEFAULT_UPLOAD_CONCURRENCY):
+        self._part_size = max(part_size, MIN_UPLOAD_PART_SIZE)
+        self._upload = bucket.initiate_multipart_upload(key_path, metadata=metadata or {})
+        self._pool = ThreadPool(concurrency)
+        # Parts being uploaded plus one waiting for a free upload thread
+        self._slots = threading.BoundedSemaphore(concurrency + 1)
+        self._buffer = StringIO()
+        self._results = []
+        self._part_num = 0
+        self.size = 0
+
+    def write(self, data):
+        self._buffer.write(data)
+        self.size += len(data)
+        if self._buffer.tell() >= self._part_size:
+            self._flush_part()
+
+    def flush(self):
+        pass
+
+    def _flush_part(self):
+        data = self._buffer.getvalue()
+        self._buffer = StringIO()
+        self._part_num += 1
+        self._slots.acquire()
+        self._results.append(self._pool.apply_async(self._upload_part, (self._part_num, data)))
+        # Fail fast if a previous part could not be uploaded
+        for result in self._results:
+            if result.ready() and not result.successful():
+                result.get()
+
+    def _upload_part(self, part_num, data):
+        try:
+            self._upload.upload_part_from_file(StringIO(data), part_num)
+        finally:
+            self._slots.release()
+
+    def complete(self):
+        if self._buffer.tell() or not self._part_num:
+            self._flush_part()
+        self._pool.close()
+        self._pool.join()
+        for result in self._results:
+            result.get()
+        self._upload.complete_upload()
+
+    def abort(self):
+        self._pool.terminate()
+        self._upload.cancel_upload()
+
+
+class _CountingFile(object):
+    """
+    File-like wrapper counting the bytes written through it
+    """
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.size = 0
+
+    def write(self, data):
+        self._fileobj.write(data)
+        self.size += len(data)
+
+
+def _write_tar(source_path, fileobj, uid, gid, package_filter):
+    """
+    Writes an uncompressed tar stream of the source_path content into fileobj
+    Returns the size of the tar stream, a cheap measure of the packaged content size, and the number of files
+    """
+    files = [0]
+
+    def set_owner(tarinfo):
+        if tarinfo.name != '.' and package_filter.is_excluded(tarinfo.name[2:], tarinfo.isdir()):
+            return None
+        if not tarinfo.isdir():
+            files[0] += 1
+        tarinfo.uid = uid
+        tarinfo.gid = gid
+        tarinfo.uname = tarinfo.gname = ''
+        return tarinfo
+
+    counter = _CountingFile(fileobj)
+    archive = tarfile.open(fileobj=counter, mode='w|', format=tarfile.GNU_FORMAT)
+    try:
+        archive.add(source_path, arcname='.', filter=set_owner)
+    finally:
+        archive.close()
+    return counter.size, files[0]
+
+
+def _write_delta_tar(source_path, fileobj, uid, gid, paths, base_pkg_name, index):
+    """
+    Writes an uncompressed tar stream of the given paths of source_path into fileobj, along with the
+    base package name, the list of all the files of the package and the digests of the files taken from the base
+    Returns the size of the tar stream and the number of files it contains
+    """
+    packaged_files = [0]
+
+    def set_owner(tarinfo):
+        if not tarinfo.isdir():
+            packaged_files[0] += 1
+        tarinfo.uid = uid
+        tarinfo.gid = gid
+        tarinfo.uname = tarinfo.gname = ''
+        return tarinfo
+
+    counter = _CountingFile(fileobj)
+    archive = tarfile.open(fileobj=counter, mode='w|', format=tarfile.GNU_FORMAT)
+    try:
+        for path in paths:
+            archive.add(os.path.join(source_path, path), arcname=path, recursive=False, filter=set_owner)
+        for name, content in ((DELTA_BASE_FILE, base_pkg_name), (DELTA_FILES_LIST, '\n'.join(sorted(index)) + '\n'),
+                              (DELTA_DIGESTS_FILE, get_package_delta_digests(index, paths))):
+            tarinfo = set_owner(tarfile.TarInfo('./' + name))
+            tarinfo.size = len(content)
+            archive.addfile(tarinfo, StringIO(content))
+    finally:
+        archive.close()
+    return counter.size, packaged_files[0]
+
+
+def _write_compressed_in_process(write_tar, writer):
+    compressed = gzip.GzipFile(filename='', mode='wb', compresslevel=6, fileobj=writer)
+    try:
+        return write_tar(compressed)
+    finally:
+        compressed.close()
+
+
+def _write_compressed_with_command(write_tar, writer, command):
+    process = Popen(command, stdin=PIPE, stdout=PIPE)
+    errors = []
+    sizes = []
+
+    def produce():
+        try:
+            sizes.append(write_tar(process.stdin))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            process.stdin.close()
+
+    producer = threading.Thread(target=produce, name='package-tar')
+    producer.daemon = True
+    producer.start()
+    try:
+        for chunk in iter(lambda: process.stdout.read(STREAM_READ_SIZE), ''):
+            writer.write(chunk)
+    except:
+        process.kill()
+        producer.join()
+        raise
+    producer.join()
+    if process.wait() != 0:
+        raise GCallException("ERROR: '{0}' exited with code {1}".format(' '.join(command), process.returncode))
+    if errors:
+        raise errors[0]
+    return sizes[0]
+
+
+def _stream_tar_to_s3(write_tar, bucket, key_path, codec, log_file, metadata, part_size, concurrency):
+    writer = S3MultipartWriter(bucket, key_path, metadata, part_size, concurrency)
+    try:
+        command = PACKAGE_CODECS[codec]['command']
+        if command:
+            content_size, file_count = _write_compressed_with_command(write_tar, writer, command)
+        else:
+            content_size, file_count = _write_compressed_in_process(write_tar, writer)
+        writer.complete()
+    except Exception as e:
+        log("Package upload failed, aborting multipart upload of {0}".format(key_path), log_file)
+        try:
+            writer.abort()
+        except Exception as abort_error:
+            log("Package upload abort failed: {0}".format(abort_error), log_file)
+        raise GCallException("ERROR: Package creation and upload failed: {0}".format(e))
+    log("Package {0} uploaded using {1} ({2} bytes, {3} bytes uncompressed, {4} files)".format(
+        key_path, codec, writer.size, content_size, file_count), log_file)
+    return writer.size, content_size, file_count
+
+
+def stream_package_to_s3(source_path, bucket, key_path, codec, uid, gid, log_file, package_filter=None,
+                         metadata=None, part_size=DEFAULT_UPLOAD_PART_SIZE, concurrency=DEFAULT_UPLOAD_CONCURRENCY):
+    """
+    Packages the source_path directory, without the paths excluded by the package filter,
+    and streams it to the S3 bucket, without any local temporary file
+    Returns the package size and the uncompressed size of its content, in bytes, and its number of files
+    """
+    package_filter = package_filter or PackageFilter()
+    return _stream_tar_to_s3(lambda fileobj: _write_tar(source_path, fileobj, uid, gid, package_filter),
+                             bucket, key_path, codec, log_file, metadata, part_size, concurrency)
+
+
+def stream_delta_package_to_s3(source_path, bucket, key_path, paths, base_pkg_name, index, uid, gid, log_file,
+                               part_size=DEFAULT_UPLOAD_PART_SIZE, concurrency=DEFAULT_UPLOAD_CONCURRENCY):
+    """
+    Packages the given paths of the source_path directory as a delta package of the indexed package, always gzipped,
+    and streams it to the S3 bucket
+    Returns the package size and the uncompressed size of its content, in bytes, and its number of files
+    """
+    return _stream_tar_to_s3(
+        lambda fileobj: _write_delta_tar(source_path, fileobj, uid, gid, paths, base_pkg_name, index),
+        bucket, key_path, DEFAULT_PACKAGE_CODEC, log_file, None, part_size, concurrency)
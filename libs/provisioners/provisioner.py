@@ -4,7 +4,8 @@ from sh import git
 
 from ghost_log import log
 from ghost_tools import get_lock_path_from_repo, get_local_repo_path
-from libs.git_helper import git_remap_submodule, git_acquire_lock, git_release_lock
+from libs.git_helper import git_remap_submodule
+from libs.locks import FairFileLock
 
 
 PROVISIONER_LOCAL_TREE="/tmp/ghost-features-provisioner"
@@ -52,7 +53,8 @@ class FeaturesProvisioner:
 
         git_local_mirror = self._get_mirror_path(provisioner_git_repo)
         zabbix_repo = self.global_config.get('zabbix_repo', ZABBIX_REPO)
-        lock_path = get_lock_path_from_repo(provisioner_git_repo)
+        # Lock the mirror itself, as the background mirrors maintenance does
+        lock_path = get_lock_path_from_repo(os.path.relpath(git_local_mirror, PROVISIONER_LOCAL_MIRROR))
         log("Getting provisioner features from {r}".format(r=provisioner_git_repo), self._log_file)
         try:
             output=git("ls-remote", "--exit-code", provisioner_git_repo, provisioner_git_revision).strip()
@@ -62,9 +64,7 @@ class FeaturesProvisioner:
                 self._log_file)
             raise
 
-        try:
-            git_acquire_lock(lock_path, self._log_file)
-
+        with FairFileLock(lock_path, self._log_file, 'on git mirror {m}'.format(m=git_local_mirror)):
             # Creates the Provisioner local mirror
             if not os.path.exists(git_local_mirror):
                 log("Creating local mirror [{r}] for the first time".format(r=git_local_mirror), self._log_file)
@@ -77,8 +77,6 @@ class FeaturesProvisioner:
             log("Fetching local mirror [{r}] remotes".format(r=git_local_mirror), self._log_file)
             os.chdir(git_local_mirror)
             git.fetch(['--all'])
-        finally:
-            git_release_lock(lock_path, self._log_file)
 
         log("Cloning [{r}] repo with local mirror reference".format(r=provisioner_git_repo), self._log_file)
         git.clone(['--reference', git_local_mirror, provisioner_git_repo, '-b',
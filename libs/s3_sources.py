@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Library to fetch modules sources from S3 with concurrent downloads and a local cache of the fetched objects.
+    Cached objects are keyed on their ETag (or VersionId), so unchanged objects are never downloaded twice.
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+
+from ghost_log import log
+from ghost_tools import GCallException
+
+S3_SOURCES_CACHE_ROOT = '/ghost/.cache/s3'
+
+DEFAULT_S3_SOURCES_CONCURRENCY = 16
+DEFAULT_S3_SOURCES_CACHE_MAX_SIZE = 10240
+
+# Minimum number of fetched objects between two progress lines
+S3_SOURCES_PROGRESS_STEP = 10
+
+
+def parse_s3_url(source_url):
+    """
+    Returns the bucket name and key (or prefix) of an S3 url
+
+    >>> parse_s3_url('s3://my-bucket/sources/mod1')
+    ('my-bucket', 'sources/mod1')
+    >>> parse_s3_url('s3://my-bucket/sources/archive.tar.gz')
+    ('my-bucket', 'sources/archive.tar.gz')
+    >>> parse_s3_url('s3://my-bucket')
+    ('my-bucket', '')
+    >>> parse_s3_url('https://my-bucket/sources')
+    Traceback (most recent call last):
+    GCallException: 'Invalid S3 source url given: "https://my-bucket/sources", it must starts with "s3://"'
+    """
+    matches = re.match(r'^s3://([a-z0-9][a-z0-9-.]*)/?(.*)$', source_url)
+    if not matches:
+        raise GCallException('Invalid S3 source url given: "{}", it must starts with "s3://"'.format(source_url))
+    return matches.group(1), matches.group(2)
+
+
+def get_relative_key_path(prefix, key):
+    """
+    Returns the path of an object under the destination directory, as written by `aws s3 cp --recursive`
+
+    >>> get_relative_key_path('sources/mod1', 'sources/mod1/web/index.php')
+    'web/index.php'
+    >>> get_relative_key_path('sources/mod1/', 'sources/mod1/index.php')
+    'index.php'
+    >>> get_relative_key_path('', 'index.php')
+    'index.php'
+    """
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    return key[len(prefix):]
+
+
+def _is_safe_relative_path(path):
+    """
+    >>> _is_safe_relative_path('web/index.php')
+    True
+    >>> _is_safe_relative_path('web/')
+    False
+    >>> _is_safe_relative_path('../../etc/cron.d/job')
+    False
+    """
+    normalized = os.path.normpath(path)
+    return bool(path) and not path.endswith('/') and not os.path.isabs(normalized) and \
+        normalized != '..' and not normalized.startswith('../')
+
+
+class S3SourcesFetcher(object):
+    """
+    Downloads S3 objects with a pool of concurrent workers, through a local cache keyed on the objects ETag
+    or VersionId. Large objects are downloaded with concurrent ranged requests by the boto3 transfer manager.
+    The client must be a boto3 S3 client. Cached objects are evicted in least recently used order when they
+    exceed the configured size.
+    """
+
+    def __init__(self, client, config, log_file, root=S3_SOURCES_CACHE_ROOT):
+        self._client = client
+        self._log_file = log_file
+        self._root = root
+        self._concurrency = max(int(config.get('s3_sources_concurrency', DEFAULT_S3_SOURCES_CONCURRENCY) or 1), 1)
+        self._max_size = int(float(config.get('s3_sources_cache_max_size', DEFAULT_S3_SOURCES_CACHE_MAX_SIZE))
+                             * 1024 * 1024)
+        self._progress_lock = threading.Lock()
+
+    def _get_cache_path(self, bucket, key, etag_or_version):
+        digest = hashlib.sha256('{0}/{1}@{2}'.format(bucket, key, etag_or_version)).hexdigest()
+        return os.path.join(self._root, digest[:2], digest)
+
+    def _fetch_object(self, bucket, key, etag_or_version, destination, extra_args=None):
+        """
+        Copies the object into the destination, from the cache if possible
+        Returns True if the object has been downloaded
+        """
+        cache_path = self._get_cache_path(bucket, key, etag_or_version)
+        downloaded = False
+        if os.path.exists(cache_path):
+            # Mark as recently used
+            os.utime(cache_path, None)
+        else:
+            cache_dir = os.path.dirname(cache_path)
+            if not os.path.isdir(cache_dir):
+                try:
+                    os.makedirs(cache_dir)
+                except OSError:
+                    if not os.path.isdir(cache_dir):
+                        raise
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.download-')
+            os.close(fd)
+            try:
+                self._client.download_file(bucket, key, tmp_path, ExtraArgs=extra_args)
+                os.rename(tmp_path, cache_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            downloaded = True
+        destination_dir = os.path.dirname(destination)
+        if destination_dir and not os.path.isdir(destination_dir):
+            try:
+                os.makedirs(destination_dir)
+            except OSError:
+                if not os.path.isdir(destination_dir):
+                    raise
+        # Copy rather than link, the buildpack may modify the sources in place
+        shutil.copyfile(cache_path, destination)
+        return downloaded
+
+    def _list_objects(self, bucket, prefix):
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        paginator = self._client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                yield obj
+
+    def fetch_latest(self, source_url, working_directory):
+        """
+        Fetches every object under the S3 url prefix into the working directory, at their latest version
+        """
+        bucket, prefix = parse_s3_url(source_url)
+        objects = []
+        for obj in self._list_objects(bucket, prefix):
+            relative_path = get_relative_key_path(prefix, obj['Key'])
+            if _is_safe_relative_path(relative_path):
+                objects.append((obj['Key'], obj['ETag'].strip('"'), obj['Size'], relative_path))
+        if not objects:
+            raise GCallException('No S3 object found at "{0}"'.format(source_url))
+
+        total_size = sum(size for key, etag, size, relative_path in objects)
+        log("S3 sources: fetching {0} object(s) ({1:.1f} MB) from {2} with {3} concurrent worker(s)".format(
+            len(objects), total_size / 1024.0 / 1024.0, source_url, self._concurrency), self._log_file)
+        progress = {'done': 0, 'downloaded': 0, 'downloaded_size': 0, 'logged': 0}
+
+        def fetch(obj):
+            key, etag, size, relative_path = obj
+            downloaded = self._fetch_object(bucket, key, etag, os.path.join(working_directory, relative_path))
+            self._report_progress(progress, len(objects), downloaded, size)
+
+        self._run_concurrently(fetch, objects)
+        log("S3 sources: {0} object(s) fetched, {1} downloaded ({2:.1f} MB), {3} from cache".format(
+            len(objects), progress['downloaded'], progress['downloaded_size'] / 1024.0 / 1024.0,
+            len(objects) - progress['downloaded']), self._log_file)
+        self.evict()
+
+    def fetch_version(self, source_url, working_directory, version_id):
+        """
+        Fetches the given version of the S3 object into the working directory
+        """
+        bucket, key = parse_s3_url(source_url)
+        try:
+            downloaded = self._fetch_object(bucket, key, version_id,
+                                            os.path.join(working_directory, os.path.basename(key)),
+                                            extra_args={'VersionId': version_id})
+        except Exception as e:
+            raise GCallException("S3 sources: download failed: {0}".format(e))
+        log("S3 sources: {0} fetched at version '{1}'{2}".format(
+            source_url, version_id, '' if downloaded else ' from cache'), self._log_file)
+        self.evict()
+
+    def _run_concurrently(self, func, items):
+        pool = ThreadPool(min(self._concurrency, len(items)))
+        try:
+            pool.map(func, items)
+        except Exception as e:
+            raise GCallException("S3 sources: download failed: {0}".format(e))
+        finally:
+            pool.close()
+            pool.join()
+
+    def _report_progress(self, progress, total, downloaded, size):
+        with self._progress_lock:
+            progress['done'] += 1
+            if downloaded:
+                progress['downloaded'] += 1
+                progress['downloaded_size'] += size
+            step = max(total // 10, S3_SOURCES_PROGRESS_STEP)
+            if progress['done'] - progress['logged'] >= step and progress['done'] < total:
+                progress['logged'] = progress['done']
+                log("S3 sources: {0}/{1} object(s) fetched".format(progress['done'], total), self._log_file)
+
+    def evict(self):
+        """
+        Removes the least recently used objects until the cache fits in the configured size
+        """
+        cached = []
+        for dirpath, dirnames, filenames in os.walk(self._root):
+            for name in filenames:
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                cached.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum(size for mtime, size, path in cached)
+        for mtime, size, path in sorted(cached):
+            if total_size <= self._max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_size -= size
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Library running fabric tasks on instances with a bounded number of concurrent hosts.
+    Each host runs in a worker process, from the job SSH connection pool if any, which is killed if the host exceeds
+    its timeout. Hosts not started yet are skipped once too many hosts have failed.
+"""
+
+import datetime
+import time
+from collections import OrderedDict
+
+from ghost_log import log
+from libs.ssh_pool import SSHHostWorker
+
+DEFAULT_SSH_MAX_PARALLEL = 16
+DEFAULT_SSH_HOST_TIMEOUT = 0
+DEFAULT_SSH_MAX_FAILURES = 0
+
+HOST_STATUS_SUCCESS = 'success'
+HOST_STATUS_FAILED = 'failed'
+HOST_STATUS_TIMEOUT = 'timeout'
+HOST_STATUS_SKIPPED = 'skipped'
+
+# Interval in seconds between two checks of the running hosts
+POLL_INTERVAL = 0.2
+
+
+def get_concurrency(fabric_execution_strategy, max_parallel, hosts_count):
+    """
+    Returns the number of hosts to run at the same time. In parallel, max_parallel is either a number of hosts or a
+    percentage of the hosts, 0 meaning all hosts at once.
+
+    >>> get_concurrency('serial', 16, 120)
+    1
+    >>> get_concurrency('parallel', 16, 120)
+    16
+    >>> get_concurrency('parallel', 16, 4)
+    4
+    >>> get_concurrency('parallel', '25%', 120)
+    30
+    >>> get_concurrency('parallel', '10%', 4)
+    1
+    >>> get_concurrency('parallel', 0, 120)
+    120
+    """
+    if fabric_execution_strategy != 'parallel' or not hosts_count:
+        return 1
+    max_parallel = str(max_parallel).strip()
+    if max_parallel.endswith('%'):
+        concurrency = int(hosts_count * float(max_parallel[:-1]) / 100)
+    else:
+        concurrency = int(max_parallel or 0) or hosts_count
+    return max(min(concurrency, hosts_count), 1)
+
+
+def get_host_result(status, return_code, duration, message=None):
+    return {
+        'status': status,
+        'return_code': return_code,
+        'duration': round(duration, 3),
+        'message': message,
+        'ended_at': datetime.datetime.utcnow(),
+    }
+
+
+def get_failed_hosts(results):
+    """
+    >>> results = OrderedDict([('10.0.0.1', {'status': 'success'}), ('10.0.0.2', {'status': 'timeout'}),
+    ...                        ('10.0.0.3', {'status': 'skipped'})])
+    >>> get_failed_hosts(results)
+    ['10.0.0.2', '10.0.0.3']
+    """
+    return [host for host, result in results.items() if result['status'] != HOST_STATUS_SUCCESS]
+
+
+class SSHExecutor(object):
+    """
+    Runs a fabric task on hosts, at most `concurrency` hosts at the same time.
+    A host not done after `host_timeout` seconds (0 for no limit) is killed and marked as timed out.
+    Once `max_failures` hosts (0 for no limit) have failed, the hosts not started yet are skipped.
+    Hosts are served by the workers of the SSH connection pool if given, by workers started for this run otherwise.
+    """
+
+    def __init__(self, concurrency, host_timeout, max_failures, log_file, ssh_pool=None):
+        self._concurrency = max(int(concurrency), 1)
+        self._host_timeout = float(host_timeout or 0)
+        self._max_failures = int(max_failures or 0)
+        self._log_file = log_file
+        self._ssh_pool = ssh_pool
+
+    @property
+    def concurrency(self):
+        return self._concurrency
+
+    def _start(self, task_name, host, args, kwargs):
+        worker = self._ssh_pool.get_worker(host) if self._ssh_pool else SSHHostWorker(host, self._log_file)
+        worker.submit(task_name, args, kwargs)
+        return {'worker': worker, 'start': time.time()}
+
+    def _release(self, running, killed=False):
+        worker = running['worker']
+        if self._ssh_pool and killed:
+            self._ssh_pool.discard(worker.host)
+        elif not self._ssh_pool and killed:
+            worker.kill()
+        elif not self._ssh_pool:
+            worker.close()
+
+    def _poll(self, running):
+        """
+        Returns the result of the running host if it is done, None otherwise
+        """
+        duration = time.time() - running['start']
+        outcome = running['worker'].poll()
+        if outcome:
+            status, return_code = outcome
+            self._release(running, killed=status == 'error')
+            if status == 'error':
+                return self._get_result(HOST_STATUS_FAILED, None, duration, return_code)
+            if return_code == 0:
+                return self._get_result(HOST_STATUS_SUCCESS, return_code, duration)
+            return self._get_result(HOST_STATUS_FAILED, return_code, duration,
+                                    'exited with code {0}'.format(return_code))
+        if self._host_timeout and duration > self._host_timeout:
+            self._release(running, killed=True)
+            return self._get_result(HOST_STATUS_TIMEOUT, None, duration,
+                                    'timed out after {0:.0f}s'.format(self._host_timeout))
+        return None
+
+    def _get_result(self, status, return_code, duration, message=None):
+        return get_host_result(status, return_code, duration, message)
+
+    def run(self, hosts, task_name, *args, **kwargs):
+        """
+        Runs the fabric task of the fabfile with the given arguments on every host
+        Returns the results by host, in hosts order
+        """
+        results = OrderedDict((host, None) for host in hosts)
+        pending = list(results.keys())
+        running = OrderedDict()
+        failures = 0
+        try:
+            while pending or running:
+                aborted = self._max_failures and failures >= self._max_failures
+                while pending and not aborted and len(running) < self._concurrency:
+                    host = pending.pop(0)
+                    running[host] = self._start(task_name, host, args, kwargs)
+                for host in list(running.keys()):
+                    result = self._poll(running[host])
+                    if result:
+                        del running[host]
+                        results[host] = result
+                        if result['status'] != HOST_STATUS_SUCCESS:
+                            failures += 1
+                            log("Host {0}: {1}".format(host, result['message']), self._log_file)
+                if aborted and pending:
+                    log("{0} host(s) failed, skipping the {1} host(s) not started yet".format(
+                        failures, len(pending)), self._log_file)
+                    for host in pending:
+                        results[host] = self._get_result(HOST_STATUS_SKIPPED, None, 0,
+                                                         'skipped after {0} failure(s)'.format(failures))
+                    pending = []
+                if running:
+                    time.sleep(POLL_INTERVAL)
+        finally:
+            for host in running:
+                self._release(running[host], killed=True)
+        return results
+
+
+def get_ssh_executor(config, fabric_execution_strategy, hosts_count, log_file, ssh_pool=None):
+    """
+    Returns the executor configured for the execution strategy, serial or parallel
+
+    >>> get_ssh_executor({}, 'parallel', 120, None).concurrency
+    16
+    >>> executor = get_ssh_executor({'ssh_max_parallel': '50%', 'ssh_host_timeout': 900, 'ssh_max_failures': 2},
+    ...                             'parallel', 120, None)
+    >>> executor.concurrency, executor._host_timeout, executor._max_failures
+    (60, 900.0, 2)
+    >>> get_ssh_executor({'ssh_max_parallel': '50%'}, 'serial', 120, None).concurrency
+    1
+    """
+    return SSHExecutor(get_concurrency(fabric_execution_strategy,
+                                       config.get('ssh_max_parallel', DEFAULT_SSH_MAX_PARALLEL), hosts_count),
+                       config.get('ssh_host_timeout', DEFAULT_SSH_HOST_TIMEOUT),
+                       config.get('ssh_max_failures', DEFAULT_SSH_MAX_FAILURES),
+                       log_file, ssh_pool)
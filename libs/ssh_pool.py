@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Library keeping SSH connections to instances open for the duration of a job.
+    Each host is served by a worker process running fabric tasks one after the other: fabric caches the connection
+    to the host in the process, so every task reuses it, each command running in its own channel of the connection.
+"""
+
+from copy import copy
+from multiprocessing import Pipe, Process
+
+from fabric.api import env, execute as fab_execute
+from fabric.network import disconnect_all
+
+DEFAULT_SSH_KEEPALIVE = 30
+
+# Stands for the job log file in tasks arguments: the file is inherited by the worker process, not sent to it
+LOG_FILE_ARG = '__ghost_log_file__'
+
+
+def _get_task(task_name):
+    import fabfile
+    # Each worker runs its tasks on a single host
+    task = copy(getattr(fabfile, task_name))
+    setattr(task, 'serial', True)
+    setattr(task, 'parallel', False)
+    return task
+
+
+def _serve(connection, host, keepalive, log_file):
+    """
+    Runs the fabric tasks received on the connection on the host, until the connection is closed
+    """
+    env.keepalive = keepalive
+    try:
+        while True:
+            try:
+                request = connection.recv()
+            except EOFError:
+                break
+            if request is None:
+                break
+            task_name, args, kwargs = request
+            args = [log_file if arg == LOG_FILE_ARG else arg for arg in args]
+            try:
+                connection.send(('done', fab_execute(_get_task(task_name), *args, hosts=[host], **kwargs).get(host)))
+            except BaseException as e:
+                # Fabric aborts with SystemExit
+                connection.send(('error', str(e) or repr(e)))
+    finally:
+        disconnect_all()
+        connection.close()
+
+
+class SSHHostWorker(object):
+    """
+    Process running fabric tasks on a host through a single SSH connection
+    """
+
+    def __init__(self, host, log_file, keepalive=DEFAULT_SSH_KEEPALIVE):
+        self.host = host
+        self._log_file = log_file
+        self._connection, child_connection = Pipe()
+        self._process = Process(target=_serve, args=(child_connection, host, keepalive, log_file))
+        self._process.daemon = True
+        self._process.start()
+        child_connection.close()
+
+    def submit(self, task_name, args, kwargs):
+        self._connection.send((task_name, [LOG_FILE_ARG if arg is self._log_file else arg for arg in args],
+                               kwargs))
+
+    def poll(self):
+        """
+        Returns the outcome of the submitted task, ('done', return code) or ('error', message), None if running
+        """
+        if self._connection.poll():
+            try:
+                return self._connection.recv()
+            except EOFError:
+                pass
+        if not self._process.is_alive():
+            return 'error', 'process exited with code {0}'.format(self._process.exitcode)
+        return None
+
+    def is_alive(self):
+        return self._process.is_alive()
+
+    def close(self):
+        try:
+            self._connection.send(None)
+        except (IOError, OSError):
+            pass
+        self._process.join(5)
+        self.kill()
+
+    def kill(self):
+        if self._process.is_alive():
+            self._process.terminate()
+        self._process.join()
+        self._connection.close()
+
+
+class SSHConnectionPool(object):
+    """
+    Workers by host, shared by every remote execution of a job (modules, safe deployment batches, scripts)
+    """
+
+    def __init__(self, log_file, keepalive=DEFAULT_SSH_KEEPALIVE):
+        self._log_file = log_file
+        self._keepalive = keepalive
+        self._workers = {}
+
+    def get_worker(self, host):
+        worker = self._workers.get(host)
+        if not worker or not worker.is_alive():
+            worker = SSHHostWorker(host, self._log_file, self._keepalive)
+            self._workers[host] = worker
+        return worker
+
+    def discard(self, host):
+        """
+        Kills the worker of the host, which is started again on next use
+        """
+        worker = self._workers.pop(host, None)
+        if worker:
+            worker.kill()
+
+    def close(self):
+        for host in list(self._workers.keys()):
+            self._workers.pop(host).close()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Library to measure the duration of the phases of a job
+"""
+
+import time
+from contextlib import contextmanager
+
+
+class PhaseTimer(object):
+    """
+    Accumulates the wall-clock duration of named phases, in seconds.
+    A phase run several times (e.g. host pushes of each safe deployment group) is summed up.
+
+    >>> clock = iter([10.0, 12.5, 20.0, 21.0, 30.0, 30.25]).next
+    >>> timer = PhaseTimer(clock=clock)
+    >>> with timer.phase('mirror_fetch'):
+    ...     pass
+    >>> with timer.phase('host_push'):
+    ...     pass
+    >>> with timer.phase('host_push'):
+    ...     pass
+    >>> sorted(timer.as_dict().items())
+    [('host_push', 1.25), ('mirror_fetch', 2.5)]
+
+    Failed phases are measured too:
+
+    >>> timer = PhaseTimer(clock=iter([0.0, 1.0]).next)
+    >>> with timer.phase('buildpack'):
+    ...     raise ValueError('failed')
+    Traceback (most recent call last):
+    ValueError: failed
+    >>> timer.as_dict()
+    {'buildpack': 1.0}
+    """
+
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._durations = {}
+
+    def add(self, name, seconds):
+        self._durations[name] = self._durations.get(name, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name):
+        start = self._clock()
+        try:
+            yield
+        finally:
+            self.add(name, self._clock() - start)
+
+    def as_dict(self):
+        return dict((name, round(seconds, 3)) for name, seconds in self._durations.items())
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Library managing the modules build workspaces kept under /ghost between deployments
+"""
+
+import os
+
+from ghost_tools import gcall
+from libs.locks import FairFileLock
+
+WORKSPACES_ROOT = '/ghost'
+WORKSPACE_MODES = ['clean', 'persistent']
+
+DEFAULT_WORKSPACES_MAX_SIZE = 51200
+
+# Files identifying a module workspace: a git clone, or the metadata written by every build
+WORKSPACE_MARKERS = ['.git', '.ghost-metadata']
+
+# Colors of blue/green apps, whose workspaces are one level deeper than the app path
+WORKSPACE_COLORS = ['blue', 'green']
+
+
+def get_workspace_mode(module):
+    """
+    Returns the workspace mode of a module: 'clean' workspaces only keep the checked out sources between
+    deployments, 'persistent' workspaces also keep the files ignored by git (build outputs and caches)
+
+    >>> get_workspace_mode({'name': 'mod1'})
+    'clean'
+    >>> get_workspace_mode({'name': 'mod1', 'workspace_mode': 'persistent'})
+    'persistent'
+    """
+    return module.get('workspace_mode') or 'clean'
+
+
+def get_workspace_lock_path(workspace_path, root=WORKSPACES_ROOT):
+    """
+    Returns the lock path held by jobs while they use the workspace
+
+    >>> get_workspace_lock_path('/ghost/AppName/prod/webfront/blue/mod1')
+    '/ghost/.locks/workspaces/AppName/prod/webfront/blue/mod1'
+    """
+    return os.path.join(root, '.locks', 'workspaces', os.path.relpath(workspace_path, root))
+
+
+def is_workspace(path):
+    return any(os.path.exists(os.path.join(path, marker)) for marker in WORKSPACE_MARKERS)
+
+
+def list_workspaces(root=WORKSPACES_ROOT):
+    """
+    Returns the paths of the modules workspaces of every app under root, in
+    root/<app>/<env>/<role>/<module> or root/<app>/<env>/<role>/<color>/<module>
+
+    >>> import tempfile, shutil
+    >>> root = tempfile.mkdtemp()
+    >>> for path in ['app1/prod/web/mod1/.git', 'app1/prod/web/mod2/.git', 'app2/prod/web/blue/mod1/.git',
+    ...              'app2/prod/web/blue/mod2/.ghost-metadata', '.mirrors/git@github.com:claranet/ghost.git/refs']:
+    ...     os.makedirs(os.path.join(root, path))
+    >>> [os.path.relpath(path, root) for path in list_workspaces(root)]
+    ['app1/prod/web/mod1', 'app1/prod/web/mod2', 'app2/prod/web/blue/mod1', 'app2/prod/web/blue/mod2']
+    >>> shutil.rmtree(root)
+    """
+    workspaces = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        depth = len(os.path.relpath(dirpath, root).split(os.sep)) if dirpath != root else 0
+        # Skip mirrors, caches, locks and extracted packages
+        dirnames[:] = sorted(name for name in dirnames if not name.startswith('.'))
+        if depth < 3:
+            continue
+        if depth == 3 or os.path.basename(dirpath) in WORKSPACE_COLORS:
+            workspaces.extend(os.path.join(dirpath, name) for name in dirnames
+                              if is_workspace(os.path.join(dirpath, name)))
+            dirnames[:] = [name for name in dirnames if depth == 3 and name in WORKSPACE_COLORS]
+        else:
+            dirnames[:] = []
+    return sorted(workspaces)
+
+
+def touch_workspace(workspace_path):
+    """
+    Marks the workspace as recently used
+    """
+    if os.path.isdir(workspace_path):
+        os.utime(workspace_path, None)
+
+
+def remove_workspace(workspace_path, log_file):
+    gcall('chmod -R u+rwx "{p}"'.format(p=workspace_path), 'Update rights on workspace files', log_file)
+    gcall('rm -rf "{p}"'.format(p=workspace_path), 'Removing workspace {p}'.format(p=workspace_path), log_file)
+
+
+class WorkspaceLocks(object):
+    """
+    Locks held by a job on the workspaces it uses, from the sources checkout to the end of the job, so that the
+    disk manager never removes them. Locks are acquired in path order to prevent deadlocks.
+    """
+
+    def __init__(self, workspace_paths, log_file, root=WORKSPACES_ROOT):
+        self._locks = [FairFileLock(get_workspace_lock_path(path, root), log_file, 'on workspace {p}'.format(p=path))
+                       for path in sorted(set(workspace_paths))]
+
+    def __enter__(self):
+        acquired = []
+        try:
+            for lock in self._locks:
+                lock.acquire()
+                acquired.append(lock)
+        except:
+            for lock in reversed(acquired):
+                lock.release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for lock in reversed(self._locks):
+            lock.release()
+
@@ -176,6 +176,24 @@ apps_schema = {
                 'pre_deploy': {'type': 'string'},
                 'post_deploy': {'type': 'string'},
                 'after_all_deploy': {'type': 'string'},
+                'build_cache': {
+                    'type': 'dict',
+                    'schema': {
+                        'paths': {'type': 'list', 'schema': {'type': 'string'}},
+                        'key_files': {'type': 'list', 'schema': {'type': 'string'}},
+                    },
+                },
+                'workspace_mode': {
+                    'type': 'string',
+                    'allowed': ['clean', 'persistent'],
+                },
+                'packaging': {
+                    'type': 'dict',
+                    'schema': {
+                        'exclude': {'type': 'list', 'schema': {'type': 'string'}},
+                        'include': {'type': 'list', 'schema': {'type': 'string'}},
+                    },
+                },
                 'path': {'type': 'string',
                          'regex': '^(/[a-zA-Z0-9\.\-\_]+)+$',
                          'required': True},
@@ -41,6 +41,36 @@ deployment_schema = {
         'type': 'string',
         'readonly': True
     },
+    'package_key_path': {
+        'type': 'string',
+        'readonly': True,
+        'nullable': True
+    },
+    'package_size': {
+        'type': 'integer',
+        'readonly': True,
+        'nullable': True
+    },
+    'package_content_size': {
+        'type': 'integer',
+        'readonly': True,
+        'nullable': True
+    },
+    'package_file_count': {
+        'type': 'integer',
+        'readonly': True,
+        'nullable': True
+    },
+    'timings': {
+        'type': 'dict',
+        'readonly': True,
+        'nullable': True
+    },
+    'build_hash': {
+        'type': 'string',
+        'readonly': True,
+        'nullable': True
+    },
     'module_path': {
         'type': 'string',
         'readonly': True
@@ -56,6 +86,7 @@ deployments = {
     'resource_methods': ['GET'],
     'item_methods': ['GET'],
     'mongo_indexes': {
-        'app_id-modules-timestamp': [('app_id', 1), ('module', 1), ('timestamp', -1)]
+        'app_id-modules-timestamp': [('app_id', 1), ('module', 1), ('timestamp', -1)],
+        'app_id-modules-build_hash': [('app_id', 1), ('module', 1), ('build_hash', 1)]
     }
 }
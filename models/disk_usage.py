@@ -0,0 +1,47 @@
+disk_usage_schema = {
+    'host': {
+        'type': 'string',
+        'readonly': True
+    },
+    'store': {
+        'type': 'string',
+        'readonly': True
+    },
+    'path': {
+        'type': 'string',
+        'readonly': True
+    },
+    'size': {
+        'type': 'integer',
+        'readonly': True
+    },
+    'max_size': {
+        'type': 'integer',
+        'readonly': True
+    },
+    'entries': {
+        'type': 'integer',
+        'readonly': True
+    },
+    'evicted_entries': {
+        'type': 'integer',
+        'readonly': True
+    },
+    'evicted_size': {
+        'type': 'integer',
+        'readonly': True
+    }
+}
+
+disk_usage = {
+    'datasource': {
+        'source': 'disk_usage'
+    },
+    'item_title': 'disk_usage',
+    'schema': disk_usage_schema,
+    'resource_methods': ['GET'],
+    'item_methods': ['GET'],
+    'mongo_indexes': {
+        'host-store': [('host', 1), ('store', 1)]
+    }
+}
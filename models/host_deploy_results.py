@@ -0,0 +1,42 @@
+host_deploy_results_schema = {
+    'job_id': {
+        'type': 'string',
+        'readonly': True
+    },
+    'run_id': {
+        'type': 'string',
+        'readonly': True
+    },
+    'host': {
+        'type': 'string',
+        'readonly': True
+    },
+    'hostname': {
+        'type': 'string',
+        'readonly': True,
+        'nullable': True
+    },
+    'status': {
+        'type': 'string',
+        'readonly': True,
+        'allowed': ['starting', 'started', 'done', 'failed']
+    },
+    'return_code': {
+        'type': 'integer',
+        'readonly': True,
+        'nullable': True
+    }
+}
+
+host_deploy_results = {
+    'datasource': {
+        'source': 'host_deploy_results'
+    },
+    'item_title': 'host_deploy_result',
+    'schema': host_deploy_results_schema,
+    'resource_methods': ['GET'],
+    'item_methods': ['GET'],
+    'mongo_indexes': {
+        'job_id-run_id-host': [('job_id', 1), ('run_id', 1), ('host', 1)]
+    }
+}
@@ -46,6 +46,22 @@ jobs_schema = {
             'type': 'string'
         }
     },
+    'hosts_results': {
+        'type': 'list',
+        'readonly': True,
+        'schema': {
+            'type': 'dict',
+            'schema': {
+                'host': {'type': 'string'},
+                'module': {'type': 'string', 'nullable': True},
+                'status': {'type': 'string', 'allowed': ['success', 'failed', 'timeout', 'skipped']},
+                'return_code': {'type': 'integer', 'nullable': True},
+                'duration': {'type': 'float'},
+                'message': {'type': 'string', 'nullable': True},
+                'ended_at': {'type': 'datetime'},
+            }
+        }
+    },
     'modules': {
         'type': 'list',
         'schema': {
@@ -59,6 +75,10 @@ jobs_schema = {
                     'type': 'string',
                     'default': 'HEAD'
                 },
+                'clean_build': {
+                    'type': 'boolean',
+                    'default': False
+                },
                 'deploy_id': {
                     'type': 'string',
                     'readonly': True
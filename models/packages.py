@@ -0,0 +1,77 @@
+package_schema = {
+    'app_id': {
+        'type': 'objectid',
+        'readonly': True,
+        'data_relation': {
+            'resource': 'apps',
+            'field': '_id',
+            'embeddable': True
+        }
+    },
+    'deploy_id': {
+        'type': 'objectid',
+        'readonly': True,
+        'nullable': True,
+        'data_relation': {
+            'resource': 'deployments',
+            'field': '_id',
+            'embeddable': True
+        }
+    },
+    'module': {
+        'type': 'string',
+        'readonly': True
+    },
+    'color': {
+        'type': 'string',
+        'readonly': True,
+        'nullable': True
+    },
+    'path': {
+        'type': 'string',
+        'readonly': True
+    },
+    'package': {
+        'type': 'string',
+        'readonly': True
+    },
+    'key_path': {
+        'type': 'string',
+        'readonly': True,
+        'nullable': True
+    },
+    'timestamp': {
+        'type': 'integer',
+        'readonly': True
+    },
+    'size': {
+        'type': 'integer',
+        'readonly': True,
+        'nullable': True
+    },
+    'sidecars': {
+        'type': 'list',
+        'readonly': True,
+        'schema': {
+            'type': 'string'
+        }
+    },
+    'referenced': {
+        'type': 'boolean',
+        'readonly': True
+    }
+}
+
+packages = {
+    'datasource': {
+        'source': 'packages'
+    },
+    'item_title': 'package',
+    'schema': package_schema,
+    'resource_methods': ['GET'],
+    'item_methods': ['GET'],
+    'mongo_indexes': {
+        'path-package': [('path', 1), ('package', 1)],
+        'path-module-referenced-timestamp': [('path', 1), ('module', 1), ('referenced', 1), ('timestamp', -1)]
+    }
+}
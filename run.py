@@ -29,6 +29,7 @@ from models.webhook_invocations import webhook_invocations, webhook_invocation_s
 
 from ghost_tools import get_rq_name_from_app, boolify
 from ghost_blueprints import commands_blueprint, job_logs_blueprint, version_blueprint, websocket_token_blueprint
+from ghost_blueprints import host_deploy_results_blueprint
 from ghost_api import ghost_api_bluegreen_is_enabled, ghost_api_enable_green_app
 from ghost_api import ghost_api_delete_alter_ego_app, ghost_api_clean_bluegreen_app
 from ghost_api import initialize_app_modules, check_and_set_app_fields_state
@@ -372,6 +373,9 @@ def pre_insert_webhook_invocation(items):
     # Launches desired jobs
     jobs = []
     if validated:
+        # Whatever the job to start, the repository refs have changed
+        webhook_handler.refresh_git_refs(ghost.ghost_redis_connection)
+
         jobs, results, err = webhook_handler.start_jobs()
 
         if err:
@@ -454,6 +458,7 @@ ghost.register_blueprint(lxd_blueprint)
 ghost.register_blueprint(version_blueprint)
 ghost.register_blueprint(job_logs_blueprint)
 ghost.register_blueprint(websocket_token_blueprint)
+ghost.register_blueprint(host_deploy_results_blueprint)
 
 # Register Websocket server
 ws = create_ws(ghost)
@@ -1,6 +1,6 @@
 from multiprocessing import Process, active_children
 from setproctitle import setproctitle
-from time import sleep
+from time import sleep, time
 import signal
 import sys
 import traceback
@@ -16,6 +16,11 @@ logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s %(mes
 from settings import MONGO_DBNAME, MONGO_HOST, MONGO_PORT, REDIS_HOST, RQ_JOB_TIMEOUT
 
 from ghost_tools import config, get_rq_name_from_app, get_app_from_rq_name, get_app_colored_env
+from libs.disk_manager import manage_disk_stores, DEFAULT_DISK_MANAGER_INTERVAL
+from libs.git_maintenance import maintain_git_mirrors
+
+GIT_MIRRORS_MAINTENANCE_LOG = '/var/log/ghost/git_mirrors_maintenance.log'
+DISK_MANAGER_LOG = '/var/log/ghost/disk_manager.log'
 
 def create_rq_queue_and_worker(rqworker_name, ghost_rq_queues, ghost_rq_workers, ghost_redis_connection):
     ghost_rq_queues[rqworker_name] = Queue(name=rqworker_name, connection=ghost_redis_connection, default_timeout=RQ_JOB_TIMEOUT)
@@ -42,6 +47,35 @@ def delete_rq_queue_and_worker(rqworker_name, ghost_rq_queues, ghost_rq_workers)
     del ghost_rq_workers[rqworker_name]
     logging.info('Killed rqworker {0}'.format(rqworker_name))
 
+def run_git_mirrors_maintenance():
+    setproctitle('git-mirrors-maintenance')
+    stats_collection = MongoClient(host=MONGO_HOST, port=MONGO_PORT)[MONGO_DBNAME]['git_mirrors']
+    with open(GIT_MIRRORS_MAINTENANCE_LOG, 'a', 0) as log_file:
+        maintain_git_mirrors(config, stats_collection, log_file)
+
+def start_git_mirrors_maintenance(maintenance_process):
+    # A single maintenance process at a time, mirrors are skipped until their maintenance interval is over
+    if maintenance_process and maintenance_process.is_alive():
+        return maintenance_process
+    maintenance_process = Process(target=run_git_mirrors_maintenance)
+    maintenance_process.start()
+    return maintenance_process
+
+def run_disk_manager():
+    setproctitle('disk-manager')
+    stats_collection = MongoClient(host=MONGO_HOST, port=MONGO_PORT)[MONGO_DBNAME]['disk_usage']
+    with open(DISK_MANAGER_LOG, 'a', 0) as log_file:
+        manage_disk_stores(config, stats_collection, log_file)
+
+def start_disk_manager(disk_manager_process, last_start):
+    # A single disk manager process at a time, started at most once per interval
+    interval = int(config.get('disk_manager_interval', DEFAULT_DISK_MANAGER_INTERVAL))
+    if (disk_manager_process and disk_manager_process.is_alive()) or time() - last_start < interval:
+        return disk_manager_process, last_start
+    disk_manager_process = Process(target=run_disk_manager)
+    disk_manager_process.start()
+    return disk_manager_process, time()
+
 def manage_rq_workers():
     ghost_redis_connection = Redis(host=REDIS_HOST)
     ghost_rq_queues = {}
@@ -66,6 +100,9 @@ def manage_rq_workers():
     signal.signal(signal.SIGQUIT, signal_handler)
 
     apps_db = MongoClient(host=MONGO_HOST, port=MONGO_PORT)[MONGO_DBNAME]['apps']
+    git_mirrors_maintenance = None
+    disk_manager = None
+    disk_manager_last_start = 0
 
     # Manage RQ workers for existing apps, terminating RQ workers with no
     while True:
@@ -112,6 +149,12 @@ def manage_rq_workers():
                     if not found:
                         delete_rq_queue_and_worker(rqworker_name, ghost_rq_queues, ghost_rq_workers)
 
+            # Run the git mirrors housekeeping out of the deployment jobs
+            git_mirrors_maintenance = start_git_mirrors_maintenance(git_mirrors_maintenance)
+
+            # Evict the least recently used local files beyond the disk quotas
+            disk_manager, disk_manager_last_start = start_disk_manager(disk_manager, disk_manager_last_start)
+
         except:
             logging.error("an exception occurred: {}".format(sys.exc_value))
             traceback.print_exc()
@@ -19,8 +19,22 @@ modules = [
     "ghost_data",
     "ghost_tools",
     "libs.blue_green",
+    "libs.build_cache",
     "libs.deploy",
+    "libs.deploy_agent",
+    "libs.disk_manager",
     "libs.git_helper",
+    "libs.git_maintenance",
+    "libs.host_deploy_results",
+    "libs.locks",
+    "libs.manifest",
+    "libs.package_catalog",
+    "libs.packaging",
+    "libs.s3_sources",
+    "libs.ssh_executor",
+    "libs.ssh_pool",
+    "libs.timings",
+    "libs.workspaces",
     "libs.host_deployment_manager",
     "libs.builders.image_builder",
     "libs.builders.image_builder_aws",
@@ -2,6 +2,9 @@ import os
 from models import jobs
 from models import apps
 from models import deployments
+from models import packages
+from models import disk_usage
+from models import host_deploy_results
 from models import job_enqueueings
 from models import webhooks, webhook_invocations
 from botosts.aws_connection import AWSConnection
@@ -74,6 +77,9 @@ DOMAIN = {
     'jobs': jobs.jobs,
     'apps': apps.apps,
     'deployments': deployments.deployments,
+    'packages': packages.packages,
+    'disk_usage': disk_usage.disk_usage,
+    'host_deploy_results': host_deploy_results.host_deploy_results,
     'webhook_invocations': webhook_invocations.webhook_invocations,
     'webhook_all_invocations': webhook_invocations.webhook_all_invocations,
     'webhooks': webhooks.webhooks,
@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+
+import mock
+
+from libs.build_cache import BuildCache, get_build_cache_key
+
+
+APP = {'_id': '5a0d3e08a2b9c2b5a1234567'}
+MODULE = {'name': 'mod1', 'build_cache': {'paths': ['vendor'], 'key_files': ['composer.lock']}}
+
+
+def _create_clone(lock_content='{"packages": []}', vendor_content=None):
+    clone_path = tempfile.mkdtemp()
+    with open(os.path.join(clone_path, 'composer.lock'), 'w') as f:
+        f.write(lock_content)
+    if vendor_content:
+        os.makedirs(os.path.join(clone_path, 'vendor', 'symfony'))
+        with open(os.path.join(clone_path, 'vendor', 'symfony', 'autoload.php'), 'w') as f:
+            f.write(vendor_content)
+    return clone_path
+
+
+@mock.patch('libs.build_cache.log')
+def test_build_cache_save_and_restore(log):
+    root = tempfile.mkdtemp()
+    built_clone = _create_clone(vendor_content='<?php // 1.0')
+    new_clone = _create_clone()
+    try:
+        with tempfile.TemporaryFile() as log_file:
+            cache = BuildCache({}, log_file, root=root)
+            key = get_build_cache_key(APP, MODULE, built_clone)
+            assert key == get_build_cache_key(APP, MODULE, new_clone)
+
+            assert not cache.restore(key, new_clone)
+            cache.save(key, built_clone, ['vendor'])
+            assert os.listdir(root) == [key + '.tar.gz']
+
+            assert cache.restore(key, new_clone)
+        with open(os.path.join(new_clone, 'vendor', 'symfony', 'autoload.php')) as f:
+            assert f.read() == '<?php // 1.0'
+    finally:
+        for path in (root, built_clone, new_clone):
+            shutil.rmtree(path)
+
+
+@mock.patch('libs.build_cache.log')
+def test_build_cache_evicts_least_recently_used(log):
+    root = tempfile.mkdtemp()
+    clones = [_create_clone(lock_content=str(i), vendor_content=os.urandom(600 * 1024).encode('hex'))
+              for i in range(3)]
+    try:
+        with tempfile.TemporaryFile() as log_file:
+            # Each cache is about 600KB once compressed
+            cache = BuildCache({'build_cache_max_size': 1.5}, log_file, root=root)
+            keys = [get_build_cache_key(APP, MODULE, clone) for clone in clones]
+            cache.save(keys[0], clones[0], ['vendor'])
+            cache.save(keys[1], clones[1], ['vendor'])
+            os.utime(os.path.join(root, keys[0] + '.tar.gz'), (0, 0))
+            os.utime(os.path.join(root, keys[1] + '.tar.gz'), (1, 1))
+            # Using the first cache makes the second one the least recently used
+            assert cache.restore(keys[0], clones[2])
+            cache.save(keys[2], clones[2], ['vendor'])
+
+        assert sorted(os.listdir(root)) == sorted([keys[0] + '.tar.gz', keys[2] + '.tar.gz'])
+    finally:
+        shutil.rmtree(root)
+        for clone in clones:
+            shutil.rmtree(clone)
+
+
+@mock.patch('libs.build_cache.log')
+def test_build_cache_s3_tier(log):
+    root = tempfile.mkdtemp()
+    other_root = tempfile.mkdtemp()
+    built_clone = _create_clone(vendor_content='<?php // 1.0')
+    new_clone = _create_clone()
+    uploaded = {}
+
+    def new_key(key_path):
+        s3_key = mock.MagicMock()
+        s3_key.set_contents_from_filename.side_effect = lambda path: uploaded.update({key_path: open(path).read()})
+        return s3_key
+
+    def get_key(key_path):
+        if key_path not in uploaded:
+            return None
+        s3_key = mock.MagicMock()
+        s3_key.get_contents_to_filename.side_effect = lambda path: open(path, 'w').write(uploaded[key_path])
+        return s3_key
+
+    bucket = mock.MagicMock()
+    bucket.new_key.side_effect = new_key
+    bucket.get_key.side_effect = get_key
+    try:
+        with tempfile.TemporaryFile() as log_file:
+            key = get_build_cache_key(APP, MODULE, built_clone)
+            BuildCache({'build_cache_s3': True}, log_file, bucket, root=root).save(key, built_clone, ['vendor'])
+            assert uploaded.keys() == ['ghost-build-cache/{0}.tar.gz'.format(key)]
+
+            # Another Ghost instance without local cache
+            assert BuildCache({'build_cache_s3': True}, log_file, bucket, root=other_root).restore(key, new_clone)
+        assert os.path.isfile(os.path.join(new_clone, 'vendor', 'symfony', 'autoload.php'))
+    finally:
+        for path in (root, other_root, built_clone, new_clone):
+            shutil.rmtree(path)
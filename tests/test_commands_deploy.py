@@ -0,0 +1,42 @@
+import pytest
+from mock import mock, MagicMock
+
+from commands.deploy import Deploy
+from ghost_tools import GCallException
+from tests.helpers import get_test_application, mocked_logger, LOG_FILE
+
+
+def _get_worker(test_app):
+    worker = MagicMock()
+    worker.app = test_app
+    worker.job = {'_id': 'job_id', 'options': ['serial', '']}
+    worker.log_file = LOG_FILE
+    worker._config = {'bucket_s3': 'bucket', 'bucket_region': 'eu-west-1', 'deployment_build_concurrency': 4}
+    return worker
+
+
+@mock.patch('commands.deploy.cloud_connections')
+@mock.patch('commands.deploy.log', new=mocked_logger)
+def test_build_modules_reports_every_failure(cloud_connections):
+    modules = [{'name': 'mod1'}, {'name': 'mod2'}, {'name': 'mod3'}]
+    errors = {
+        'mod1': GCallException('ERROR: Buildpack execution failed'),
+        'mod3': IOError('No space left on device'),
+    }
+
+    def build_module(module):
+        if module['name'] in errors:
+            raise errors[module['name']]
+        return {'package': '1485857801_{0}_0d23e96'.format(module['name'])}
+
+    cmd = Deploy(_get_worker(get_test_application()))
+    cmd._build_module = MagicMock(side_effect=build_module)
+
+    with pytest.raises(GCallException) as excinfo:
+        cmd._build_modules(modules, 4)
+
+    # Every build ran to completion and both failures are reported
+    assert cmd._build_module.call_count == 3
+    assert 'mod1 (ERROR: Buildpack execution failed)' in str(excinfo.value)
+    assert 'mod3 (No space left on device)' in str(excinfo.value)
+    assert 'mod2' not in str(excinfo.value)
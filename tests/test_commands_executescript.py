@@ -171,7 +171,7 @@ def test_executescript_cmd_single_host_deep(get_ghost_env_variables,
     )
 
     launch_executescript.assert_called_once_with(
-        test_app, get_dummy_bash_script(), '/tmp', 0, '42', ['10.0.0.1'], 'serial', LOG_FILE, {})
+        test_app, get_dummy_bash_script(), '/tmp', 0, '42', ['10.0.0.1'], 'serial', LOG_FILE, {}, mock.ANY, worker.ssh_pool)
 
 
 @mock.patch('commands.executescript.cloud_connections')
@@ -281,4 +281,4 @@ def test_executescript_cmd_deep(cloud_connections,
             'sudoer_uid': 0,
             'jobid': worker.job['_id'],
             'env_vars': {},
-        })
+        }, hosts_results_recorder=mock.ANY, ssh_pool=worker.ssh_pool)
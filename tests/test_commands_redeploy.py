@@ -0,0 +1,88 @@
+from mock import mock, MagicMock
+
+from commands.redeploy import Redeploy
+from tests.helpers import get_test_application, mocked_logger, LOG_FILE, void
+
+
+def _get_worker(test_app):
+    worker = MagicMock()
+    worker.app = test_app
+    worker.job = {'_id': 'job_id', 'options': ['5a0d3e08a2b9c2b5a1234567', 'serial', '']}
+    worker.log_file = LOG_FILE
+    worker._config = {'bucket_s3': 'bucket', 'bucket_region': 'eu-west-1'}
+    worker._db.deploy_histories.find_one.return_value = {
+        'module': 'dummy', 'module_path': '/var/www/dummy', 'package': '1485857801_dummy_0d23e96'}
+
+    def assert_ok(status, message=None):
+        assert status == "done", "Status is {} and not done : {}".format(status, message)
+    worker.update_status = assert_ok
+    return worker
+
+
+@mock.patch('commands.redeploy.HostDeploymentManager')
+@mock.patch('commands.redeploy.execute_module_script_on_ghost')
+@mock.patch('commands.redeploy.clean_local_module_workspace', new=void)
+@mock.patch('commands.redeploy.set_referenced_package', new=void)
+@mock.patch('commands.redeploy.get_app_manifest')
+@mock.patch('commands.redeploy.cloud_connections')
+@mock.patch('commands.redeploy.log', new=mocked_logger)
+def test_redeploy_without_after_all_deploy(cloud_connections, get_app_manifest, execute_script, deploy_manager):
+    test_app = get_test_application()
+    for module in test_app['modules']:
+        module.pop('after_all_deploy', None)
+
+    cmd = Redeploy(_get_worker(test_app))
+    cmd._local_extract_package = MagicMock()
+    cmd.execute()
+
+    assert deploy_manager.return_value.deployment.call_count == 1
+    get_app_manifest.return_value.set_module_package.assert_called_once_with(
+        {'name': 'dummy', 'path': '/var/www/dummy'}, '1485857801_dummy_0d23e96', None)
+    assert not cmd._local_extract_package.called
+    assert not execute_script.called
+
+
+@mock.patch('commands.redeploy.HostDeploymentManager')
+@mock.patch('commands.redeploy.execute_module_script_on_ghost')
+@mock.patch('commands.redeploy.clean_local_module_workspace', new=void)
+@mock.patch('commands.redeploy.set_referenced_package', new=void)
+@mock.patch('commands.redeploy.get_app_manifest')
+@mock.patch('commands.redeploy.cloud_connections')
+@mock.patch('commands.redeploy.log', new=mocked_logger)
+def test_redeploy_with_after_all_deploy(cloud_connections, get_app_manifest, execute_script, deploy_manager):
+    test_app = get_test_application()
+    test_app['modules'][0]['after_all_deploy'] = 'ZWNobyBkb25l'
+
+    cmd = Redeploy(_get_worker(test_app))
+    cmd._local_extract_package = MagicMock(return_value='/ghost/test-app/test/webfront/dummy')
+    cmd.execute()
+
+    cmd._local_extract_package.assert_called_once_with(
+        {'name': 'dummy', 'path': '/var/www/dummy', 'after_all_deploy': 'ZWNobyBkb25l'}, '1485857801_dummy_0d23e96', None)
+    assert execute_script.call_args[0][2] == 'after_all_deploy'
+    assert execute_script.call_args[0][4] == '/ghost/test-app/test/webfront/dummy'
+
+
+@mock.patch('commands.redeploy.HostDeploymentManager')
+@mock.patch('commands.redeploy.execute_module_script_on_ghost')
+@mock.patch('commands.redeploy.clean_local_module_workspace', new=void)
+@mock.patch('commands.redeploy.set_referenced_package', new=void)
+@mock.patch('commands.redeploy.get_app_manifest')
+@mock.patch('commands.redeploy.cloud_connections')
+@mock.patch('commands.redeploy.log', new=mocked_logger)
+def test_redeploy_missing_package(cloud_connections, get_app_manifest, execute_script, deploy_manager):
+    test_app = get_test_application()
+    for module in test_app['modules']:
+        module.pop('after_all_deploy', None)
+    bucket = cloud_connections.get.return_value.return_value.get_connection.return_value.get_bucket.return_value
+    bucket.get_key.return_value = None
+    worker = _get_worker(test_app)
+    statuses = []
+    worker.update_status = lambda status, message=None: statuses.append(status)
+
+    Redeploy(worker).execute()
+
+    # Nothing changes when the package is missing
+    assert statuses == ['failed']
+    assert not get_app_manifest.return_value.save.called
+    assert not deploy_manager.called
@@ -0,0 +1,78 @@
+import datetime
+import json
+
+import mock
+
+from libs.deploy_agent import get_agent_heartbeats_prefix, get_agent_hosts, get_agent_reports_prefix
+from libs.deploy_agent import publish_agent_release, wait_agent_reports
+from libs.ssh_executor import get_failed_hosts
+
+APP_PATH = '/ghost/AppName/prod/webfront'
+
+
+def _report_keys(bucket, key_names, last_modified=None):
+    keys = []
+    for name in key_names:
+        key = mock.Mock()
+        key.name = name
+        key.last_modified = (last_modified or {}).get(name)
+        keys.append(key)
+    bucket.list.side_effect = lambda prefix: [key for key in keys if key.name.startswith(prefix)]
+
+
+def _timestamp(age):
+    return (datetime.datetime.utcnow() - datetime.timedelta(seconds=age)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+@mock.patch('libs.deploy_agent.log')
+def test_publish_agent_release(log):
+    bucket = mock.MagicMock()
+    release_id = publish_agent_release(bucket, APP_PATH, ['mod1', 'mod2'], ['10.0.0.1'], 600, None)
+
+    bucket.new_key.assert_called_once_with(APP_PATH + '/AGENT_RELEASE')
+    release = json.loads(bucket.new_key.return_value.set_contents_from_string.call_args[0][0])
+    assert release['release_id'] == release_id
+    assert release['modules'] == ['mod1', 'mod2']
+    assert release['hosts'] == ['10.0.0.1']
+
+
+@mock.patch('libs.deploy_agent.time.sleep')
+@mock.patch('libs.deploy_agent.log')
+def test_wait_agent_reports(log, sleep):
+    bucket = mock.MagicMock()
+    prefix = get_agent_reports_prefix(APP_PATH, 'release1')
+    _report_keys(bucket, [prefix + '10.0.0.1/0', prefix + '10.0.0.2/243', prefix + '10.0.0.9/0',
+                          get_agent_reports_prefix(APP_PATH, 'release0') + '10.0.0.3/0'])
+
+    results = wait_agent_reports(bucket, APP_PATH, 'release1', ['10.0.0.1', '10.0.0.2', '10.0.0.3'], 60, 0, None)
+
+    assert [result['status'] for result in results.values()] == ['success', 'failed', 'timeout']
+    assert results['10.0.0.2']['return_code'] == 243
+    assert get_failed_hosts(results) == ['10.0.0.2', '10.0.0.3']
+    # Reports of the release are removed once collected
+    bucket.delete_keys.assert_called_once_with([prefix + '10.0.0.1/0', prefix + '10.0.0.2/243', prefix + '10.0.0.9/0'])
+
+
+@mock.patch('libs.deploy_agent.time')
+@mock.patch('libs.deploy_agent.log')
+def test_wait_agent_reports_ack_timeout(log, time):
+    time.time.side_effect = [0, 0, 100, 2000, 2000]
+    bucket = mock.MagicMock()
+    prefix = get_agent_reports_prefix(APP_PATH, 'release1')
+    _report_keys(bucket, [prefix + '10.0.0.1/started'])
+
+    results = wait_agent_reports(bucket, APP_PATH, 'release1', ['10.0.0.1', '10.0.0.2'], 60, 1800, None)
+
+    # The host which never acknowledged the release fails without waiting for the deployment timeout
+    assert [result['status'] for result in results.values()] == ['timeout', 'timeout']
+    assert 'did not acknowledge' in results['10.0.0.2']['message']
+    assert 'did not acknowledge' not in results['10.0.0.1']['message']
+
+
+def test_get_agent_hosts():
+    bucket = mock.MagicMock()
+    prefix = get_agent_heartbeats_prefix(APP_PATH)
+    _report_keys(bucket, [prefix + '10.0.0.1', prefix + '10.0.0.2'],
+                 {prefix + '10.0.0.1': _timestamp(30), prefix + '10.0.0.2': _timestamp(3600)})
+
+    assert get_agent_hosts(bucket, APP_PATH, ['10.0.0.3', '10.0.0.2', '10.0.0.1'], 610) == ['10.0.0.1']
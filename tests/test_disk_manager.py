@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+import time
+
+import mock
+
+from libs.disk_manager import DiskStore, list_job_logs, manage_disk_stores, _JobEntryLock
+from libs.locks import FairFileLock, JobLockRegistry
+from libs.workspaces import WorkspaceLocks, get_workspace_lock_path, list_workspaces
+
+
+def _make_entry(path, size, mtime, is_workspace=True):
+    if is_workspace:
+        os.makedirs(os.path.join(path, '.git'))
+        with open(os.path.join(path, 'build.out'), 'w') as f:
+            f.write('x' * size)
+    else:
+        with open(path, 'w') as f:
+            f.write('x' * size)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+@mock.patch('libs.disk_manager.log')
+def test_workspaces_store_evicts_least_recently_used(log):
+    root = tempfile.mkdtemp()
+    log_file = open('/dev/null', 'w')
+    now = time.time()
+    store = DiskStore('workspaces', root, list_workspaces,
+                      lambda path, log_file: FairFileLock(get_workspace_lock_path(path, root), log_file),
+                      'workspaces_max_size', 51200)
+    try:
+        oldest = _make_entry(os.path.join(root, 'app1/prod/web/mod1'), 400 * 1024, now - 300)
+        locked = _make_entry(os.path.join(root, 'app2/prod/web/blue/mod1'), 400 * 1024, now - 200)
+        older = _make_entry(os.path.join(root, 'app2/prod/web/green/mod1'), 400 * 1024, now - 100)
+        recent = _make_entry(os.path.join(root, 'app3/prod/web/mod1'), 400 * 1024, now)
+
+        stats_collection = mock.MagicMock()
+        with WorkspaceLocks([locked], log_file, root=root):
+            manage_disk_stores({'workspaces_max_size': 1}, stats_collection, log_file, [store])
+
+        # The locked workspace is kept, the next least recently used one is removed instead
+        assert not os.path.exists(oldest) and not os.path.exists(older)
+        assert os.path.exists(locked) and os.path.exists(recent)
+        stats = stats_collection.update.call_args[0][1]['$set']
+        assert stats['store'] == 'workspaces'
+        assert stats['entries'] == 2 and stats['evicted_entries'] == 2
+        assert stats['size'] == 800 * 1024 and stats['max_size'] == 1024 * 1024
+    finally:
+        log_file.close()
+        shutil.rmtree(root)
+
+
+@mock.patch('libs.disk_manager.log')
+def test_job_logs_store_keeps_running_jobs_logs(log):
+    root = tempfile.mkdtemp()
+    locks_root = tempfile.mkdtemp()
+    log_file = open('/dev/null', 'w')
+    now = time.time()
+    registry = JobLockRegistry(locks_root)
+    store = DiskStore('job_logs', root, list_job_logs,
+                      lambda path, log_file: _JobEntryLock(JobLockRegistry(locks_root),
+                                                           os.path.basename(path)[:-len('.txt')]),
+                      'job_logs_max_size', 10240)
+    try:
+        running = _make_entry(os.path.join(root, 'running.txt'), 600 * 1024, now - 200, is_workspace=False)
+        done = _make_entry(os.path.join(root, 'done.txt'), 600 * 1024, now - 100, is_workspace=False)
+        registry.register('running')
+
+        stats = store.evict({'job_logs_max_size': 1}, log_file)
+
+        assert os.path.exists(running) and not os.path.exists(done)
+        assert stats['evicted_entries'] == 1 and stats['size'] == 600 * 1024
+    finally:
+        registry.unregister('running')
+        log_file.close()
+        shutil.rmtree(root)
+        shutil.rmtree(locks_root)
@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+
+import mock
+from sh import git
+
+from libs.git_helper import git_fetch_mirror_commit, git_update_submodules
+
+GIT_ENV = {
+    'GIT_AUTHOR_NAME': 'ghost', 'GIT_AUTHOR_EMAIL': 'ghost@example.com',
+    'GIT_COMMITTER_NAME': 'ghost', 'GIT_COMMITTER_EMAIL': 'ghost@example.com',
+    # Git protocol v0, the default before git 2.26, only serves advertised objects unless allowed by upload-pack
+    'GIT_CONFIG_PARAMETERS': "'protocol.version'='0'",
+}
+
+
+def _create_mirror(root):
+    source_path = os.path.join(root, 'source')
+    git('init', '-q', source_path)
+    for i in range(30):
+        with open(os.path.join(source_path, 'version'), 'w') as f:
+            f.write(str(i))
+        git('add', 'version', _cwd=source_path)
+        git('commit', '-q', '-m', 'Version {0}'.format(i), _cwd=source_path)
+    git('tag', '-a', '-m', 'Release', 'v1', 'HEAD~6', _cwd=source_path)
+    mirror_path = os.path.join(root, 'mirror')
+    git('clone', '-q', '--bare', '--mirror', source_path, mirror_path)
+    return mirror_path
+
+
+@mock.patch('ghost_tools.log')
+def test_git_fetch_mirror_commit_not_a_tip(log):
+    root = tempfile.mkdtemp()
+    try:
+        with mock.patch.dict(os.environ, GIT_ENV), open(os.devnull, 'w') as log_file:
+            mirror_path = _create_mirror(root)
+            clone_path = os.path.join(root, 'clone')
+            git('init', '-q', clone_path)
+            git('remote', 'add', 'origin', 'file://' + mirror_path, _cwd=clone_path)
+
+            for revision in ('HEAD~5', 'v1^{commit}'):
+                commit = git('rev-parse', revision, _cwd=mirror_path).strip()
+                git_fetch_mirror_commit(clone_path, commit, 10, log_file)
+                git('checkout', '-q', '--force', '--detach', commit, _cwd=clone_path)
+
+                assert git('rev-parse', 'HEAD', _cwd=clone_path).strip() == commit
+                assert git('rev-parse', '--is-shallow-repository', _cwd=clone_path).strip() == 'true'
+    finally:
+        shutil.rmtree(root)
+
+
+@mock.patch('libs.git_helper.git_update_mirror')
+@mock.patch('libs.git_helper.git_get_gitlink_commit', return_value='0d23e96')
+@mock.patch('libs.git_helper.git_get_submodules')
+@mock.patch('libs.git_helper.gcall')
+def test_git_update_submodules_keeps_ignored_files(gcall, git_get_submodules, git_get_gitlink_commit,
+                                                   git_update_mirror):
+    # A single submodule, without nested submodules
+    git_get_submodules.side_effect = lambda path: [] if path.endswith('/lib') else [
+        {'name': 'lib', 'path': 'lib', 'url': 'git@github.com:claranet/lib.git'}]
+
+    for keep_ignored_files, clean_command in ((True, 'git --no-pager clean -ffd'),
+                                              (False, 'git --no-pager clean -ffdx')):
+        gcall.reset_mock()
+        git_update_submodules('/ghost/app/prod/webfront/mod1', 'git@github.com:claranet/app.git', None,
+                              keep_ignored_files=keep_ignored_files)
+        commands = [call[0][0] for call in gcall.call_args_list]
+        assert clean_command in commands
+        assert len([command for command in commands if 'clean' in command]) == 1
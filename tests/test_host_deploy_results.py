@@ -0,0 +1,58 @@
+import json
+
+import mock
+
+from libs.host_deploy_results import HostDeployResultsCollector, get_host_deploy_results_channel
+from libs.host_deploy_results import record_host_deploy_result
+
+JOB_ID = '5a0d3e08a2b9c2b5a1234567'
+
+
+def test_record_host_deploy_result():
+    collection = mock.MagicMock()
+    redis_connection = mock.MagicMock()
+    result = {'host': '10.0.0.1', 'hostname': 'web-10-0-0-1', 'status': 'done', 'return_code': 0}
+
+    record_host_deploy_result(collection, redis_connection, JOB_ID, 'run1', result)
+
+    query, update = collection.update.call_args[0]
+    assert query == {'job_id': JOB_ID, 'run_id': 'run1', 'host': '10.0.0.1'}
+    assert update['$set']['status'] == 'done'
+    assert collection.update.call_args[1] == {'upsert': True}
+    channel, message = redis_connection.publish.call_args[0]
+    assert channel == get_host_deploy_results_channel(JOB_ID)
+    assert json.loads(message)['run_id'] == 'run1'
+
+
+@mock.patch('libs.host_deploy_results.log')
+def test_collector_waits_for_stored_and_published_results(log):
+    collection = mock.MagicMock()
+    # Result stored before the job subscribed to the channel, and results of another run
+    collection.find.return_value = [
+        {'job_id': JOB_ID, 'run_id': 'run1', 'host': '10.0.0.1', 'status': 'done', 'return_code': 0},
+        {'job_id': JOB_ID, 'run_id': 'run0', 'host': '10.0.0.2', 'status': 'done', 'return_code': 0},
+    ]
+    messages = [
+        {'type': 'message', 'data': json.dumps({'run_id': 'run1', 'host': '10.0.0.2', 'status': 'started'})},
+        {'type': 'message', 'data': json.dumps({'run_id': 'run1', 'host': '10.0.0.2', 'status': 'failed',
+                                                'return_code': 243})},
+    ]
+    pubsub = mock.MagicMock()
+    pubsub.get_message.side_effect = lambda timeout: messages.pop(0) if messages else None
+    redis_connection = mock.MagicMock()
+    redis_connection.pubsub.return_value = pubsub
+
+    collector = HostDeployResultsCollector(JOB_ID, collection, redis_connection, 'https://ghost.example.com', 's', 60)
+    results = collector.wait('run1', ['10.0.0.1', '10.0.0.2'], None)
+
+    pubsub.subscribe.assert_called_once_with(get_host_deploy_results_channel(JOB_ID))
+    assert [result['status'] for result in results.values()] == ['success', 'failed']
+    assert results['10.0.0.2']['return_code'] == 243
+    pubsub.close.assert_called_once_with()
+
+
+def test_collector_run_url():
+    collector = HostDeployResultsCollector(JOB_ID, None, None, 'https://ghost.example.com/', 's', 60)
+    run_id, url = collector.new_run()
+
+    assert url.startswith('https://ghost.example.com/jobs/{0}/host_deploy_results/{1}?token='.format(JOB_ID, run_id))
@@ -0,0 +1,66 @@
+import os
+import shutil
+import signal
+import tempfile
+import time
+from multiprocessing import Process, Queue
+from StringIO import StringIO
+
+from libs.locks import FairFileLock
+
+
+def _locked_worker(lock_path, results, worker_id, hold_time):
+    with FairFileLock(lock_path, StringIO()):
+        results.put(('start', worker_id))
+        time.sleep(hold_time)
+        results.put(('end', worker_id))
+
+
+def _wait_for_tickets(lock_path, count):
+    counter_path = os.path.join(lock_path, '.counter')
+    for _ in range(100):
+        if os.path.exists(counter_path) and int(open(counter_path).read() or 0) >= count:
+            return
+        time.sleep(0.01)
+
+
+def test_fair_file_lock_serves_waiters_in_order():
+    lock_dir = tempfile.mkdtemp()
+    lock_path = os.path.join(lock_dir, 'repo')
+    results = Queue()
+    try:
+        workers = []
+        for worker_id in range(4):
+            worker = Process(target=_locked_worker, args=(lock_path, results, worker_id, 0.2))
+            worker.start()
+            workers.append(worker)
+            # Make sure each worker has queued before starting the next one
+            _wait_for_tickets(lock_path, worker_id + 1)
+        for worker in workers:
+            worker.join()
+
+        events = [results.get() for _ in range(8)]
+        assert events == [(event, worker_id) for worker_id in range(4) for event in ('start', 'end')]
+        assert [name for name in os.listdir(lock_path) if name.isdigit()] == []
+    finally:
+        shutil.rmtree(lock_dir)
+
+
+def test_fair_file_lock_reclaims_lock_of_dead_process():
+    lock_dir = tempfile.mkdtemp()
+    lock_path = os.path.join(lock_dir, 'repo')
+    results = Queue()
+    try:
+        holder = Process(target=_locked_worker, args=(lock_path, results, 0, 60))
+        holder.start()
+        assert results.get(timeout=5) == ('start', 0)
+        os.kill(holder.pid, signal.SIGKILL)
+        holder.join()
+
+        start = time.time()
+        lock = FairFileLock(lock_path, StringIO())
+        assert lock.acquire()
+        assert time.time() - start < 1
+        lock.release()
+    finally:
+        shutil.rmtree(lock_dir)
@@ -0,0 +1,113 @@
+import mock
+
+from boto.exception import S3ResponseError
+
+from libs.manifest import AppManifest, MANIFEST_WRITE_RETRIES
+from ghost_tools import GCallException
+
+
+KEY_PATH = '/ghost/app/prod/webfront/blue/MANIFEST'
+MODULES = ['mod1', 'mod2']
+
+
+class FakeBucket(object):
+    """
+    Bucket storing a single MANIFEST and honouring conditional writes
+    """
+
+    def __init__(self, content=None, legacy_content=None):
+        self.objects = {}
+        self.writes = 0
+        if content is not None:
+            self.objects[KEY_PATH] = (content, '"1"')
+        if legacy_content is not None:
+            self.objects['ghost/app/prod/webfront/MANIFEST'] = (legacy_content, '"legacy"')
+
+    def get_key(self, key_path):
+        if key_path not in self.objects:
+            return None
+        key = mock.MagicMock()
+        key.etag = self.objects[key_path][1]
+        key.get_contents_as_string.return_value = self.objects[key_path][0]
+        return key
+
+    def new_key(self, key_path):
+        bucket = self
+        key = mock.MagicMock()
+
+        def set_contents_from_string(content, headers):
+            current_etag = bucket.objects.get(key_path, (None, None))[1]
+            if headers.get('If-Match', current_etag) != current_etag or (
+                    headers.get('If-None-Match') == '*' and current_etag):
+                raise S3ResponseError(412, 'Precondition Failed')
+            bucket.writes += 1
+            key.etag = '"{0}"'.format(bucket.writes + 1)
+            bucket.objects[key_path] = (content, key.etag)
+
+        key.set_contents_from_string.side_effect = set_contents_from_string
+        return key
+
+
+@mock.patch('libs.manifest.log')
+def test_manifest_batched_write(log):
+    bucket = FakeBucket('mod1:1000_mod1_aaaaaaa:/var/www\nmod2:1000_mod2_aaaaaaa:/var/www/mod2\n')
+    history = mock.MagicMock()
+    manifest = AppManifest(bucket, KEY_PATH, MODULES, 'log_file', history=history,
+                           history_infos={'job_id': 'job'}).load()
+
+    assert manifest.get_module_package('mod2') == '1000_mod2_aaaaaaa'
+    manifest.set_module_package({'name': 'mod2', 'path': '/var/www/mod2'}, '2000_mod2_bbbbbbb')
+    manifest.set_module_package({'name': 'mod1', 'path': '/var/www'}, '2000_mod1_bbbbbbb')
+    manifest.save()
+
+    assert bucket.writes == 1
+    assert bucket.objects[KEY_PATH][0] == 'mod1:2000_mod1_bbbbbbb:/var/www\nmod2:2000_mod2_bbbbbbb:/var/www/mod2\n'
+    version = history.insert.call_args[0][0]
+    assert version['job_id'] == 'job'
+    assert version['content'] == bucket.objects[KEY_PATH][0]
+
+
+@mock.patch('libs.manifest.log')
+def test_manifest_conflict_reapplies_changes(log):
+    bucket = FakeBucket('mod1:1000_mod1_aaaaaaa:/var/www\n')
+    manifest = AppManifest(bucket, KEY_PATH, MODULES, 'log_file').load()
+    manifest.set_module_package({'name': 'mod1', 'path': '/var/www'}, '2000_mod1_bbbbbbb')
+
+    # Another job deploys mod2 in the meantime
+    bucket.objects[KEY_PATH] = ('mod1:1000_mod1_aaaaaaa:/var/www\nmod2:1500_mod2_ccccccc:/var/www/mod2\n', '"other"')
+    manifest.save()
+
+    assert bucket.objects[KEY_PATH][0] == 'mod1:2000_mod1_bbbbbbb:/var/www\nmod2:1500_mod2_ccccccc:/var/www/mod2\n'
+
+
+@mock.patch('libs.manifest.log')
+def test_manifest_gives_up_after_retries(log):
+    bucket = FakeBucket('mod1:1000_mod1_aaaaaaa:/var/www\n')
+    bucket.new_key = mock.MagicMock()
+    bucket.new_key.return_value.set_contents_from_string.side_effect = S3ResponseError(412, 'Precondition Failed')
+    manifest = AppManifest(bucket, KEY_PATH, MODULES, 'log_file').load()
+    manifest.set_module_package({'name': 'mod1', 'path': '/var/www'}, '2000_mod1_bbbbbbb')
+
+    try:
+        manifest.save()
+        assert False, 'GCallException expected'
+    except GCallException:
+        pass
+    assert bucket.new_key.return_value.set_contents_from_string.call_count == MANIFEST_WRITE_RETRIES + 1
+
+
+@mock.patch('libs.manifest.log')
+def test_manifest_rollback_without_reading_s3(log):
+    bucket = FakeBucket(legacy_content='mod1:1000_mod1_aaaaaaa:/var/www\n')
+    manifest = AppManifest(bucket, KEY_PATH, MODULES, 'log_file',
+                           legacy_key_path='ghost/app/prod/webfront/MANIFEST').load()
+    manifest.set_module_package({'name': 'mod1', 'path': '/var/www'}, '2000_mod1_bbbbbbb')
+    manifest.set_module_package({'name': 'mod2', 'path': '/var/www/mod2'}, '2000_mod2_bbbbbbb')
+    manifest.save()
+
+    bucket.get_key = mock.MagicMock()
+    manifest.rollback(['mod1', 'mod2'])
+
+    assert not bucket.get_key.called
+    assert bucket.writes == 2
+    assert bucket.objects[KEY_PATH][0] == 'mod1:1000_mod1_aaaaaaa:/var/www\n'
@@ -0,0 +1,118 @@
+import mock
+
+from libs.package_catalog import import_module_packages, purge_module_packages, S3_DELETE_BATCH_SIZE
+
+
+PATH = '/ghost/app/prod/webfront/blue/mod1'
+
+
+def _catalog(count):
+    return [{'_id': i, 'package': '{0}_mod1_abcdef'.format(1000 + i), 'timestamp': 1000 + i,
+             'sidecars': ['{0}_mod1_abcdef.index'.format(1000 + i)]} for i in range(count)]
+
+
+def _delete_result(errors=None):
+    result = mock.MagicMock()
+    result.errors = errors or []
+    return result
+
+
+@mock.patch('libs.package_catalog.log')
+def test_purge_module_packages_batches_deletes(log):
+    packages = _catalog(600)
+    collection = mock.MagicMock()
+    collection.find.return_value.skip.return_value = packages[:-10]
+    bucket = mock.MagicMock()
+    bucket.delete_keys.return_value = _delete_result()
+
+    assert purge_module_packages(collection, bucket, PATH, 'mod1', 10, 'log_file') == 590
+
+    collection.find.assert_called_once_with({'path': PATH, 'module': 'mod1', 'referenced': {'$ne': True}},
+                                            sort=[('timestamp', -1)])
+    collection.find.return_value.skip.assert_called_once_with(10)
+    deleted_keys = [key for call in bucket.delete_keys.call_args_list for key in call[0][0]]
+    assert bucket.delete_keys.call_count == 2
+    assert all(len(call[0][0]) <= S3_DELETE_BATCH_SIZE for call in bucket.delete_keys.call_args_list)
+    assert len(deleted_keys) == 590 * 2
+    assert 'ghost/app/prod/webfront/blue/mod1/1000_mod1_abcdef' in deleted_keys
+    assert 'ghost/app/prod/webfront/blue/mod1/1000_mod1_abcdef.index' in deleted_keys
+    collection.remove.assert_called_once_with({'_id': {'$in': range(590)}})
+
+
+@mock.patch('libs.package_catalog.log')
+def test_purge_module_packages_keeps_failed_packages_in_catalog(log):
+    collection = mock.MagicMock()
+    collection.find.return_value.skip.return_value = _catalog(3)
+    error = mock.MagicMock()
+    error.key = 'ghost/app/prod/webfront/blue/mod1/1001_mod1_abcdef'
+    bucket = mock.MagicMock()
+    bucket.delete_keys.return_value = _delete_result([error])
+
+    assert purge_module_packages(collection, bucket, PATH, 'mod1', 0, 'log_file') == 2
+    collection.remove.assert_called_once_with({'_id': {'$in': [0, 2]}})
+
+
+def test_purge_module_packages_nothing_to_purge():
+    collection = mock.MagicMock()
+    collection.find.return_value.skip.return_value = []
+    bucket = mock.MagicMock()
+
+    assert purge_module_packages(collection, bucket, PATH, 'mod1', 42, 'log_file') == 0
+    assert not bucket.delete_keys.called
+    assert not collection.remove.called
+
+
+@mock.patch('libs.package_catalog.log')
+def test_purge_module_packages_keeps_shared_store_packages(log):
+    packages = _catalog(2)
+    packages[0]['key_path'] = '/ghost/.packages/shared'
+    packages[1]['key_path'] = '/ghost/.packages/unshared'
+    collection = mock.MagicMock()
+    collection.find.return_value.skip.return_value = packages
+    # The shared package is also used by the other color
+    collection.find_one.side_effect = lambda query: {'_id': 'green'} if query['key_path'].endswith('/shared') else None
+    bucket = mock.MagicMock()
+    bucket.delete_keys.return_value = _delete_result()
+
+    assert purge_module_packages(collection, bucket, PATH, 'mod1', 0, 'log_file') == 2
+    deleted_keys = bucket.delete_keys.call_args[0][0]
+    assert 'ghost/.packages/unshared' in deleted_keys
+    assert 'ghost/.packages/shared' not in deleted_keys
+
+
+def _s3_key(name, size=42):
+    key = mock.MagicMock()
+    key.name = name
+    key.size = size
+    return key
+
+
+@mock.patch('libs.package_catalog.log')
+def test_import_module_packages_after_first_registration(log):
+    app = {'_id': 'app1', 'blue_green': {'color': 'blue'}}
+    # The package of the first deployment since the catalog exists is already registered
+    collection = mock.MagicMock()
+    collection.find_one.return_value = {'path': PATH, 'module': 'mod1', 'package': '1002_mod1_abcdef'}
+    imports_collection = mock.MagicMock()
+    imports_collection.find_one.return_value = None
+    bucket = mock.MagicMock()
+    bucket.list.return_value = [_s3_key('ghost/app/prod/webfront/blue/mod1/1000_mod1_abcdef'),
+                                _s3_key('ghost/app/prod/webfront/blue/mod1/1000_mod1_abcdef.index'),
+                                _s3_key('ghost/app/prod/webfront/blue/mod1/1001_mod1_abcdef')]
+    bucket.get_key.return_value.get_contents_as_string.return_value = 'mod1:1002_mod1_abcdef:/var/www'
+
+    import_module_packages(collection, imports_collection, bucket, app, 'mod1', PATH,
+                           '/ghost/app/prod/webfront/blue/MANIFEST', 'log_file')
+
+    imported = dict((call[0][0]['package'], call[0][1]['$setOnInsert']) for call in collection.update.call_args_list)
+    assert sorted(imported) == ['1000_mod1_abcdef', '1001_mod1_abcdef']
+    assert imported['1000_mod1_abcdef']['sidecars'] == ['1000_mod1_abcdef.index']
+    assert not imported['1001_mod1_abcdef']['referenced']
+    imports_collection.update.assert_called_once_with({'path': PATH, 'module': 'mod1'}, mock.ANY, upsert=True)
+
+    # Imported once per module
+    imports_collection.find_one.return_value = {'path': PATH, 'module': 'mod1'}
+    bucket.list.reset_mock()
+    import_module_packages(collection, imports_collection, bucket, app, 'mod1', PATH,
+                           '/ghost/app/prod/webfront/blue/MANIFEST', 'log_file')
+    assert not bucket.list.called
@@ -0,0 +1,171 @@
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+from distutils.spawn import find_executable
+from subprocess import Popen, PIPE
+
+import mock
+import pytest
+
+from ghost_tools import GCallException
+from libs.packaging import stream_package_to_s3, stream_delta_package_to_s3, MIN_UPLOAD_PART_SIZE
+from libs.packaging import get_package_index, get_package_delta, PackageFilter
+from tests.helpers import LOG_FILE, mocked_logger
+
+
+class FakeMultipartUpload(object):
+    def __init__(self, fail_on_part=None):
+        self.parts = {}
+        self.completed = False
+        self.cancelled = False
+        self._fail_on_part = fail_on_part
+
+    def upload_part_from_file(self, fp, part_num):
+        if part_num == self._fail_on_part:
+            raise IOError('S3 is unavailable')
+        self.parts[part_num] = fp.read()
+
+    def complete_upload(self):
+        self.completed = True
+
+    def cancel_upload(self):
+        self.cancelled = True
+
+    def get_contents(self):
+        return ''.join(self.parts[num] for num in sorted(self.parts))
+
+
+def _create_module_workspace():
+    workspace = tempfile.mkdtemp()
+    os.makedirs(os.path.join(workspace, 'src', '.git'))
+    with open(os.path.join(workspace, 'index.php'), 'w') as f:
+        f.write('<?php echo "hello";')
+    with open(os.path.join(workspace, 'src', 'app.php'), 'w') as f:
+        f.write('<?php')
+    with open(os.path.join(workspace, 'src', '.git', 'HEAD'), 'w') as f:
+        f.write('ref: refs/heads/master')
+    # Incompressible content spanning several upload parts
+    with open(os.path.join(workspace, 'assets.bin'), 'wb') as f:
+        f.write(os.urandom(MIN_UPLOAD_PART_SIZE * 2 + 1024))
+    return workspace
+
+
+def _decompress(codec, data):
+    if codec == 'zstd':
+        return Popen(['zstd', '-dc'], stdin=PIPE, stdout=PIPE).communicate(data)[0]
+    return Popen(['gzip', '-dc'], stdin=PIPE, stdout=PIPE).communicate(data)[0]
+
+
+@pytest.mark.parametrize('codec', ['gzip', 'pigz', 'zstd'])
+@mock.patch('libs.packaging.log', new=mocked_logger)
+def test_stream_package_to_s3(codec):
+    if codec != 'gzip' and not find_executable(codec):
+        pytest.skip('{} is not installed'.format(codec))
+    workspace = _create_module_workspace()
+    upload = FakeMultipartUpload()
+    bucket = mock.MagicMock()
+    bucket.initiate_multipart_upload.return_value = upload
+    try:
+        size, content_size, file_count = stream_package_to_s3(
+            workspace, bucket, '/ghost/app/env/role/mod1/1_mod1_abcdef', codec, 42, 43, LOG_FILE,
+            package_filter=PackageFilter.parse(['.git']), metadata={'build-hash': 'hash'},
+            part_size=MIN_UPLOAD_PART_SIZE)
+    finally:
+        shutil.rmtree(workspace)
+
+    bucket.initiate_multipart_upload.assert_called_once_with('/ghost/app/env/role/mod1/1_mod1_abcdef',
+                                                             metadata={'build-hash': 'hash'})
+    assert upload.completed
+    assert len(upload.parts) >= 2
+    assert size == len(upload.get_contents())
+
+    content = _decompress(codec, upload.get_contents())
+    assert content_size == len(content)
+
+    archive = tarfile.open(fileobj=io.BytesIO(content))
+    members = dict((member.name, member) for member in archive.getmembers())
+    assert sorted(members.keys()) == ['.', './assets.bin', './index.php', './src', './src/app.php']
+    assert file_count == 3
+    assert all(member.uid == 42 and member.gid == 43 for member in members.values())
+    assert archive.extractfile('./index.php').read() == '<?php echo "hello";'
+
+
+@mock.patch('libs.packaging.log', new=mocked_logger)
+def test_stream_package_to_s3_upload_error():
+    workspace = _create_module_workspace()
+    upload = FakeMultipartUpload(fail_on_part=2)
+    bucket = mock.MagicMock()
+    bucket.initiate_multipart_upload.return_value = upload
+    try:
+        with pytest.raises(GCallException):
+            stream_package_to_s3(workspace, bucket, '/ghost/app/env/role/mod1/1_mod1_abcdef', 'gzip', 0, 0,
+                                 LOG_FILE, part_size=MIN_UPLOAD_PART_SIZE)
+    finally:
+        shutil.rmtree(workspace)
+
+    assert upload.cancelled
+    assert not upload.completed
+
+
+@mock.patch('libs.packaging.log', new=mocked_logger)
+def test_stream_delta_package_to_s3():
+    workspace = _create_module_workspace()
+    base_index = get_package_index(workspace, PackageFilter.parse(['.git']))
+    with open(os.path.join(workspace, 'index.php'), 'w') as f:
+        f.write('<?php echo "hello world";')
+    os.remove(os.path.join(workspace, 'src', 'app.php'))
+    with open(os.path.join(workspace, 'src', 'lib.php'), 'w') as f:
+        f.write('<?php')
+    index = get_package_index(workspace, PackageFilter.parse(['.git']))
+    paths = get_package_delta(base_index, index)
+    assert paths == ['./index.php', './src/lib.php']
+
+    upload = FakeMultipartUpload()
+    bucket = mock.MagicMock()
+    bucket.initiate_multipart_upload.return_value = upload
+    try:
+        stream_delta_package_to_s3(workspace, bucket, '/ghost/app/env/role/mod1/2_mod1_b.delta-1_mod1_a', paths,
+                                   '1_mod1_a', index, 42, 43, LOG_FILE, part_size=MIN_UPLOAD_PART_SIZE)
+    finally:
+        shutil.rmtree(workspace)
+
+    archive = tarfile.open(fileobj=io.BytesIO(_decompress('gzip', upload.get_contents())))
+    assert sorted(archive.getnames()) == ['./.ghost-delta-base', './.ghost-delta-digests', './.ghost-delta-files',
+                                          './index.php', './src/lib.php']
+    assert archive.extractfile('./.ghost-delta-base').read() == '1_mod1_a'
+    assert archive.extractfile('./.ghost-delta-files').read().splitlines() == [
+        './assets.bin', './index.php', './src', './src/lib.php']
+    assert archive.extractfile('./.ghost-delta-digests').read() == '{0}  ./assets.bin\n'.format(
+        index['./assets.bin'].split(':')[2])
+
+
+@mock.patch('libs.packaging.log', new=mocked_logger)
+def test_stream_package_to_s3_packaging_rules():
+    workspace = _create_module_workspace()
+    os.makedirs(os.path.join(workspace, 'tests', 'fixtures'))
+    with open(os.path.join(workspace, 'tests', 'fixtures', 'dump.sql'), 'w') as f:
+        f.write('SELECT 1;')
+    with open(os.path.join(workspace, '.ghostignore'), 'w') as f:
+        f.write('# Not needed on instances\ntests/\n*.bin\n')
+    with open(os.path.join(workspace, 'predeploy'), 'w') as f:
+        f.write('exit 0')
+    module = {'name': 'mod1', 'packaging': {'exclude': ['src/*', 'predeploy'], 'include': ['app.php']}}
+    upload = FakeMultipartUpload()
+    bucket = mock.MagicMock()
+    bucket.initiate_multipart_upload.return_value = upload
+    try:
+        package_filter = PackageFilter.from_module(module, workspace, exclude_git_metadata=True)
+        size, content_size, file_count = stream_package_to_s3(
+            workspace, bucket, '/ghost/app/env/role/mod1/1_mod1_abcdef', 'gzip', 0, 0, LOG_FILE,
+            package_filter=package_filter, part_size=MIN_UPLOAD_PART_SIZE)
+        index = get_package_index(workspace, package_filter)
+    finally:
+        shutil.rmtree(workspace)
+
+    archive = tarfile.open(fileobj=io.BytesIO(_decompress('gzip', upload.get_contents())))
+    assert sorted(archive.getnames()) == ['.', './.ghostignore', './index.php', './predeploy', './src',
+                                          './src/app.php']
+    assert file_count == 4
+    assert sorted(index) == sorted(archive.getnames())[1:]
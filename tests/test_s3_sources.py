@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+
+import mock
+
+from libs.s3_sources import S3SourcesFetcher
+
+
+OBJECTS = {
+    'sources/mod1/index.php': ('"etag1"', '<?php echo "index";'),
+    'sources/mod1/web/app.php': ('"etag2"', '<?php echo "app";'),
+}
+
+
+def _client(objects):
+    client = mock.MagicMock()
+    client.get_paginator.return_value.paginate.return_value = [{'Contents': [
+        {'Key': key, 'ETag': etag, 'Size': len(content)} for key, (etag, content) in sorted(objects.items())
+    ]}]
+
+    def download_file(bucket, key, path, ExtraArgs=None):
+        with open(path, 'w') as f:
+            f.write(objects[key][1])
+
+    client.download_file.side_effect = download_file
+    return client
+
+
+@mock.patch('libs.s3_sources.log')
+def test_fetch_latest_uses_cache(log):
+    root = tempfile.mkdtemp()
+    working_directories = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+    objects = dict(OBJECTS)
+    client = _client(objects)
+    try:
+        S3SourcesFetcher(client, {}, 'log_file', root=root).fetch_latest('s3://bucket/sources/mod1',
+                                                                         working_directories[0])
+        client.get_paginator.return_value.paginate.assert_called_once_with(Bucket='bucket', Prefix='sources/mod1/')
+        assert client.download_file.call_count == 2
+        with open(os.path.join(working_directories[0], 'web', 'app.php')) as f:
+            assert f.read() == '<?php echo "app";'
+
+        # Only the modified object is downloaded again
+        objects['sources/mod1/index.php'] = ('"etag3"', '<?php echo "new index";')
+        client = _client(objects)
+        S3SourcesFetcher(client, {}, 'log_file', root=root).fetch_latest('s3://bucket/sources/mod1',
+                                                                         working_directories[1])
+        assert [call[0][1] for call in client.download_file.call_args_list] == ['sources/mod1/index.php']
+        with open(os.path.join(working_directories[1], 'index.php')) as f:
+            assert f.read() == '<?php echo "new index";'
+        assert os.path.isfile(os.path.join(working_directories[1], 'web', 'app.php'))
+    finally:
+        for path in [root] + working_directories:
+            shutil.rmtree(path)
+
+
+@mock.patch('libs.s3_sources.log')
+def test_fetch_version(log):
+    root = tempfile.mkdtemp()
+    working_directory = tempfile.mkdtemp()
+    client = _client({'sources/mod1.tar.gz': ('"etag1"', 'archive')})
+    try:
+        fetcher = S3SourcesFetcher(client, {}, 'log_file', root=root)
+        fetcher.fetch_version('s3://bucket/sources/mod1.tar.gz', working_directory, 'v42')
+        fetcher.fetch_version('s3://bucket/sources/mod1.tar.gz', working_directory, 'v42')
+
+        client.download_file.assert_called_once_with('bucket', 'sources/mod1.tar.gz', mock.ANY,
+                                                     ExtraArgs={'VersionId': 'v42'})
+        with open(os.path.join(working_directory, 'mod1.tar.gz')) as f:
+            assert f.read() == 'archive'
+    finally:
+        shutil.rmtree(root)
+        shutil.rmtree(working_directory)
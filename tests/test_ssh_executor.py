@@ -0,0 +1,60 @@
+import os
+import tempfile
+import time
+
+import mock
+
+from libs.ssh_executor import SSHExecutor
+from libs.ssh_pool import SSHConnectionPool
+
+
+def fake_fab_execute(task, log_file, *args, **kwargs):
+    host = kwargs['hosts'][0]
+    log_file.write('{0} {1}\n'.format(host, os.getpid()))
+    log_file.flush()
+    if host == 'slow':
+        time.sleep(10)
+    return {host: 1 if host.startswith('failing') else 0}
+
+
+@mock.patch('libs.ssh_pool.fab_execute', new=fake_fab_execute)
+@mock.patch('libs.ssh_pool._get_task', new=lambda task_name: task_name)
+@mock.patch('libs.ssh_executor.log')
+def test_ssh_executor_results(log):
+    with tempfile.TemporaryFile() as log_file:
+        results = SSHExecutor(2, 1, 0, log_file).run(['ok1', 'failing', 'slow', 'ok2'], 'deploy', log_file)
+
+    assert list(results.keys()) == ['ok1', 'failing', 'slow', 'ok2']
+    assert [result['status'] for result in results.values()] == ['success', 'failed', 'timeout', 'success']
+    assert results['failing']['return_code'] == 1
+    assert results['slow']['duration'] < 5
+
+
+@mock.patch('libs.ssh_pool.fab_execute', new=fake_fab_execute)
+@mock.patch('libs.ssh_pool._get_task', new=lambda task_name: task_name)
+@mock.patch('libs.ssh_executor.log')
+def test_ssh_executor_aborts_after_max_failures(log):
+    with tempfile.TemporaryFile() as log_file:
+        results = SSHExecutor(1, 0, 2, log_file).run(['failing1', 'ok1', 'failing2', 'ok2', 'ok3'], 'deploy', log_file)
+
+    assert [result['status'] for result in results.values()] == ['failed', 'success', 'failed', 'skipped', 'skipped']
+
+
+@mock.patch('libs.ssh_pool.fab_execute', new=fake_fab_execute)
+@mock.patch('libs.ssh_pool._get_task', new=lambda task_name: task_name)
+@mock.patch('libs.ssh_executor.log')
+def test_ssh_executor_reuses_pool_workers(log):
+    with tempfile.TemporaryFile() as log_file:
+        pool = SSHConnectionPool(log_file)
+        try:
+            for _ in range(2):
+                results = SSHExecutor(2, 0, 0, log_file, pool).run(['ok1', 'ok2'], 'deploy', log_file)
+                assert [result['status'] for result in results.values()] == ['success', 'success']
+        finally:
+            pool.close()
+        log_file.seek(0)
+        lines = log_file.read().splitlines()
+
+    # Each host is served by the same worker process in both runs
+    assert len(lines) == 4
+    assert len(set(lines)) == 2
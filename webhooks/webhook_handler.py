@@ -1,6 +1,8 @@
 from eve.methods.post import post_internal
+from redis.exceptions import RedisError
 
 from ghost_data import get_webhook
+from libs.git_helper import git_mark_branches_tags_stale
 from parsers.bitbucket import BitbucketWebhookParser
 from parsers.github import GithubWebhookParser
 from parsers.gitlab import GitlabWebhookParser
@@ -36,6 +38,18 @@ class WebhookHandler:
     def parse_request(self):
         self._parser.parse_request()
 
+    def refresh_git_refs(self, redis_connection):
+        """
+        Invalidates the cached branches and tags of the notified repository
+        """
+        repo_urls = self._parser.get_repo_urls()
+        if repo_urls:
+            try:
+                git_mark_branches_tags_stale(repo_urls, redis_connection)
+            except RedisError:
+                # The refs cache is expired anyway when the mirror is fetched again
+                pass
+
     def validate_request(self):
         return self._parser.validate_request(self.get_conf())
 
@@ -2,6 +2,7 @@
 
 import base64
 import chardet
+import json
 import os
 
 from flask import request
@@ -15,6 +16,8 @@ from settings import cloud_connections, DEFAULT_PROVIDER
 from ghost_tools import config, get_job_log_remote_path
 from ghost_aws import download_file_from_s3
 from ghost_blueprints import get_websocket_token
+from ghost_data import db
+from libs.host_deploy_results import format_host_deploy_result, get_host_deploy_results_channel
 
 LOG_ROOT = '/var/log/ghost'
 
@@ -311,6 +314,24 @@ def create_ws(app):
             socketio.emit('job', formatter.format_error('Failed to read log file.'), room=sid)
         print 'SocketIO: ending loop for ' + sid
 
+    def follow_host_deploy_results(job_id, sid):
+        print 'SocketIO: starting host deploy results loop for ' + sid
+        pubsub = app.ghost_redis_connection.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(get_host_deploy_results_channel(job_id))
+        try:
+            # Results already received, then the new ones as they are published
+            for document in db.host_deploy_results.find({'job_id': job_id}).sort('_updated', 1):
+                socketio.emit('job_host_deploy_results', format_host_deploy_result(document), room=sid)
+            while sid in socketio.server.rooms(sid):
+                message = pubsub.get_message()
+                if message and message['type'] == 'message':
+                    socketio.emit('job_host_deploy_results', json.loads(message['data']), room=sid)
+                else:
+                    gevent.sleep(0.5)
+        finally:
+            pubsub.close()
+        print 'SocketIO: ending host deploy results loop for ' + sid
+
     @socketio.on('connect')
     def handle_connect():
         print 'SocketIO: connected from ' + request.sid
@@ -351,4 +372,17 @@ def create_ws(app):
         else:
             socketio.emit('job', formatter.format_error('Undefined authentication token.'), room=request.sid)
 
+    @socketio.on('job_host_deploy_results')
+    def handle_host_deploy_results(data):
+        print 'SocketIO: host deploy results request from ' + request.sid
+        job_id = data.get('job_id') if data else None
+        if not data or not data.get('auth_token'):
+            socketio.emit('job_host_deploy_results', {'error': 'Undefined authentication token.'}, room=request.sid)
+        elif not job_id or check_log_id(job_id) is None:
+            socketio.emit('job_host_deploy_results', {'error': 'Invalid job_id.'}, room=request.sid)
+        elif get_websocket_token(job_id) != data.get('auth_token'):
+            socketio.emit('job_host_deploy_results', {'error': 'Invalid authentication token.'}, room=request.sid)
+        else:
+            gevent.spawn(follow_host_deploy_results, job_id, request.sid)
+
     return socketio